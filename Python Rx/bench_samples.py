@@ -0,0 +1,87 @@
+'''
+
+Sample representation benchmark
+
+Decodes a million station datagrams into each representation the receiver has
+had and keeps them all, reporting decode throughput and the memory held per
+sample: the old dict of strings from json.loads, sample objects from JSON and
+from binary frames, and a columnar sampleBatch filled straight from binary frames.
+
+usage: python3 bench_samples.py [--count 1000000] [--json]
+
+'''
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from btwind.samples import sample, sampleBatch
+
+def jsonFrames(n):
+    distinct = [sample(i % 60, (i * 7) % 80, 40 + (i % 500) / 10).toJson() for i in range(1000)]
+    return [distinct[i % 1000] for i in range(n)]
+
+def binaryFrames(n):
+    distinct = [sample(i % 60, (i * 7) % 80, 40 + (i % 500) / 10).toFrame() for i in range(1000)]
+    return [distinct[i % 1000] for i in range(n)]
+
+def dicts(frames):
+    return [json.loads(f) for f in frames]
+
+def samplesFromJson(frames):
+    return [sample.fromJson(f) for f in frames]
+
+def samplesFromFrames(frames):
+    return [sample.fromFrame(f) for f in frames]
+
+def batchFromFrames(frames):
+    batch = sampleBatch()
+    append = batch.appendFrame
+    now, mono = time.time(), time.monotonic()
+    for f in frames:
+        append(f, now, mono)
+    return batch
+
+cases = (
+    ("dict of strings (json.loads)", dicts, jsonFrames),
+    ("sample from json", samplesFromJson, jsonFrames),
+    ("sample from binary frame", samplesFromFrames, binaryFrames),
+    ("sampleBatch from binary frame", batchFromFrames, binaryFrames),
+)
+
+def run(name, decode, make, count):
+    frames = make(count)
+    gc.collect()
+    t = time.perf_counter()
+    result = decode(frames)
+    seconds = time.perf_counter() - t
+    del result
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    result = decode(frames)
+    held = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del result
+    return {
+        "case": name,
+        "samples": count,
+        "seconds": seconds,
+        "samplesPerSec": count / seconds,
+        "memBytes": held,
+        "bytesPerSample": held / count,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="sample representation benchmark")
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--json', action='store_true', help="print results as json")
+    args = parser.parse_args()
+    results = [run(name, decode, make, args.count) for name, decode, make in cases]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'representation':<32} {'samples/s':>12} {'MB held':>9} {'B/sample':>9}")
+        for r in results:
+            print(f"{r['case']:<32} {r['samplesPerSec']:>12,.0f} {r['memBytes'] / 1e6:>9.1f} {r['bytesPerSample']:>9.1f}")
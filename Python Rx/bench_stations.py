@@ -0,0 +1,91 @@
+'''
+
+Multi-station receiver benchmark
+
+Starts simulated stations (btwind.simulator) in a child process, so their CPU
+isn't counted, and a stationHub receiving from all of them on one loop in this
+process, then reports receiver CPU and memory for each station count.
+
+usage: python3 bench_stations.py [--counts 1,5,10,20,40] [--rate 1] [--seconds 10]
+
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from btwind.simulator import startStations
+from btwind.stations import stationRegistry, stationHub
+
+# Child process, runs count simulated stations on TCP sending at rate Hz
+def serveStations(count, rate, ports):
+    for server in startStations(count, rate, seed=1):
+        ports.put(server.port)
+    threading.Event().wait()
+
+def run(count, rate, seconds):
+    ports = multiprocessing.Queue()
+    child = multiprocessing.Process(target=serveStations, args=(count, rate, ports), daemon=True)
+    child.start()
+    tmp = tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False)
+    tmp.write("[Stations]\n")
+    for i in range(count):
+        tmp.write(f"s{i} = 127.0.0.1:{ports.get()}\n")
+    tmp.close()
+
+    received = [0]
+    def onSample(m):
+        received[0] += 1
+
+    async def main():
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        hub = stationHub(stationRegistry(tmp.name), onSample=onSample)
+        task = asyncio.ensure_future(hub.run())
+        await asyncio.sleep(1) # let every station connect
+        mem = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        received[0] = 0
+        cpu, wall = time.process_time(), time.time()
+        await asyncio.sleep(seconds)
+        cpu, wall = time.process_time() - cpu, time.time() - wall
+        connected = sum(1 for s in hub.stats().values() if s["connected"])
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return mem, cpu, wall, connected
+
+    mem, cpu, wall, connected = asyncio.run(main())
+    child.terminate()
+    os.unlink(tmp.name)
+    return {
+        "stations": count,
+        "connected": connected,
+        "rate": rate,
+        "samples": received[0],
+        "samplesPerSec": received[0] / wall,
+        "cpuPct": 100 * cpu / wall,
+        "cpuPerStationPct": 100 * cpu / wall / count,
+        "memBytes": mem,
+        "memPerStation": mem / count,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="multi-station receiver benchmark")
+    parser.add_argument('--counts', default='1,5,10,20,40')
+    parser.add_argument('--rate', type=float, default=1, help="datagrams per second per station")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--json', action='store_true', help="print results as json")
+    args = parser.parse_args()
+    results = [run(int(n), args.rate, args.seconds) for n in args.counts.split(',')]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'stations':>8} {'up':>4} {'samples/s':>10} {'cpu %':>7} {'cpu %/stn':>9} {'mem KB':>8} {'KB/stn':>7}")
+        for r in results:
+            print(f"{r['stations']:>8} {r['connected']:>4} {r['samplesPerSec']:>10.1f} {r['cpuPct']:>7.2f} "
+                f"{r['cpuPerStationPct']:>9.3f} {r['memBytes'] / 1024:>8.1f} {r['memPerStation'] / 1024:>7.1f}")
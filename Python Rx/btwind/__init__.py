@@ -0,0 +1,11 @@
+'''
+
+btwind receiver core
+
+Everything needed to receive, parse, store and forward btwind station data,
+with no GUI. The Kivy btwindrx apps are clients of this package and it runs
+on its own as a daemon: python3 -m btwind --help
+
+Submodules are imported on demand so the package itself loads instantly.
+
+'''
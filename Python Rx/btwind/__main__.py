@@ -0,0 +1,91 @@
+'''
+
+btwind headless receiver
+
+Runs the receiver core without a GUI, as a daemon or from a terminal:
+
+    python3 -m btwind -c btwindrx.ini
+    python3 -m btwind --engine asyncio --print
+    python3 -m btwind --record capture-{station}.rec
+
+Samples go to the sinks enabled in the settings file (storage, MQTT/outbox).
+SIGINT or SIGTERM stops it cleanly so the outbox and stores are flushed.
+
+'''
+import time
+started = time.perf_counter()
+
+import argparse
+import json
+import logging
+import signal
+import threading
+
+from . import config as settings
+from . import logs
+from .receiver import receiver
+
+log = logging.getLogger("btwind")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="btwind", description="headless BT wind station receiver")
+    parser.add_argument('-c', '--config', default='btwindrx.ini', help="settings file (default btwindrx.ini)")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), help="override General/engine")
+    parser.add_argument('--print', action='store_true', help="print every sample as a json line")
+    parser.add_argument('--record', metavar='FILE', help="write the raw link to a replay file, {station} is replaced by the name")
+    parser.add_argument('--metrics', metavar='[HOST:]PORT', help="serve prometheus metrics, overrides [Metrics]")
+    parser.add_argument('--log-level', help="DEBUG, INFO, WARNING or ERROR, overrides [Logging]")
+    parser.add_argument('--log-file', metavar='FILE', help="also log to this rotating file, overrides [Logging]")
+    args = parser.parse_args(argv)
+
+    config = settings.load(args.config)
+    logs.fromConfig(config, level=args.log_level, file=args.log_file)
+    if args.engine:
+        config.set('General', 'engine', args.engine)
+    if args.metrics:
+        host, _, port = args.metrics.rpartition(':')
+        config.set('Metrics', 'enabled', '1')
+        config.set('Metrics', 'port', port)
+        if host:
+            config.set('Metrics', 'host', host)
+    if args.record:
+        config.set('General', 'record', args.record.replace('%', '%%'))
+
+    def onSample(m):
+        if args.print:
+            print(json.dumps(m.asDict()), flush=True)
+
+    def onState(station, up):
+        log.info("Station %s is %s", station, "connected" if up else "disconnected")
+
+    rx = receiver(config, args.config, onSample=onSample, onState=onState)
+    if rx.engine == 'asyncio':
+        import asyncio
+        asyncio.run(runAsync(rx))
+    else:
+        done = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *a: done.set())
+        rx.start()
+        log.info("Receiver started in %.1f ms", (time.perf_counter() - started) * 1000)
+        while not done.wait(3600):
+            pass
+        rx.stop()
+    log.info("Receiver stopped")
+    logs.shutdown()
+
+async def runAsync(rx):
+    import asyncio
+    done = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, done.set)
+    rx.start()
+    log.info("Receiver started in %.1f ms", (time.perf_counter() - started) * 1000)
+    await done.wait()
+    rx.stop()
+    if rx.task:
+        await asyncio.gather(rx.task, return_exceptions=True) # let the connections close
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+'''
+
+btwind asyncio receive engine
+
+An alternative to the watcher/connection thread pair. One stationEngine runs the
+connection, the reconnect backoff, outgoing commands and the sample sinks as
+coroutines on a single event loop, so a GUI running on the same loop (Kivy's
+async_run) gets samples without any thread hops, and cancelling the run() task
+shuts everything down cleanly. Many engines can share one loop.
+
+'''
+import asyncio
+import logging
+import time
+
+from .channels import priority, normal, bulk
+from .framing import sampleStream
+from .linkhealth import linkHealth
+from .protocol import connectCmd, backfillCmd
+from .supervisor import backoff
+
+log = logging.getLogger(__name__)
+
+# Runs one station link over a transport (see transports.py), anything with a name and an
+# openAsync() coroutine returning an asyncio (reader, writer) pair. Samples are passed to
+# every sink and then onSample, link state changes to onState(True/False). Sinks may be plain
+# functions or coroutine functions, so may backfill, which gets lists of the samples the station kept
+# while the link was down.
+class stationEngine:
+    def __init__(self, transport, onSample=None, onState=None, sinks=(), base=1.0, limit=60.0, retries=0, protocol="binary",
+            cadence=1.0, pulses=None, backfill=None):
+        self.transport = transport
+        self.protocol = protocol # datagram format asked for on connect, binary or json
+        self.name = transport.name
+        self.onSample = onSample
+        self.onState = onState
+        self.sinks = list(sinks)
+        self.backfill = backfill
+        self.backoff = backoff(base, limit)
+        self.maxRetries = retries # consecutive failed attempts before giving up, 0 = never give up
+        self.loop = None
+        self.commands = priority() # commands waiting to be sent, bounded, most urgent first
+        self.commands.notify = self.wakeSender
+        self.wake = None # asyncio.Event the sender waits on, created on the engine's loop in run()
+        self.health = linkHealth(self.name, cadence) # arrival timing, rates and reconnects
+        self.stream = sampleStream(health=self.health) # framing, decoding and link quality counters, kept across connections
+        if pulses:
+            self.stream.pulses = pulses() # pulse mode, the receiver works out the speed from the pulse times
+        self.stream.backfilling = backfill is not None
+
+        # counters, same meaning as supervisor.linkSupervisor
+        self.attempts = 0
+        self.retries = 0
+        self.connects = 0
+        self.upSince = None
+        self.upTotal = 0.0
+        self.startedAt = time.time()
+
+    # queue an outgoing command, safe to call from any thread
+    def send(self, cmd, level=normal):
+        self.commands.put(cmd, level)
+
+    def wakeSender(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    # connect, run the session, back off, repeat until cancelled or the retry limit is hit
+    async def run(self):
+        self.wake = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        try:
+            while 1:
+                self.attempts += 1
+                log.info("Attempting connection with %s", self.name)
+                try:
+                    reader, writer = await self.transport.openAsync()
+                except (OSError, ValueError) as e:
+                    self.retries += 1
+                    if self.maxRetries and self.retries >= self.maxRetries:
+                        log.warning("Giving up on %s after %d failed connection attempts", self.name, self.retries)
+                        return
+                    delay = self.backoff.next()
+                    log.error("Failed to establish connection with %s: %s, retrying in %.1f sec", self.name, e, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                self.backoff.reset()
+                self.retries = 0
+                await self.session(reader, writer)
+        finally:
+            log.info("Engine for %s is exiting", self.name)
+
+    async def session(self, reader, writer):
+        log.info("Successfully connected with %s", self.name)
+        self.connects += 1
+        self.upSince = time.time()
+        self.stream.reset()
+        self.state(True)
+        writer.write(connectCmd(self.protocol, self.stream.pulses is not None).encode()) # old firmware ignores it and sends json
+        if self.backfill:
+            self.send(backfillCmd(self.stream.resume), bulk) # what the station kept while we were away
+        sender = asyncio.ensure_future(self.sender(writer))
+        watchdog = asyncio.ensure_future(self.watchdog())
+        try:
+            while 1:
+                data = await reader.read(4096)
+                if not data:
+                    raise ConnectionError("connection closed by remote host")
+                for m in self.stream.feed(data): # damaged frames are skipped and counted, they never end the session
+                    await self.dispatch(m)
+                backfilled = self.stream.takeBackfill()
+                if backfilled:
+                    try:
+                        r = self.backfill(backfilled)
+                        if asyncio.iscoroutine(r):
+                            await r
+                    except Exception:
+                        log.exception("Backfill from %s failed", self.name)
+        except OSError as e: # loss of connection, back out to run() to reconnect
+            log.error("The connection with %s was lost: %s", self.name, e)
+        except Exception: # a bug, not the link, but reconnecting beats the engine ending for good
+            log.exception("The session with %s failed", self.name)
+        finally:
+            sender.cancel()
+            watchdog.cancel()
+            writer.close()
+            self.upTotal += time.time() - self.upSince
+            self.upSince = None
+            self.state(False)
+
+    # drains the command queue onto the wire for the life of a session
+    async def sender(self, writer):
+        while 1:
+            commands = self.commands.getBatch()
+            if commands: # everything that queued up goes out in one write
+                writer.write("".join(commands).encode())
+                await writer.drain()
+            else:
+                await self.wake.wait()
+                self.wake.clear()
+
+    # a stalled link has no frames to notice it by, check the timing once a second
+    async def watchdog(self):
+        while 1:
+            await asyncio.sleep(1)
+            self.health.check()
+
+    # the sinks then onSample like the thread engine, one that raises is logged and the sample goes on to the rest
+    async def dispatch(self, m):
+        for sink in self.sinks:
+            try:
+                r = sink(m)
+                if asyncio.iscoroutine(r):
+                    await r
+            except Exception:
+                log.exception("A sink failed on a sample from %s", self.name)
+        if self.onSample:
+            try:
+                self.onSample(m)
+            except Exception:
+                log.exception("onSample failed on a sample from %s", self.name)
+
+    def state(self, up):
+        if up:
+            self.health.up()
+        else:
+            self.health.down()
+        if self.onState:
+            self.onState(up)
+
+    def uptime(self):
+        if self.upSince is None:
+            return 0.0
+        return time.time() - self.upSince
+
+    def stats(self):
+        stats = {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "connects": self.connects,
+            "connected": self.upSince is not None,
+            "uptime": self.uptime(),
+            "upTotal": self.upTotal + self.uptime(),
+            "runtime": time.time() - self.startedAt,
+        }
+        stats.update(self.commands.stats())
+        stats.update(self.stream.stats())
+        stats.update(self.health.stats())
+        return stats
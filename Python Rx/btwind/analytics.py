@@ -0,0 +1,294 @@
+'''
+
+btwind wind analytics
+
+The station only reports the speed now and a gust that holds until someone
+resets it. These are the usual wind report figures, worked out on the
+receiver from the samples:
+
+    sustained       mean over the last 2 minutes (the NWS sustained wind,
+                    use 600 for the WMO 10 minute mean)
+    gust            highest 3 second mean (the WMO gust) in the period
+    lull            lowest 3 second mean in the period
+    gust factor     gust / mean speed over the period
+    turbulence      turbulence intensity, standard deviation / mean speed over
+                    the period
+    feelsLo         lowest feels like temperature in the period, batch only
+                    (the live one is on each sample and in the rollups, see
+                    derived.py)
+
+The speed is sample.speed in pulse mode and mph otherwise. A 3 second mean is
+only counted once the samples in it cover at least half the window, so one
+sample after a gap in the data isn't taken for a gust.
+
+windWindow does it incrementally, one add() per sample in constant time and
+plain Python, over a trailing period. windAnalytics keeps one per station as
+a sink, its stats() go to the metrics page:
+
+    [Analytics]
+    enabled = 1
+    period = 600        seconds of the trailing window, and of a batch report row
+    sustained = 120
+    gust = 3
+
+periodStats() is the batch form over stored history with numpy: clock aligned
+periods, cumulative sums and binary searches for the rolling means, reductions
+per period, worked through in chunks so memory stays small whatever the span.
+A year of 1 Hz samples takes seconds. From the command line:
+
+    python3 -m btwind.analytics data/default.ring --period 3600
+
+'''
+import argparse
+import collections
+import math
+import os
+import sys
+import time
+
+from .config import defaults as settingDefaults
+from .derived import derivedArrays
+from .pulses import numpy
+
+defaults = settingDefaults["Analytics"]
+
+# the speed analytics use for a sample
+def speedOf(m):
+    return m.mph if m.speed is None else m.speed
+
+# Running mean over the last window seconds
+class runningMean:
+    def __init__(self, window):
+        self.window = window
+        self.values = collections.deque() # (t, x)
+        self.total = 0.0
+
+    def add(self, t, x):
+        self.values.append((t, x))
+        self.total += x
+        while self.values[0][0] <= t - self.window:
+            self.total -= self.values.popleft()[1]
+        if len(self.values) == 1:
+            self.total = x # no rounding drift carried over
+
+    def mean(self):
+        return self.total / len(self.values)
+
+    # how much of the window the samples in it cover
+    def span(self):
+        return self.values[-1][0] - self.values[0][0]
+
+# Highest (or lowest) value over the last window seconds, a monotonic deque
+class runningExtreme:
+    def __init__(self, window, lowest=False):
+        self.window = window
+        self.sign = -1 if lowest else 1
+        self.values = collections.deque() # (t, x) with x falling (rising for lowest)
+
+    def add(self, t, x):
+        v = x * self.sign
+        while self.values and self.values[-1][1] <= v:
+            self.values.pop()
+        self.values.append((t, v))
+        while self.values[0][0] <= t - self.window:
+            self.values.popleft()
+
+    def value(self):
+        try:
+            return self.values[0][1] * self.sign
+        except IndexError: # none in the window, or add() is emptying it on the receive thread
+            return None
+
+    def expire(self, t):
+        while self.values and self.values[0][0] <= t - self.window:
+            self.values.popleft()
+
+# Sustained wind, gusts, lulls, gust factor and turbulence over a trailing period, one sample at a time
+class windWindow:
+    def __init__(self, period=600.0, sustained=120.0, gust=3.0):
+        self.period = period
+        self.gustWindow = gust
+        self.sustainedMean = runningMean(sustained)
+        self.gustMean = runningMean(gust)
+        self.peak = runningExtreme(period)
+        self.low = runningExtreme(period, lowest=True)
+        self.values = collections.deque() # (t, x) over the period
+        self.total = 0.0
+        self.squares = 0.0
+        self.samples = 0
+
+    def add(self, t, x):
+        self.samples += 1
+        self.sustainedMean.add(t, x)
+        self.gustMean.add(t, x)
+        if self.gustMean.span() >= self.gustWindow / 2:
+            g = self.gustMean.mean()
+            self.peak.add(t, g)
+            self.low.add(t, g)
+        else:
+            self.peak.expire(t)
+            self.low.expire(t)
+        self.values.append((t, x))
+        self.total += x
+        self.squares += x * x
+        while self.values[0][0] <= t - self.period:
+            old = self.values.popleft()[1]
+            self.total -= old
+            self.squares -= old * old
+        if len(self.values) == 1:
+            self.total, self.squares = x, x * x
+
+    def stats(self):
+        if not self.values:
+            return {}
+        n = len(self.values)
+        mean = self.total / n
+        sd = math.sqrt(max(0.0, self.squares / n - mean * mean))
+        gust = self.peak.value()
+        return {
+            "sustained": self.sustainedMean.mean(),
+            "mean": mean,
+            "sd": sd,
+            "turbulence": sd / mean if mean > 0 else None,
+            "gust": gust,
+            "lull": self.low.value(),
+            "gustFactor": gust / mean if gust is not None and mean > 0 else None,
+        }
+
+# A windWindow per station, as a sink
+class windAnalytics:
+    def __init__(self, period=600.0, sustained=120.0, gust=3.0):
+        self.settings = (period, sustained, gust)
+        self.windows = {} # station: windWindow
+
+    @classmethod
+    def fromConfig(cls, config):
+        get = lambda key: float(config.get('Analytics', key, fallback=defaults.get(key)))
+        return cls(get('period'), get('sustained'), get('gust'))
+
+    def put(self, m):
+        window = self.windows.get(m.station)
+        if window is None:
+            window = self.windows[m.station] = windWindow(*self.settings)
+        window.add(m.received, speedOf(m)) # monotonic, a clock change doesn't bend the windows
+
+    def stats(self):
+        return {station: w.stats() for station, w in list(self.windows.items())}
+
+# mean of x over the window seconds ending at each sample, nan where the samples cover under half of it.
+# t must be sorted
+def rollingMean(t, x, window):
+    np = numpy()
+    sums = np.concatenate(([0.0], np.cumsum(x)))
+    end = np.arange(1, len(t) + 1)
+    start = np.searchsorted(t, t - window, side='right')
+    mean = (sums[end] - sums[start]) / (end - start)
+    mean[t - t[start] < window / 2] = np.nan
+    return mean
+
+# Report rows for every period with samples: start time, count, mean, sd, turbulence, sustained (the highest
+# sustained mean), gust, lull and gustFactor, each a numpy array, and feelsLo when temperatures (degrees F) are
+# given. t is sorted sample times, seconds = t * scale + offset, so a ring's raw 1/10 sec times can be passed
+# without a converted copy of the lot; the work is done chunk samples at a time
+def periodStats(t, x, period=600.0, sustained=120.0, gust=3.0, scale=1.0, offset=0.0, chunk=1 << 20, temp=None):
+    np = numpy()
+    t = np.asarray(t)
+    x = np.asarray(x)
+    names = ("start", "count", "total", "squares", "sustained", "gust", "lull")
+    if temp is not None:
+        temp = np.asarray(temp)
+        names += ("feelsLo",)
+    lookback = max(sustained, gust)
+    raw = lambda seconds: (seconds - offset) / scale # seconds to the units of t
+    parts = []
+    a = 0
+    while a < len(t):
+        b = min(len(t), a + chunk)
+        if b < len(t): # end the chunk on a period boundary so no period is split
+            boundary = math.floor((t[b] * scale + offset) / period) * period
+            b = int(np.searchsorted(t, raw(boundary), side='left'))
+            if b <= a: # one period holds more than a chunk
+                b = int(np.searchsorted(t, raw(boundary + period), side='left'))
+        first = int(np.searchsorted(t, raw(t[a] * scale + offset - lookback), side='left'))
+        ts = t[first:b].astype(np.float64) * scale + offset
+        xs = x[first:b].astype(np.float64)
+        sus = rollingMean(ts, xs, sustained)[a - first:]
+        g3 = rollingMean(ts, xs, gust)[a - first:]
+        ts, xs = ts[a - first:], xs[a - first:]
+        if temp is not None:
+            feels = derivedArrays(temp[a:b], xs)[1]
+
+        p = np.floor(ts / period)
+        starts = np.flatnonzero(np.concatenate(([True], p[1:] != p[:-1])))
+        count = np.diff(np.append(starts, len(ts)))
+        total = np.add.reduceat(xs, starts)
+        squares = np.add.reduceat(xs * xs, starts)
+        parts.append((p[starts] * period, count, total, squares, np.fmax.reduceat(sus, starts),
+            np.fmax.reduceat(g3, starts), np.fmin.reduceat(g3, starts)))
+        if temp is not None:
+            parts[-1] += (np.minimum.reduceat(feels, starts),)
+        a = b
+
+    if not parts:
+        cols = {name: np.empty(0) for name in names}
+    else:
+        cols = {name: np.concatenate([part[i] for part in parts]) for i, name in enumerate(names)}
+    mean = cols.pop("total") / np.maximum(cols["count"], 1)
+    sd = np.sqrt(np.maximum(0.0, cols.pop("squares") / np.maximum(cols["count"], 1) - mean * mean))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cols["mean"] = mean
+        cols["sd"] = sd
+        cols["turbulence"] = np.where(mean > 0, sd / mean, np.nan)
+        cols["gustFactor"] = np.where(mean > 0, cols["gust"] / mean, np.nan)
+    return cols
+
+# the records of a ringstore.sampleRing as numpy arrays (raw 1/10 sec times, mph, temp in 1/10 degree), no copy
+# unless it has wrapped
+def ringArrays(ring):
+    np = numpy()
+    parts = [np.frombuffer(view, dtype=ring.dtype) for view in ring.views()]
+    records = parts[0] if len(parts) == 1 else np.concatenate(parts)
+    return records['t'], records['mph'], records['temp']
+
+# periodStats over a sample ring file
+def ringStats(path, period=600.0, sustained=120.0, gust=3.0, since=None):
+    from .ringstore import sampleRing
+    np = numpy()
+    if not os.path.isfile(path): # sampleRing would make a new ring there
+        raise FileNotFoundError(f"no sample ring at {path}")
+    ring = sampleRing(path)
+    t = mph = temp = None
+    try:
+        t, mph, temp = ringArrays(ring)
+        if since is not None:
+            first = int(np.searchsorted(t, (since - ring.epoch) * 10))
+            t, mph, temp = t[first:], mph[first:], temp[first:]
+        return periodStats(t, mph, period, sustained, gust, scale=0.1, offset=ring.epoch, temp=temp / 10)
+    finally:
+        del t, mph, temp # the arrays are views of the map, they have to go before it's closed
+        ring.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="btwind.analytics", description="wind report figures from stored samples")
+    parser.add_argument('ring', help="a station's sample ring file, e.g. data/default.ring")
+    parser.add_argument('--period', type=float, default=600, help="seconds per report row, default 600")
+    parser.add_argument('--sustained', type=float, default=120, help="sustained wind averaging, default 120 sec")
+    parser.add_argument('--gust', type=float, default=3, help="gust averaging, default 3 sec")
+    parser.add_argument('--days', type=float, help="only the last DAYS days")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.days * 86400 if args.days else None
+    started = time.perf_counter()
+    try:
+        rows = ringStats(args.ring, args.period, args.sustained, args.gust, since)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    print(f"{'period start':<20} {'samples':>7} {'mean':>6} {'sust':>6} {'gust':>6} {'lull':>6} {'factor':>6} {'turb':>6} {'feels':>6}")
+    for i in range(len(rows["start"])):
+        print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(rows['start'][i])):<20} {rows['count'][i]:>7} "
+            f"{rows['mean'][i]:>6.1f} {rows['sustained'][i]:>6.1f} {rows['gust'][i]:>6.1f} {rows['lull'][i]:>6.1f} "
+            f"{rows['gustFactor'][i]:>6.2f} {rows['turbulence'][i]:>6.2f} {rows['feelsLo'][i]:>6.1f}")
+    print(f"{len(rows['start'])} periods in {time.perf_counter() - started:.2f} s", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,521 @@
+'''
+
+btwind benchmark suite
+
+Numbers for the whole receive pipeline, all of it driven by simulated stations
+(see simulator.py) so no hardware is needed:
+
+    framing    bytes and samples per second through the sampleStream, JSON,
+               binary and a damaged mixed stream, fed in socket sized chunks
+               and a byte at a time like the old recv loop
+    decode     json.loads against the sample decoders and the sampleBatch
+    latency    frame arrival to display refresh percentiles, through a TCP
+               link, the thread engine, latestSample and a 60 fps UI clock
+    reconnect  time from the station dropping the link to being connected again
+    idle       CPU per idle connection and memory per station for each engine
+    pulses     pulse mode against the simulator's true wind, light to hurricane
+               speeds: error of the pulse estimate and of the firmware's own
+               mph against the real 3 second mean, and samples per second
+               through the estimator (needs numpy, skipped without it)
+    mqtt       the outbox and MQTT sink against a stand-in broker client that
+               refuses publishes for a while: live publishes, the failed
+               batches and the replay once it accepts again, with any sample
+               that never reached it counted as lost
+
+    python3 -m btwind.bench --out today.json
+    python3 -m btwind.bench --quick --only framing,decode --compare today.json
+
+Results are a flat JSON dict of case.metric values plus a note of the machine
+they came from. --compare checks a run against an earlier results file and
+exits with status 1 if any metric got worse by more than the tolerance:
+metrics ending in PerSec are better higher, all others (times, CPU, bytes)
+are better lower.
+
+'''
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from .connection import connectionSupervisor
+from .display import latestSample
+from .framing import sampleStream
+from .samples import sample, sampleBatch
+from .simulator import station, tcpStation, startStations
+from .stations import stationHub
+from .registry import stationRegistry
+
+# value at fraction p of the sorted values
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+# the byte stream count updates of a simulated station make, damaged ones included
+def stationBytes(count, binary=False, seed=1, **kwargs):
+    sim = station(seed=seed, **kwargs)
+    if binary:
+        sim.receive(b'@B@')
+    return sim.ticks(count)
+
+def feedAll(data, chunk):
+    stream = sampleStream()
+    feed = stream.feed
+    t = time.perf_counter()
+    n = 0
+    for i in range(0, len(data), chunk):
+        n += len(feed(data[i:i + chunk]))
+    return time.perf_counter() - t, n
+
+def caseFraming(quick):
+    count = 20000 if quick else 200000
+    results = {}
+    streams = (
+        ("json", stationBytes(count)),
+        ("binary", stationBytes(count, binary=True)),
+        ("damaged", stationBytes(count, noise=0.02, dropout=0.02, corrupt=0.02)),
+    )
+    for name, data in streams:
+        seconds, n = feedAll(data, 4096)
+        results[name + "BytesPerSec"] = len(data) / seconds
+        results[name + "SamplesPerSec"] = n / seconds
+    data = streams[0][1][:len(streams[0][1]) // 20]
+    seconds, n = feedAll(data, 1)
+    results["jsonByteAtATimeBytesPerSec"] = len(data) / seconds
+    return results
+
+# the stream of count updates in pulse mode and the true mean wind over the 3 sec before each one
+def pulseBytes(count, mph, seed=1):
+    sim = station(mph=mph, gustiness=0.3, calm=0, seed=seed)
+    wind = sim.firmware.wind
+    step = wind.step
+    recent = []
+    def recorded(now, dt):
+        speed = step(now, dt)
+        recent.append((now + dt, speed * dt))
+        return speed
+    wind.step = recorded
+    sim.receive(b'@B@@P@')
+    chunks, truth = [], []
+    for i in range(count):
+        chunks.append(sim.ticks(1))
+        now = sim.firmware.millis
+        del recent[:-3000 // 100] # the steps of the last 3 sec
+        truth.append(sum(d for end, d in recent if end > now - 3000) / 3000)
+    return chunks, truth
+
+def casePulses(quick):
+    try:
+        from .pulses import pulseEstimator
+        pulseEstimator()
+    except ImportError:
+        print("pulses: numpy isn't installed, skipped", file=sys.stderr)
+        return {}
+    count = 300 if quick else 3000
+    results = {}
+    for mph in (5, 40, 150):
+        chunks, truth = pulseBytes(count, mph)
+        stream = sampleStream()
+        stream.pulses = pulseEstimator()
+        samples = []
+        t = time.perf_counter()
+        for data in chunks:
+            samples += stream.feed(data)
+        seconds = time.perf_counter() - t
+        pairs = list(zip(samples, truth))[10:] # once there are 3 sec of pulses
+        results[f"mph{mph}ErrorMph"] = sum(abs(m.speed - v) for m, v in pairs) / len(pairs)
+        results[f"mph{mph}FirmwareErrorMph"] = sum(abs(m.mph - v) for m, v in pairs) / len(pairs)
+        results[f"mph{mph}SamplesPerSec"] = len(samples) / seconds
+        results[f"mph{mph}PulsesPerSec"] = stream.pulses.pulses / seconds
+    return results
+
+# batch analytics over days of 1 Hz samples stored like the sample ring, and the streaming windows
+def caseAnalytics(quick):
+    from .analytics import periodStats, windWindow
+    try:
+        from .pulses import numpy
+        np = numpy()
+    except ImportError:
+        print("analytics: numpy isn't installed, skipped", file=sys.stderr)
+        return {}
+    days = 30 if quick else 365
+    count = days * 86400
+    rng = np.random.default_rng(1)
+    t = np.arange(count, dtype=np.uint32) * 10 # 1/10 sec like the ring
+    mph = np.clip(15 + np.cumsum(rng.normal(0, 0.3, count)) % 30 + rng.normal(0, 3, count), 0, 255).astype(np.uint8)
+    started = time.perf_counter()
+    rows = periodStats(t, mph, scale=0.1, offset=time.time() - count)
+    seconds = time.perf_counter() - started
+    assert len(rows["start"]) in (count // 600, count // 600 + 1)
+
+    window = windWindow()
+    values = mph[:100000].tolist()
+    started = time.perf_counter()
+    for i, v in enumerate(values):
+        window.add(float(i), v)
+    stream = time.perf_counter() - started
+    return {"batchSamplesPerSec": count / seconds, "yearSeconds": seconds * 365 / days,
+        "streamSamplesPerSec": len(values) / stream}
+
+def caseDecode(quick):
+    count = 100000 if quick else 1000000
+    distinct = [sample(i % 60, (i * 7) % 80, 40 + (i % 500) / 10, seq=i) for i in range(1000)]
+    jsonFrames = [distinct[i % 1000].toJson() for i in range(count)]
+    binaryFrames = [distinct[i % 1000].toFrame() for i in range(count)]
+
+    def batch(frames):
+        b = sampleBatch()
+        append = b.appendFrame
+        now, mono = time.time(), time.monotonic()
+        for f in frames:
+            append(f, now, mono)
+        return b
+
+    decoders = (
+        ("jsonLoads", lambda frames: [json.loads(f) for f in frames], jsonFrames),
+        ("sampleFromJson", lambda frames: [sample.fromJson(f) for f in frames], jsonFrames),
+        ("sampleFromFrame", lambda frames: [sample.fromFrame(f) for f in frames], binaryFrames),
+        ("batchFromFrame", batch, binaryFrames),
+    )
+    results = {}
+    for name, decode, frames in decoders:
+        t = time.perf_counter()
+        decode(frames)
+        results[name + "PerSec"] = count / (time.perf_counter() - t)
+    return results
+
+# Stands in for Kivy's Clock: callbacks scheduled with a delay run on the first frame after it
+class uiClock(threading.Thread):
+    def __init__(self, fps=60):
+        super(uiClock, self).__init__()
+        self._stop_event = threading.Event()
+        self.daemon = True
+        self.frame = 1 / fps
+        self.lock = threading.Lock()
+        self.due = [] # heap of (time, n, callback)
+        self.n = 0
+
+    def schedule(self, callback, delay):
+        with self.lock:
+            self.n += 1
+            heapq.heappush(self.due, (time.monotonic() + delay, self.n, callback))
+
+    def run(self):
+        next = time.monotonic()
+        while not self.stopped():
+            next += self.frame
+            time.sleep(max(0.0, next - time.monotonic()))
+            now = time.monotonic()
+            while 1:
+                with self.lock:
+                    if not self.due or self.due[0][0] > now:
+                        break
+                    callback = heapq.heappop(self.due)[2]
+                callback()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+def caseLatency(quick):
+    seconds = 3 if quick else 10
+    sim = station("bench", seed=1)
+    sent = {} # seq: time the simulator wrote it
+    ticks = sim.ticks
+    def timedTicks(n):
+        first = sim.firmware.seq
+        data = ticks(n)
+        now = time.monotonic()
+        for i in range(n):
+            sent[(first + i) & 0xFFFF] = now
+        return data
+    sim.ticks = timedTicks
+    server = tcpStation(sim, rate=50)
+    server.start()
+    clock = uiClock()
+    clock.start()
+    latest = latestSample(0)
+    arrival, wire = [], []
+
+    def refresh():
+        m = latest.take()
+        if m is None:
+            return
+        now = time.monotonic()
+        arrival.append(now - m.received)
+        if m.seq in sent:
+            wire.append(now - sent[m.seq])
+
+    def onSample(m):
+        delay = latest.put(m)
+        if delay is not None:
+            clock.schedule(refresh, delay)
+
+    watcher = connectionSupervisor("bench", server.address, onSample=onSample)
+    watcher.start()
+    time.sleep(seconds)
+    watcher.stop()
+    watcher.join()
+    server.stop()
+    clock.stop()
+    results = {}
+    for name, values in (("arrivalToUi", arrival), ("wireToUi", wire)):
+        for p in (50, 95, 99):
+            results[f"{name}P{p}Ms"] = percentile(values, p / 100) * 1000
+    results["refreshesPerSec"] = len(arrival) / seconds
+    return results
+
+def caseReconnect(quick):
+    drops = 5 if quick else 20
+    results = {}
+    for engine in ('thread', 'asyncio'):
+        server = tcpStation(station("bench", seed=1), rate=20)
+        server.start()
+        up = threading.Event()
+        times = []
+        def onState(*args): # (station, up) from the thread engine, (up) from the asyncio one
+            if args[-1]:
+                up.set()
+        stop = startEngine(engine, server.address, onState)
+        if up.wait(5):
+            for i in range(drops):
+                time.sleep(0.2)
+                up.clear()
+                t = time.monotonic()
+                server.hangup()
+                if not up.wait(5):
+                    break
+                times.append(time.monotonic() - t)
+        stop()
+        server.stop()
+        results[engine + "P50Ms"] = percentile(times, 0.5) * 1000
+        results[engine + "MaxMs"] = max(times, default=0.0) * 1000
+    return results
+
+# What the MQTT sink needs of a paho client, messages are kept instead of sent and publishes fail while down
+class standInBroker:
+    def __init__(self, **kwargs):
+        self.on_connect = self.on_disconnect = None
+        self.down = False
+        self.messages = [] # (topic, payload) in the order accepted
+
+    def reconnect_delay_set(self, *args):
+        pass
+
+    def connect_async(self, *args):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if self.down:
+            return published(4) # MQTT_ERR_NO_CONN
+        self.messages.append((topic, payload))
+        return published(0)
+
+class published:
+    def __init__(self, rc):
+        self.rc = rc
+
+def caseMqtt(quick):
+    from .mqttsink import mqttSink
+    from .outbox import outbox
+    from .supervisor import backoff
+    count = 2000 if quick else 20000
+    sink = mqttSink(topics={"seq": "bench/seq"}, clientFactory=standInBroker)
+    broker = sink.client
+    with tempfile.TemporaryDirectory() as path:
+        box = outbox(path, sink, replayRate=count)
+        box.backoff = backoff(0.01, 0.05) # probe the broker again quickly
+        sink.start()
+        box.start()
+        for i in range(count):
+            box.put(sample(10, 12, 20.0, seq=i, station="bench"))
+            if i == count // 4:
+                broker.down = True # publishes fail from here, the outbox keeps the records
+            elif i == count // 2:
+                broker.down = False
+                back = time.perf_counter()
+        while box.backlog() and time.perf_counter() - back < 30:
+            time.sleep(0.01)
+        caughtUp = time.perf_counter() - back
+        box.stop()
+        box.join()
+        sink.stop()
+        sink.join()
+    seen = {int(payload) for topic, payload in broker.messages}
+    return {"catchUpMs": caughtUp * 1000, "replayedPerSec": box.replayed / caughtUp,
+        "lost": count - len(seen & set(range(count)))}
+
+# runs one station link with either engine, returns a function that stops it
+def startEngine(engine, address, onState):
+    if engine == 'thread':
+        watcher = connectionSupervisor("bench", address, onState=onState, base=0.1)
+        watcher.start()
+        def stop():
+            watcher.stop()
+            watcher.join()
+        return stop
+    from .aioengine import stationEngine
+    from .transports import transportFor
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(stationEngine(transportFor(address), onState=onState, base=0.1).run())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        time.sleep(0.2) # let the cancellation run before the loop stops
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return stop
+
+# Child process, simulated stations that send once when a receiver connects and then stay quiet
+def serveStations(count, rate, ports):
+    for server in startStations(count, rate, seed=1):
+        ports.put(server.port)
+    threading.Event().wait()
+
+def caseIdle(quick):
+    count = 10 if quick else 40
+    seconds = 3 if quick else 10
+    ports = multiprocessing.Queue()
+    child = multiprocessing.Process(target=serveStations, args=(count, 1e-6, ports), daemon=True)
+    child.start()
+    addresses = [f"127.0.0.1:{ports.get(timeout=10)}" for i in range(count)]
+    results = {}
+    try:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        watchers = [connectionSupervisor(f"s{i}", a) for i, a in enumerate(addresses)]
+        for w in watchers:
+            w.start()
+        time.sleep(1)
+        results["threadMemPerStationBytes"] = (tracemalloc.get_traced_memory()[0] - base) / count
+        tracemalloc.stop()
+        cpu = time.process_time()
+        time.sleep(seconds)
+        results["threadCpuPerConnPct"] = 100 * (time.process_time() - cpu) / seconds / count
+        for w in watchers:
+            w.stop()
+        for w in watchers:
+            w.join()
+
+        tmp = tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False)
+        tmp.write("[Stations]\n" + "".join(f"s{i} = {a}\n" for i, a in enumerate(addresses)))
+        tmp.close()
+        async def main():
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            hub = stationHub(stationRegistry(tmp.name))
+            task = asyncio.ensure_future(hub.run())
+            await asyncio.sleep(1)
+            results["asyncioMemPerStationBytes"] = (tracemalloc.get_traced_memory()[0] - base) / count
+            tracemalloc.stop()
+            cpu = time.process_time()
+            await asyncio.sleep(seconds)
+            results["asyncioCpuPerConnPct"] = 100 * (time.process_time() - cpu) / seconds / count
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(main())
+        os.unlink(tmp.name)
+    finally:
+        child.terminate()
+    return results
+
+cases = {
+    "framing": caseFraming,
+    "decode": caseDecode,
+    "latency": caseLatency,
+    "reconnect": caseReconnect,
+    "idle": caseIdle,
+    "pulses": casePulses,
+    "analytics": caseAnalytics,
+    "mqtt": caseMqtt,
+}
+
+def higherIsBetter(metric):
+    return metric.endswith("PerSec")
+
+# metrics that got worse than tolerance (a fraction) against the old results, as (metric, old, new, change)
+def regressions(old, new, tolerance):
+    worse = []
+    for metric, value in new.items():
+        before = old.get(metric)
+        if not before:
+            continue
+        change = (value - before) / before
+        if (-change if higherIsBetter(metric) else change) > tolerance:
+            worse.append((metric, before, value, change))
+    return worse
+
+def machine():
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="btwind.bench", description="btwind receive pipeline benchmarks")
+    parser.add_argument('--only', help="comma separated cases, default all of: " + ", ".join(cases))
+    parser.add_argument('--quick', action='store_true', help="smaller runs, for a fast check")
+    parser.add_argument('--out', metavar='FILE', help="write the results as json")
+    parser.add_argument('--compare', metavar='FILE', help="results file from an earlier run to check against")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="allowed change before a regression, default 0.10")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    parser.add_argument('--log-level', default='CRITICAL', help="receiver logging, links are dropped on purpose")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s - %(message)s')
+
+    names = args.only.split(',') if args.only else list(cases)
+    results = {}
+    for name in names:
+        if name not in cases:
+            parser.error(f"unknown case {name}")
+        if not args.json:
+            print(f"{name} ...", file=sys.stderr, flush=True)
+        for metric, value in cases[name](args.quick).items():
+            results[f"{name}.{metric}"] = value
+    report = {"machine": machine(), "quick": args.quick, "results": results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)["results"]
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'metric':<42} {'value':>14} {'before':>14} {'change':>8}")
+        for metric, value in results.items():
+            if metric in old:
+                change = (value - old[metric]) / old[metric] if old[metric] else 0.0
+                print(f"{metric:<42} {value:>14,.3f} {old[metric]:>14,.3f} {change:>+8.1%}")
+            else:
+                print(f"{metric:<42} {value:>14,.3f}")
+    worse = regressions(old, results, args.tolerance)
+    for metric, before, value, change in worse:
+        print(f"REGRESSION {metric}: {before:,.3f} -> {value:,.3f} ({change:+.1%})", file=sys.stderr)
+    return 1 if worse else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
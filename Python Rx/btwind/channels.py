@@ -0,0 +1,187 @@
+'''
+
+btwind channels
+
+Bounded hand-offs between the receive path and the things it feeds, so memory
+stays flat however slow a consumer gets. Each kind has an explicit policy for
+when it is full and counts what that policy did:
+
+    latest value wins   the display, see display.latestSample: one slot, a
+                        newer sample replaces the one waiting (skipped)
+    bounded             lossless FIFO for the sinks: put() waits for room, so
+                        a slow disk or broker holds up the reader (and through
+                        it the link's own flow control) instead of dropping or
+                        piling up samples in memory (blocked, blockedMs)
+    priority            commands for a station: more urgent ones go out first,
+                        FIFO within a level, drained in one batch per write;
+                        when full the oldest of the least urgent is dropped
+                        (dropped)
+
+sinkQueue runs sinks on their own thread behind a bounded channel, the
+receiver puts storage and the outbox behind one ([General] sinkqueue, 0 for
+the old inline calls) and merges backfilled samples into storage on another,
+so a backfill burst never queues up in front of live samples.
+
+'''
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# command priorities, lower goes first
+urgent = 0
+normal = 1
+bulk = 2
+
+class closed(Exception):
+    pass
+
+# Lossless FIFO, put() waits while it's full
+class bounded:
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        self.isClosed = False
+        self.puts = 0
+        self.maxDepth = 0
+        self.blocked = 0   # puts that had to wait for room
+        self.blockedTime = 0.0
+
+    # add an item, waiting up to timeout sec for room (None = as long as it takes), False if there was none
+    def put(self, item, timeout=None):
+        with self.lock:
+            if len(self.items) >= self.maxsize and not self.isClosed:
+                if timeout == 0:
+                    return False
+                self.blocked += 1
+                started = time.monotonic()
+                self.notFull.wait_for(lambda: len(self.items) < self.maxsize or self.isClosed, timeout)
+                self.blockedTime += time.monotonic() - started
+            if self.isClosed:
+                raise closed()
+            if len(self.items) >= self.maxsize:
+                return False
+            self.items.append(item)
+            self.puts += 1
+            self.maxDepth = max(self.maxDepth, len(self.items))
+            self.notEmpty.notify()
+            return True
+
+    # add an item if there's room, never waits
+    def putNowait(self, item):
+        return self.put(item, 0)
+
+    # up to limit items, oldest first, waiting up to timeout sec for the first one. Empty on timeout or once
+    # closed and drained
+    def getBatch(self, limit=None, timeout=None):
+        with self.lock:
+            self.notEmpty.wait_for(lambda: self.items or self.isClosed, timeout)
+            n = len(self.items) if limit is None else min(limit, len(self.items))
+            batch = [self.items.popleft() for _ in range(n)]
+            if batch:
+                self.notFull.notify_all()
+            return batch
+
+    # no more puts, getters drain what is left
+    def close(self):
+        with self.lock:
+            self.isClosed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        with self.lock:
+            return {"depth": len(self.items), "capacity": self.maxsize, "maxDepth": self.maxDepth, "puts": self.puts,
+                "blocked": self.blocked, "blockedMs": self.blockedTime * 1000}
+
+# Commands by priority, never waits, when full the oldest of the least urgent queued goes
+class priority:
+    def __init__(self, maxsize=64, levels=3):
+        self.maxsize = maxsize
+        self.levels = [collections.deque() for _ in range(levels)]
+        self.lock = threading.Lock()
+        self.notify = None # called after every put, an asyncio engine uses it to wake its sender
+        self.puts = 0
+        self.dropped = 0
+
+    # queue an item, False if it was dropped because everything queued is more urgent
+    def put(self, item, level=normal):
+        level = min(max(level, 0), len(self.levels) - 1)
+        with self.lock:
+            if sum(len(q) for q in self.levels) >= self.maxsize:
+                least = max(i for i, q in enumerate(self.levels) if q)
+                self.dropped += 1
+                if least < level:
+                    log.warning("Command queue full, dropped %r", item)
+                    return False
+                log.warning("Command queue full, dropped %r", self.levels[least].popleft())
+            self.levels[level].append(item)
+            self.puts += 1
+        if self.notify:
+            self.notify()
+        return True
+
+    # everything queued, most urgent first
+    def getBatch(self):
+        with self.lock:
+            batch = []
+            for q in self.levels:
+                batch.extend(q)
+                q.clear()
+            return batch
+
+    def __len__(self):
+        return sum(len(q) for q in self.levels)
+
+    def stats(self):
+        return {"commandsQueued": len(self), "commandsDropped": self.dropped}
+
+# Runs sinks on a thread of their own behind a bounded channel
+class sinkQueue(threading.Thread):
+    def __init__(self, sinks, maxsize=1000, batch=100, name="sinks"):
+        super(sinkQueue, self).__init__(name=name)
+        self.daemon = True
+        self.sinks = list(sinks)
+        self.batch = batch
+        self.channel = bounded(maxsize)
+        self.failures = 0
+
+    # the sink for the thread engine, waits while the queue is full
+    def put(self, m):
+        self.channel.put(m)
+
+    # the sink for the asyncio engine, waits for room off the event loop so the loop keeps running
+    async def putAsync(self, m):
+        if not self.channel.putNowait(m):
+            await asyncio.get_running_loop().run_in_executor(None, self.channel.put, m)
+
+    def run(self):
+        while 1:
+            batch = self.channel.getBatch(self.batch)
+            if not batch:
+                break # closed and drained
+            for m in batch:
+                for sink in self.sinks:
+                    try:
+                        sink(m)
+                    except Exception: # one bad sample or sink must not stop the others for good
+                        self.failures += 1
+                        log.exception("Sink %r failed", sink)
+
+    # finish what is queued, then exit
+    def stop(self):
+        self.channel.close()
+
+    def stats(self):
+        stats = self.channel.stats()
+        stats["failures"] = self.failures
+        return stats
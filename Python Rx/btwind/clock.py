@@ -0,0 +1,142 @@
+'''
+
+btwind clocks
+
+Samples are stamped once, where their frame is completed: sampleStream reads
+host.now() after every chunk of bytes that finished a frame, so every sample
+has a monotonic receive time (for ordering, intervals and latency) and a wall
+clock time. The wall clock time is the monotonic one plus a single offset for
+the whole receiver, so every station is on the same timeline and a step of the
+system clock can't reorder samples. The offset is taken again (and logged) if
+the system clock moves more than a second away from it.
+
+Firmware that sends its millis() with each sample (and every backfill frame)
+lets the receiver do better than the receive time, which carries however long
+the frame sat in the shield, the radio and the socket. deviceClock fits host
+time = device time + offset + drift * device time online:
+
+    a frame can arrive late but never early, so the lowest host - device
+    difference in each 10 seconds of device time is the best point in it
+    a least squares line through the last 60 of those points gives the offset
+    and the drift (an Arduino's ceramic resonator can be 0.5% out, 18 seconds
+    an hour, and moves with temperature)
+    millis() wrapping every 49 days is unwrapped, a station restart (its
+    millis() going backwards) starts the fit over
+
+Each frame costs one comparison, the fit runs once per window over 60 points.
+The sample's time is then when the station took it rather than when it got
+here, the same for storage, rollups and every station. How far the receive
+time is behind that is the latency, the delay over the quickest frame seen.
+
+'''
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+wrap = 1 << 32 # millis() wraps here
+half = 1 << 31
+
+# The receiver's clock, monotonic times and wall clock times on one timeline
+class hostClock:
+    def __init__(self, step=1.0):
+        self.step = step # seconds the system clock can move before the offset is taken again
+        self.offset = time.time() - time.monotonic()
+        self.steps = 0
+
+    # (wall clock time, monotonic time) now
+    def now(self):
+        mono = time.monotonic()
+        wall = time.time()
+        if abs(wall - mono - self.offset) > self.step:
+            log.warning("The system clock moved %.1f s, sample times follow it from here", wall - mono - self.offset)
+            self.offset = wall - mono
+            self.steps += 1
+        return mono + self.offset, mono
+
+    # wall clock time of a monotonic time
+    def wall(self, mono):
+        return mono + self.offset
+
+host = hostClock() # shared, so samples from every station line up
+
+# Device millis() to host monotonic time, offset and drift fitted online from (millis(), receive time) pairs
+class deviceClock:
+    def __init__(self, window=10.0, windows=60):
+        self.window = window # seconds of device time per lowest point
+        self.points = collections.deque(maxlen=windows) # (device sec, host - device) lowest of each closed window
+        self.best = None        # lowest point of the open window
+        self.windowStart = None # device time the open window started
+        self.raw = None         # last millis() observed
+        self.device = 0.0       # it in seconds, unwrapped
+        self.anchor = 0.0       # device time the fit is centred on
+        self.offset = None      # host - device at the anchor, None until the first observation
+        self.skew = 0.0         # drift, host seconds per device second - 1
+
+        # counters
+        self.observations = 0
+        self.restarts = 0
+
+    # millis() as seconds on the unwrapped timeline, relative to the last one observed
+    def unwrap(self, ms):
+        return self.device + (((ms - self.raw + half) % wrap) - half) / 1000
+
+    # a frame with millis() ms from the station, completed at monotonic time received
+    def observe(self, ms, received):
+        if self.raw is None:
+            d = ms / 1000
+        else:
+            step = ((ms - self.raw + half) % wrap) - half
+            if step < -1000: # the station restarted
+                self.restarts += 1
+                self.points.clear()
+                self.best = self.windowStart = self.offset = None
+                self.skew = 0.0
+                d = ms / 1000
+            else:
+                d = self.device + step / 1000
+        self.raw, self.device = ms, d
+        self.observations += 1
+        if self.windowStart is None:
+            self.windowStart = d
+        elif d - self.windowStart >= self.window:
+            self.points.append(self.best)
+            self.best = None
+            self.windowStart = d
+            self.fit()
+        y = received - d
+        if self.best is None or y < self.best[1]:
+            self.best = (d, y)
+            if not self.points: # no window closed yet, go by the best so far
+                self.anchor, self.offset = self.best
+
+    # least squares line through the lowest points, one pass, relative to the newest so the sums stay small
+    def fit(self):
+        n = len(self.points)
+        x0, y0 = self.points[-1]
+        sx = sy = sxx = sxy = 0.0
+        for x, y in self.points:
+            x -= x0
+            y -= y0
+            sx += x
+            sy += y
+            sxx += x * x
+            sxy += x * y
+        xm, ym = sx / n, sy / n
+        if sxx - sx * xm > 0:
+            self.skew = (sxy - sx * ym) / (sxx - sx * xm)
+        self.anchor, self.offset = x0 + xm, y0 + ym
+
+    # host monotonic time of a device millis() near the ones observed, None before the first observation
+    def toHost(self, ms):
+        if self.offset is None:
+            return None
+        d = self.unwrap(ms)
+        return d + self.offset + self.skew * (d - self.anchor)
+
+    def stats(self):
+        if self.offset is None:
+            return {}
+        return {"clockOffset": self.offset + self.skew * (self.device - self.anchor), "clockDriftPpm": self.skew * 1e6,
+            "clockRestarts": self.restarts}
@@ -0,0 +1,33 @@
+'''
+
+btwind settings
+
+All receiver settings live in btwindrx.ini. These are the defaults for every
+section the core reads, the Kivy apps pass them to build_config and headless
+runs get them from load().
+
+'''
+import configparser
+
+defaults = {
+    "General": {"address": "00:18:E4:0C:68:00", "update": "1", "connection": "1", "lights": "1",
+        "retrymax": "60", "retries": "0", "engine": "thread", "station": "", "protocol": "binary",
+        "record": "", "cadence": "1", "sinkqueue": "1000", "backfill": "1"},
+    "Stations": {},
+    "Storage": {"enabled": "1", "path": "data", "days": "14"},
+    "MQTT": {"enabled": "0", "broker": "localhost", "port": "1883", "clientid": "btwindrx", "qos": "1",
+        "retain": "0", "interval": "5", "topic_temp": "JHome/Backyard/Temperature", "topic_mph": "JHome/Backyard/Wind"},
+    "Outbox": {"enabled": "1", "path": "outbox", "maxmb": "50", "batch": "200", "replayrate": "100"},
+    "Metrics": {"enabled": "0", "host": "127.0.0.1", "port": "9108"},
+    "Analytics": {"enabled": "1", "period": "600", "sustained": "120", "gust": "3"},
+    "Pulses": {"enabled": "0", "calibration": "0:0, 1:10", "smooth": "3", "gust": "3"},
+    "Logging": {"level": "INFO", "file": "", "format": "text", "maxkb": "1024", "backups": "5", "ring": "500",
+        "ringlevel": "", "dumps": "logs"},
+}
+
+# read the settings file on top of the defaults
+def load(path="btwindrx.ini"):
+    config = configparser.ConfigParser()
+    config.read_dict(defaults)
+    config.read(path)
+    return config
@@ -0,0 +1,168 @@
+'''
+
+btwind connection thread
+
+The thread engine: a connectionSupervisor (see supervisor.py) keeps one
+connectionThread running for a station, over whichever transport the station
+address names (see transports.py). The connection thread reads datagrams
+with the select driven frameReader, hands every sample to the sinks and then to
+onSample, and sends queued commands. With a backfill callback it asks the
+station for the samples it kept while the link was down and passes them on as
+they arrive, in lists (see framing.py). Callbacks run on the connection thread,
+a GUI has to move them to its own thread. With a record path the raw bytes
+are also written to a replay file.
+
+'''
+import logging
+import threading
+import time
+
+from .channels import priority, normal, bulk
+from .framing import frameReader, sampleStream
+from .linkhealth import linkHealth
+from .protocol import connectCmd, backfillCmd
+from .supervisor import linkSupervisor
+from .transports import transportFor, recorder
+
+log = logging.getLogger(__name__)
+
+# Keeps a connection to one station running, restarting it with a backoff when it exits
+class connectionSupervisor(linkSupervisor):
+    def __init__(self, station, address, onSample=None, onState=None, sinks=(), protocol="binary", record="", cadence=1.0,
+            pulses=None, backfill=None, **kwargs):
+        super(connectionSupervisor, self).__init__(**kwargs)
+        self.station = station
+        self.address = address
+        self.protocol = protocol # datagram format asked for on connect, binary or json
+        self.onSample = onSample # called with each sample (samples.sample), sample.station holds the station name
+        self.onState = onState # called with (station name, True/False) when the link goes up or down
+        self.sinks = list(sinks)
+        self.backfill = backfill # called with lists of samples the station kept while the link was down
+        self.commands = priority() # commands waiting to be sent to the station, bounded, most urgent first
+        self.health = linkHealth(station, cadence) # arrival timing, rates and reconnects
+        self.stream = sampleStream(health=self.health) # framing, decoding and link quality counters, kept across connections
+        if pulses:
+            self.stream.pulses = pulses() # pulse mode, the receiver works out the speed from the pulse times
+        self.stream.backfilling = backfill is not None
+        self.recorder = recorder(record.format(station=station)) if record else None # replay file of everything received
+        if self.recorder:
+            self.stream.tap = self.recorder.write
+
+    def makeConnection(self):
+        return connectionThread(self)
+
+    def run(self):
+        try:
+            super(connectionSupervisor, self).run()
+        finally:
+            if self.recorder:
+                self.recorder.close()
+
+    def send(self, cmd, level=normal):
+        self.commands.put(cmd, level)
+
+    # a sink or onSample that raises is logged and the sample goes on to the rest, the link stays up
+    def dispatch(self, m):
+        m.station = self.station
+        for sink in self.sinks: # storage etc, done here so a GUI thread never waits on it
+            try:
+                sink(m)
+            except Exception:
+                log.exception("A sink failed on a sample from %s", self.station)
+        if self.onSample:
+            try:
+                self.onSample(m)
+            except Exception:
+                log.exception("onSample failed on a sample from %s", self.station)
+
+    def dispatchBackfill(self, samples):
+        for m in samples:
+            m.station = self.station
+        try:
+            self.backfill(samples)
+        except Exception:
+            log.exception("Backfill from %s failed", self.station)
+
+    def state(self, up):
+        if up:
+            self.health.up()
+        else:
+            self.health.down()
+        if self.onState:
+            self.onState(self.station, up)
+
+    def stats(self):
+        stats = super(connectionSupervisor, self).stats()
+        stats.update(self.commands.stats())
+        stats.update(self.stream.stats())
+        stats.update(self.health.stats())
+        return stats
+
+# This is always run in a separate non-daemon thread, it connects and stays alive
+# as long as the connection within it stays alive. When an established connection dies,
+# or a connect fails the thread dies and the supervisor starts a new one after a backoff.
+class connectionThread(threading.Thread):
+    def __init__(self, p):
+        super(connectionThread, self).__init__()
+        self._stop_event = threading.Event()
+        self.daemon = False
+        self.p = p
+        self.wasUp = False # set once the link is established, the supervisor uses it to reset the backoff
+
+    def run(self):
+        try:
+            self.connect()
+        finally:
+            if self.wasUp:
+                self.p.state(False)
+            self.p.linkDown() # wake the supervisor so it can start a new connection
+
+    def connect(self):
+        address = self.p.address
+        log.info("Attempting connection with %s", address)
+        try:
+            sock = transportFor(address).open()
+        except (OSError, ValueError) as e:
+            log.error("Failed to establish connection with %s: %s", address, e)
+            return # no connection, the supervisor will start a new one after a backoff
+        log.info("Successfully connected with %s", address)
+        self.wasUp = True
+        self.p.linkUp()
+        self.p.state(True)
+        try:
+            sock.send(connectCmd(self.p.protocol, self.p.stream.pulses is not None).encode()) # old firmware ignores it and sends json
+        except OSError as e:
+            log.error("The connection with %s was lost: %s", address, e)
+            sock.close()
+            return
+        sock.settimeout(0) # non-blocking, the reader only calls recv once select says there is data
+        self.p.stream.reset()
+        if self.p.backfill:
+            self.p.send(backfillCmd(self.p.stream.resume), bulk) # what the station kept while we were away
+        reader = frameReader(sock, frames=self.p.stream)
+        checked = time.monotonic()
+        while not self.stopped():
+            try:
+                samples = reader.read(0.25) # blocks in select for up to 1/4 sec, returns every sample completed
+                for m in samples: # damaged frames were already skipped and counted, they never end the connection
+                    self.p.dispatch(m)
+                backfilled = self.p.stream.takeBackfill()
+                if backfilled:
+                    self.p.dispatchBackfill(backfilled)
+                commands = self.p.commands.getBatch() # everything queued since the last pass goes out in one send
+                if commands:
+                    sock.send("".join(commands).encode())
+                if time.monotonic() - checked >= 1: # a stalled link has no frames to notice it by
+                    checked = time.monotonic()
+                    self.p.health.check()
+            except OSError as e: # loss of connection
+                log.error("The connection with %s was lost: %s", address, e)
+                break
+        log.info("Connection thread is exiting")
+        sock.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
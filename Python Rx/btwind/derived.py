@@ -0,0 +1,53 @@
+'''
+
+btwind derived values
+
+Values worked out from a sample's own fields, once, on the receive path:
+sampleStream calls derive() on every sample after decoding (and after pulse
+mode has filled in its speed), so the sinks, rollups, metrics and the apps all
+read the same numbers off the sample instead of each working them out again
+from the display strings.
+
+    windchill   the NWS wind chill (2001) in degrees F,
+                35.74 + 0.6215 T - 35.75 V^0.16 + 0.4275 T V^0.16
+                only defined at 50 F or below with the wind at 3 mph or more,
+                None otherwise
+    feelslike   the wind chill where there is one, otherwise the temperature
+                (the station has no humidity sensor for a heat index)
+
+The wind is the pulse mode speed when there is one, otherwise mph. The same
+formulas over numpy arrays (derivedArrays) give the values for stored history,
+see analytics.periodStats.
+
+'''
+from .pulses import numpy
+
+chillMaxTemp = 50.0 # degrees F, the wind chill is only defined at or below this
+chillMinWind = 3.0  # mph, and at or above this
+
+def windChill(temp, mph):
+    if temp > chillMaxTemp or mph < chillMinWind:
+        return None
+    v = mph ** 0.16
+    return 35.74 + 0.6215 * temp - 35.75 * v + 0.4275 * temp * v
+
+def feelsLike(temp, mph):
+    chill = windChill(temp, mph)
+    return temp if chill is None else chill
+
+# fill in the derived fields of a sample
+def derive(m):
+    mph = m.mph if m.speed is None else m.speed
+    m.windchill = windChill(m.temp, mph)
+    m.feelslike = m.temp if m.windchill is None else m.windchill
+    return m
+
+# windchill (nan where it isn't defined) and feelslike for arrays of temperatures and wind speeds
+def derivedArrays(temp, mph):
+    np = numpy()
+    temp = np.asarray(temp, dtype=np.float64)
+    mph = np.asarray(mph, dtype=np.float64)
+    v = mph ** 0.16
+    defined = (temp <= chillMaxTemp) & (mph >= chillMinWind)
+    chill = np.where(defined, 35.74 + 0.6215 * temp - 35.75 * v + 0.4275 * temp * v, np.nan)
+    return chill, np.where(defined, chill, temp)
@@ -0,0 +1,97 @@
+'''
+
+btwind display refresh
+
+Receive threads can deliver samples much faster than a screen needs them, a
+burst after a reconnect for example. latestSample sits between the receiver and
+a GUI: put() keeps only the newest sample and tells the caller when a refresh
+has to be scheduled, take() hands the GUI the newest sample once per refresh.
+Samples replaced before they were shown are counted as skipped, and the time
+from a sample's arrival to its refresh is kept as the update latency.
+
+labelCache does for the GUI what mphLast / gustLast do in the firmware, a label
+is only written when its text actually changed.
+
+'''
+import threading
+import time
+
+# Newest sample waiting for the display, thread safe
+class latestSample:
+    def __init__(self, interval=0):
+        self.interval = interval # minimum seconds between refreshes, 0 = every frame
+        self.lock = threading.Lock()
+        self.sample = None
+        self.arrived = 0.0
+        self.pending = False # a refresh has been scheduled and hasn't run yet
+        self.lastRefresh = 0.0
+        self.received = 0  # samples put
+        self.skipped = 0   # samples replaced by a newer one before they were shown
+        self.refreshes = 0 # refreshes that showed a sample
+        self.latency = 0.0 # seconds from arrival to refresh for the last sample shown
+        self.latencyMax = 0.0
+        self.latencyTotal = 0.0
+
+    # store a sample, returns the delay in sec to schedule a refresh with, or None if one is already scheduled
+    def put(self, m):
+        now = time.monotonic()
+        with self.lock:
+            self.received += 1
+            if self.sample is not None:
+                self.skipped += 1
+            self.sample = m
+            self.arrived = now
+            if self.pending:
+                return None
+            self.pending = True
+            return max(0.0, self.lastRefresh + self.interval - now)
+
+    # the newest sample for a refresh, None if there's nothing new
+    def take(self):
+        now = time.monotonic()
+        with self.lock:
+            self.pending = False
+            m, self.sample = self.sample, None
+            if m is None:
+                return None
+            self.lastRefresh = now
+            self.refreshes += 1
+            self.latency = now - self.arrived
+            self.latencyMax = max(self.latencyMax, self.latency)
+            self.latencyTotal += self.latency
+            return m
+
+    # drop whatever is waiting, used when the link goes down so an old sample isn't shown afterwards
+    def clear(self):
+        with self.lock:
+            self.sample = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "received": self.received,
+                "refreshes": self.refreshes,
+                "skipped": self.skipped,
+                "latencyMs": self.latency * 1000,
+                "latencyMaxMs": self.latencyMax * 1000,
+                "latencyAvgMs": self.latencyTotal / self.refreshes * 1000 if self.refreshes else 0.0,
+            }
+
+# Writes label text only when it changed, counts the writes it saved
+class labelCache:
+    def __init__(self):
+        self.last = {}
+        self.writes = 0
+        self.unchanged = 0
+
+    def set(self, label, text):
+        if self.last.get(id(label)) == text:
+            self.unchanged += 1
+            return False
+        self.last[id(label)] = text
+        label.text = text
+        self.writes += 1
+        return True
+
+    def stats(self):
+        return {"labelWrites": self.writes, "labelUnchanged": self.unchanged}
@@ -0,0 +1,280 @@
+'''
+
+btwind datagram framing
+
+Pulls complete datagrams out of the byte stream sent by the btwind arduino,
+either {...} JSON text or length prefixed, crc checked binary frames (see
+protocol.py), both can turn up on the same link. The frameBuffer is pure (no
+sockets) so it can be fed from any source, the frameReader drives it from a
+socket using select so an idle link costs nothing but a wakeup every timeout.
+
+Damage never costs the connection. Bytes that can't belong to a frame are
+skipped up to the next frame start (a resync): noise between frames, a JSON
+frame that runs into another { or a sync byte before its closing brace, a
+binary frame with a bad crc. The sampleStream on top decodes frames into
+samples, drops ones that don't decode (corrupt) and uses the station's
+sequence numbers to count lost frames (gaps) and repeated ones (duplicates).
+A number far from the last one (a restarted station, or a garbled digit in a
+JSON datagram, which has no crc) is taken as the new starting point and
+counted as a jump, so one bad number can't hide the samples after it.
+Every one of these is counted so link quality shows up in stats().
+In pulse mode the pulse frames go to a pulses.pulseEstimator, which fills in
+the speed estimates on each sample after them. Then every sample gets its
+derived values (derived.py).
+
+Backfill frames, the samples the station kept while the link was down, are
+decoded into a list of their own for the engine to pick up with
+takeBackfill(), they never go through the sequence checks of the live ones.
+resume is the last seq seen before the link went down, where the next backfill
+request starts from. The station keeps sending live samples while it works
+through a backfill, so backfilled ones from the first live seq on are already
+here and are dropped (backfillDuplicates).
+
+Every sample is stamped with one host.now() read per chunk of bytes that
+completed frames (clock.py). When the station sends its millis() the stream's
+deviceClock learns the station's clock from them, and the sample's time is put
+back to when the station took it, for backfilled samples too, so the receive
+time is left saying when it got here and the difference is the latency.
+
+'''
+import logging
+import re
+import select
+
+from .protocol import sync, headerFmt, frameOverhead, crc, typePulses, typeBackfill, backfillHeadFmt
+from .clock import host, deviceClock
+from .derived import derive
+from .samples import decode, sample
+
+log = logging.getLogger(__name__)
+
+frameStart = re.compile(rb'[{\xa5]') # a json frame or a binary sync byte
+seqWindow = 256 # sequence numbers further than this from the last one are a jump, not gaps or repeats
+
+# This accumulates raw bytes and splits off every complete datagram in one pass
+class frameBuffer:
+    def __init__(self, maxFrame=1024):
+        self.buf = bytearray() # bytes received but not yet part of a complete frame
+        self.maxFrame = maxFrame # anything longer than this without a closing brace is junk
+        self.frames = 0     # complete frames found
+        self.crcErrors = 0  # binary frames thrown away for a bad crc
+        self.resyncs = 0    # times bytes had to be skipped to find the next frame start
+        self.discarded = 0  # bytes skipped
+        self.skipping = False # skipping since the last good frame, one resync however the bytes arrive
+
+    def skip(self, n):
+        if n > 0:
+            self.discarded += n
+            if not self.skipping:
+                self.resyncs += 1
+                self.skipping = True
+
+    # add newly received bytes and return a list of complete frames (as bytes)
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        frames = []
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while 1:
+                match = frameStart.search(buf, pos)
+                if match is None: # no frame start left, everything else is noise between frames
+                    self.skip(len(buf) - pos)
+                    pos = len(buf)
+                    break
+                start = match.start()
+                self.skip(start - pos)
+                pos = start
+                if buf[start] == sync:
+                    if len(buf) - start < headerFmt.size: # length not here yet
+                        break
+                    end = start + frameOverhead + buf[start + 1]
+                    if end > len(buf): # frame started but not finished, keep it for the next read
+                        break
+                    if crc(view[start + 1:end - 2]) != buf[end - 2] | buf[end - 1] << 8:
+                        self.crcErrors += 1
+                        self.skip(1)
+                        pos = start + 1 # not a frame after all (or a damaged one), look again from the next byte
+                        continue
+                    frames.append(bytes(view[start:end]))
+                    self.skipping = False
+                    pos = end
+                    continue
+                end = buf.find(b'}', start + 1)
+                restart = frameStart.search(buf, start + 1, len(buf) if end < 0 else end)
+                if restart: # json is plain text without nested braces, this frame lost its end
+                    self.skip(restart.start() - start)
+                    pos = restart.start()
+                    continue
+                if end < 0: # frame started but not finished, keep it for the next read
+                    if len(buf) - start > self.maxFrame: # runaway frame, throw it away
+                        self.skip(len(buf) - start)
+                        pos = len(buf)
+                    break
+                frames.append(bytes(view[start:end + 1]))
+                self.skipping = False
+                pos = end + 1
+        finally:
+            view.release() # the buffer can't be resized while a view of it exists
+        del buf[:pos] # drop consumed bytes in one go rather than per frame
+        self.frames += len(frames)
+        return frames
+
+    def clear(self):
+        self.buf.clear()
+        self.skipping = False
+
+    def stats(self):
+        return {"frames": self.frames, "crcErrors": self.crcErrors, "resyncs": self.resyncs, "discarded": self.discarded}
+
+# Frames to samples for one link, checking the station's sequence numbers
+class sampleStream:
+    def __init__(self, maxFrame=1024, health=None):
+        self.frames = frameBuffer(maxFrame)
+        self.health = health # linkHealth told about every chunk and the samples it completed
+        self.last = None    # sequence number of the last sample passed on, None after a reconnect
+        self.samples = 0    # samples passed on
+        self.corrupt = 0    # frames that didn't decode into a sample
+        self.unknown = 0    # binary frames of a type this receiver doesn't know
+        self.gaps = 0       # samples the sequence numbers say never arrived
+        self.duplicates = 0 # samples dropped as repeats (same or slightly older sequence number)
+        self.jumps = 0      # sequence numbers out of the window, numbering started over from there
+        self.tap = None     # called with every chunk of raw bytes before framing, e.g. a transports.recorder
+        self.pulses = None  # pulses.pulseEstimator for pulse frames, it annotates the samples
+        self.backfilling = False # decode backfill frames, off they count as unknown
+        self.backfilled = []     # backfilled samples waiting for takeBackfill()
+        self.resume = None       # seq of the last sample before the link went down
+        self.firstLive = None    # seq of the first live sample of this connection
+        self.backfillSamples = 0 # backfilled samples passed on
+        self.backfillDuplicates = 0
+        self.clock = deviceClock() # the station's millis() to host time, kept across reconnects
+        self.latency = None        # smoothed seconds from the station taking a sample to its frame completing here
+
+    # add newly received bytes and return the list of samples they completed
+    def feed(self, data):
+        if self.tap is not None:
+            self.tap(data)
+        samples = []
+        frames = self.frames.feed(data)
+        if frames:
+            wall, mono = host.now() # one stamp for everything this chunk completed
+        for frame in frames:
+            if self.pulses is not None and frame[0] == sync and frame[2] == typePulses:
+                try:
+                    self.pulses.feed(frame)
+                except ValueError as e:
+                    self.corrupt += 1
+                    log.debug("Dropped corrupt pulse frame %r: %s", frame[:64], e)
+                continue
+            if self.backfilling and frame[0] == sync and frame[2] == typeBackfill:
+                try:
+                    sent = backfillHeadFmt.unpack_from(frame, 3)[1]
+                    self.addBackfill(sample.fromBackfill(frame, wall, mono), sent, mono)
+                except ValueError as e:
+                    self.corrupt += 1
+                    log.debug("Dropped corrupt backfill frame %r: %s", frame[:64], e)
+                continue
+            try:
+                m = decode(frame, wall, mono)
+            except ValueError as e: # well framed but garbled, drop it and carry on
+                self.corrupt += 1
+                log.debug("Dropped corrupt frame %r: %s", frame[:64], e)
+                continue
+            if m is None:
+                self.unknown += 1
+                continue
+            if m.seq is not None:
+                if self.last is not None:
+                    d = (m.seq - self.last) & 0xFFFF # 16 bit sequence numbers wrap
+                    if d == 0 or d >= 0x10000 - seqWindow: # same or just behind the last one
+                        self.duplicates += 1
+                        continue
+                    if d > seqWindow:
+                        self.jumps += 1
+                    else:
+                        self.gaps += d - 1
+                self.last = m.seq
+                if self.firstLive is None:
+                    self.firstLive = m.seq
+            if m.device is not None:
+                self.clock.observe(m.device, mono)
+                event = min(self.clock.toHost(m.device), mono) # never taken after it arrived
+                m.time = host.wall(event)
+                delay = mono - event
+                self.latency = delay if self.latency is None else self.latency + 0.1 * (delay - self.latency)
+            if self.pulses is not None:
+                self.pulses.annotate(m)
+            derive(m)
+            self.samples += 1
+            samples.append(m)
+        if self.health is not None:
+            self.health.received(len(data), samples)
+        return samples
+
+    # backfilled samples from a frame the station sent at millis() sent, completed at monotonic time received
+    def addBackfill(self, samples, sent, received):
+        self.clock.observe(sent, received)
+        for m in samples:
+            if self.firstLive is not None and (m.seq - self.firstLive) & 0xFFFF < 0x8000: # came in live already
+                self.backfillDuplicates += 1
+                continue
+            m.received = min(self.clock.toHost(m.device), m.received) # kept on the station's clock, not the link's
+            m.time = host.wall(m.received)
+            derive(m)
+            self.backfillSamples += 1
+            self.backfilled.append(m)
+
+    # the backfilled samples decoded since the last call, oldest first
+    def takeBackfill(self):
+        samples, self.backfilled = self.backfilled, []
+        return samples
+
+    # start over for a new connection, the station may have restarted its numbering
+    def reset(self):
+        self.frames.clear()
+        if self.last is not None:
+            self.resume = self.last
+        self.last = self.firstLive = None
+        self.backfilled = []
+        if self.pulses is not None:
+            self.pulses.reset()
+
+    def stats(self):
+        stats = self.frames.stats()
+        stats.update({"samples": self.samples, "corrupt": self.corrupt, "unknown": self.unknown,
+            "gaps": self.gaps, "duplicates": self.duplicates, "jumps": self.jumps})
+        stats.update(self.clock.stats())
+        if self.latency is not None:
+            stats["latencyMs"] = self.latency * 1000
+        if self.backfilling:
+            stats.update({"backfilled": self.backfillSamples, "backfillDuplicates": self.backfillDuplicates})
+        if self.pulses is not None:
+            stats.update(self.pulses.stats())
+        return stats
+
+# This reads whatever the socket has available and hands back what the frame source makes of it,
+# complete frames from a frameBuffer by default or samples from a sampleStream
+class frameReader:
+    def __init__(self, sock, bufsize=4096, maxFrame=1024, frames=None):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.frames = frameBuffer(maxFrame) if frames is None else frames
+        self.bytesIn = 0 # total bytes received on this link
+
+    # wait up to timeout seconds for data, returns a (possibly empty) list of frames
+    # raises ConnectionError when the remote end closes the link, socket errors propagate
+    def read(self, timeout=0.5):
+        r, _, _ = select.select([self.sock], [], [], timeout)
+        if not r: # timed out, nothing on the pipe
+            return []
+        try:
+            data = self.sock.recv(self.bufsize)
+        except OSError as e:
+            if isinstance(e, BlockingIOError) or "temporarily" in str(e) or "busy" in str(e):
+                return [] # spurious wakeup, no data on the pipe, situation normal
+            raise
+        if not data: # readable but empty means the other end hung up
+            raise ConnectionError("connection closed by remote host")
+        self.bytesIn += len(data)
+        return self.frames.feed(data)
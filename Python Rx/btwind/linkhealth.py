@@ -0,0 +1,182 @@
+'''
+
+btwind link health
+
+The station sends one datagram every dataUpdateInterval (1000 ms), so the
+timing of arrivals says a lot about a link before it actually drops: frames
+arriving late, bunched up or not at all. linkHealth keeps per link telemetry
+from the arrival times the framing layer already stamps on every sample:
+
+    a histogram of inter-arrival times, in fractions of the cadence
+    the average interval and the jitter (RFC 3550 style, the smoothed change
+    between consecutive intervals)
+    bytes and frames per second over the last minute
+    time since the last frame
+    reconnects and how long the link was down each time
+
+state() sums it up as down, ok or degraded (with the reason): no data for
+2.5 intervals, an average interval more than 25% off the cadence, or jitter
+above 25% of it. Changes of state are logged as warnings, so a failing link
+shows up in the log and on the display before the socket dies.
+
+The sampleStream calls received() once per chunk of bytes read, so the cost per
+frame is a few float operations. Readers on other threads (the display, a
+metrics exporter) go through a lock.
+
+'''
+import bisect
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# inter-arrival histogram bucket upper edges, as fractions of the cadence
+histogramEdges = (0.25, 0.5, 0.75, 0.9, 0.95, 1.05, 1.1, 1.25, 1.5, 2.0, 3.0, 5.0)
+
+class linkHealth:
+    def __init__(self, name="default", cadence=1.0, tolerance=0.25, stall=2.5, window=60):
+        self.name = name
+        self.cadence = cadence     # seconds between datagrams the station is set up for
+        self.tolerance = tolerance # allowed drift of interval and jitter, as a fraction of the cadence
+        self.stall = stall         # intervals without a frame before the link counts as degraded
+        self.window = window       # seconds the rates are averaged over
+        self.lock = threading.Lock()
+        self.edges = [e * cadence for e in histogramEdges]
+        self.histogram = [0] * (len(self.edges) + 1) # the last bucket holds everything longer
+        self.intervalSum = 0.0  # of every interval in the histogram
+        self.lastFrame = None   # monotonic time of the last frame, None until the first after a connect
+        self.lastInterval = None
+        self.interval = cadence # smoothed inter-arrival time
+        self.jitter = 0.0
+        self.intervals = 0      # intervals measured since the last connect
+        self.frames = 0
+        self.bytes = 0
+        self.buckets = collections.deque() # [second, bytes, frames] for the rate window
+        self.connected = False
+        self.upAt = None        # monotonic time of the last connect
+        self.connects = 0
+        self.downSince = None   # monotonic time the link went down
+        self.downLast = 0.0     # seconds the link was down before the last reconnect
+        self.downMax = 0.0
+        self.downTotal = 0.0
+        self.current = "down"   # last state reported, for logging changes
+        self.reason = ""
+
+    # a chunk of nbytes from the link completed these samples, called by the sampleStream
+    def received(self, nbytes, samples):
+        now = time.monotonic()
+        with self.lock:
+            self.bytes += nbytes
+            self.frames += len(samples)
+            second = int(now)
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0])
+                while self.buckets[0][0] <= second - self.window:
+                    self.buckets.popleft()
+            bucket = self.buckets[-1]
+            bucket[1] += nbytes
+            bucket[2] += len(samples)
+            for m in samples:
+                t = m.received
+                if self.lastFrame is not None:
+                    dt = t - self.lastFrame
+                    self.histogram[bisect.bisect_left(self.edges, dt)] += 1
+                    self.intervalSum += dt
+                    self.interval += (dt - self.interval) / 16
+                    if self.lastInterval is not None:
+                        self.jitter += (abs(dt - self.lastInterval) - self.jitter) / 16
+                    self.lastInterval = dt
+                    self.intervals += 1
+                self.lastFrame = t
+
+    # the link came up
+    def up(self):
+        now = time.monotonic()
+        with self.lock:
+            self.connected = True
+            self.upAt = now
+            self.connects += 1
+            if self.downSince is not None and self.connects > 1:
+                self.downLast = now - self.downSince
+                self.downMax = max(self.downMax, self.downLast)
+                self.downTotal += self.downLast
+            self.downSince = None
+            self.lastFrame = self.lastInterval = None # the time spent reconnecting is not an interval
+            self.interval = self.cadence
+            self.jitter = 0.0
+            self.intervals = 0
+        self.check()
+
+    # the link went down
+    def down(self):
+        with self.lock:
+            self.connected = False
+            self.downSince = time.monotonic()
+        self.check()
+
+    # (state, reason) now, state is down, ok or degraded
+    def state(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if not self.connected:
+                return "down", ""
+            since = now - (self.lastFrame if self.lastFrame is not None else self.upAt) # a link can come up silent
+            if since > self.stall * self.cadence:
+                return "degraded", f"no data for {since:.1f} s"
+            if self.intervals >= 8: # enough arrivals to judge the timing
+                if abs(self.interval - self.cadence) > self.tolerance * self.cadence:
+                    return "degraded", f"interval {self.interval:.2f} s"
+                if self.jitter > self.tolerance * self.cadence:
+                    return "degraded", f"jitter {self.jitter * 1000:.0f} ms"
+            return "ok", ""
+
+    # state(), logging when it changes, the engines call this periodically
+    def check(self):
+        state, reason = self.state()
+        if state != self.current:
+            if state == "degraded":
+                log.warning("Link to %s is degraded: %s", self.name, reason)
+            elif self.current == "degraded":
+                log.info("Link to %s is %s again", self.name, "healthy" if state == "ok" else state)
+            self.current = state
+        self.reason = reason
+        return state, reason
+
+    # a short line for a status label
+    def summary(self):
+        state, reason = self.state()
+        if state == "down":
+            return "Disconnected"
+        if state == "degraded":
+            return f"Degraded ({reason})"
+        with self.lock:
+            return f"Connected, {self.interval:.2f} s / jitter {self.jitter * 1000:.0f} ms"
+
+    def rates(self, now):
+        if not self.buckets:
+            return 0.0, 0.0
+        span = max(1.0, min(self.window, now - self.buckets[0][0]))
+        return sum(b[1] for b in self.buckets) / span, sum(b[2] for b in self.buckets) / span
+
+    def stats(self):
+        state, reason = self.state()
+        now = time.monotonic()
+        with self.lock:
+            bytesPerSec, framesPerSec = self.rates(now)
+            return {
+                "health": state,
+                "healthReason": reason,
+                "intervalMs": self.interval * 1000,
+                "jitterMs": self.jitter * 1000,
+                "sinceLastMs": (now - self.lastFrame) * 1000 if self.lastFrame is not None else None,
+                "bytesPerSec": bytesPerSec,
+                "framesPerSec": framesPerSec,
+                "reconnects": max(0, self.connects - 1),
+                "downLastMs": self.downLast * 1000,
+                "downMaxMs": self.downMax * 1000,
+                "downTotalMs": self.downTotal * 1000,
+                "intervalSumMs": self.intervalSum * 1000,
+                "intervalHistogram": dict(zip([f"{e * 1000:g}" for e in self.edges] + ["+Inf"], self.histogram)),
+            }
@@ -0,0 +1,186 @@
+'''
+
+btwind logging
+
+Sets up the standard logging module for the receiver and the apps, replacing
+the print based msg():
+
+    records below the level are dropped before any formatting, callers pass
+    arguments (log.info("lost %s", name)) instead of building f-strings
+    handlers don't run on the caller's thread: a QueueHandler hands the record
+    over unformatted and a QueueListener thread formats and writes it, to the
+    console and optionally a rotating file (plain text or one JSON object per
+    line)
+    a ring of the most recent records, kept unformatted, is written out as a
+    post-mortem file when a station's link is lost. It keeps what the level
+    lets through unless ringlevel asks for more (DEBUG), which means every
+    debug call on the receive path builds a record, so that's opt in
+    the level can be changed while running (the settings panel does this)
+
+Settings come from the [Logging] section of btwindrx.ini:
+
+    [Logging]
+    level = INFO        console and file level
+    file =              log file, blank = console only
+    format = text       or json
+    maxkb = 1024        rotate the file at this size
+    backups = 5         rotated files kept
+    ring = 500          records kept for post-mortem dumps, 0 = off
+    ringlevel =         lowest level kept in the ring, blank = the level
+    dumps = logs        directory for post-mortem files, blank = no dumps
+
+'''
+import atexit
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+
+from .config import defaults as settingDefaults
+
+log = logging.getLogger(__name__)
+defaults = settingDefaults["Logging"]
+
+textFormat = '%(asctime)s %(levelname)s %(name)s - %(message)s'
+msgLevels = {1: logging.ERROR, 2: logging.WARNING, 3: logging.INFO} # msg() levels
+dumpEvery = 60 # seconds, at most one post-mortem per station in this time so a flapping link can't fill the disk
+
+# One JSON object per record: time, level, logger, thread, message and any extra= fields
+class jsonFormatter(logging.Formatter):
+    standard = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        d = {"time": record.created, "level": record.levelname, "logger": record.name, "thread": record.threadName,
+            "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in self.standard:
+                d[key] = value
+        if record.exc_info:
+            d["exception"] = self.formatException(record.exc_info)
+        return json.dumps(d, default=str)
+
+# Queues the record as it is, the listener thread does the formatting (the stock one formats in the caller)
+class recordQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Keeps the most recent records unformatted, nothing is formatted unless they are dumped
+class ringHandler(logging.Handler):
+    def __init__(self, size=500, level=logging.NOTSET):
+        super(ringHandler, self).__init__(level)
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def snapshot(self):
+        return list(self.records)
+
+queueHandler = None
+listener = None
+outputs = []  # console and file handlers, run by the listener
+ring = None
+dumpDir = ""
+lastDump = {} # name: time of the last post-mortem
+
+def levelOf(level):
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level {level}")
+    return value
+
+# route all logging through the background listener, safe to call again to apply new settings
+def setup(level="INFO", path="", fmt="text", maxBytes=1024 * 1024, backups=5, ringSize=500, ringLevel="",
+        dumps="", console=True):
+    global queueHandler, listener, ring, dumpDir
+    shutdown()
+    root = logging.getLogger()
+    formatter = jsonFormatter() if fmt == "json" else logging.Formatter(textFormat)
+    outputs.clear()
+    if console:
+        outputs.append(logging.StreamHandler())
+        outputs[-1].setFormatter(logging.Formatter(textFormat))
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        outputs.append(logging.handlers.RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backups))
+        outputs[-1].setFormatter(formatter)
+    queueHandler = recordQueueHandler(queue.SimpleQueue())
+    listener = logging.handlers.QueueListener(queueHandler.queue, *outputs, respect_handler_level=False)
+    root.addHandler(queueHandler)
+    ring = None
+    if ringSize > 0:
+        ring = ringHandler(ringSize, levelOf(ringLevel) if ringLevel else logging.NOTSET) # NOTSET, the level
+        root.addHandler(ring)
+    dumpDir = dumps
+    listener.start()
+    setLevel(level)
+
+def fromConfig(config, **overrides):
+    get = lambda key: overrides.get(key) or config.get('Logging', key, fallback=defaults.get(key))
+    setup(get('level'), get('file'), get('format'), int(float(get('maxkb')) * 1024), int(get('backups')),
+        int(get('ring')), get('ringlevel'), get('dumps'))
+
+# change the level while running: the queue handler filters, the btwind loggers only go lower when a ringlevel
+# below it was set
+def setLevel(level):
+    level = levelOf(level)
+    logging.getLogger().setLevel(level)
+    if queueHandler is not None:
+        queueHandler.setLevel(level)
+    package = logging.getLogger("btwind")
+    package.setLevel(min(level, ring.level) if ring is not None and ring.level else level)
+
+# write the ring out to a post-mortem file, the formatting and writing happen on a background thread
+def dump(name, reason=""):
+    if ring is None or not dumpDir:
+        return None
+    now = time.time()
+    if now - lastDump.get(name, 0) < dumpEvery:
+        return None
+    lastDump[name] = now
+    records = ring.snapshot()
+    path = os.path.join(dumpDir, "postmortem-%s-%s.log" % (re.sub(r'[^\w.-]', '_', name),
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(now))))
+    def write():
+        try:
+            os.makedirs(dumpDir, exist_ok=True)
+            formatter = logging.Formatter(textFormat)
+            with open(path, 'w') as f:
+                f.write(f"Post-mortem for {name}: {reason or 'link lost'}, last {len(records)} log records\n")
+                for record in records:
+                    f.write(formatter.format(record) + "\n")
+        except OSError as e:
+            log.error("Couldn't write post-mortem %s: %s", path, e)
+    threading.Thread(target=write, name="postmortem", daemon=True).start()
+    return path
+
+# flush and stop the listener, the handlers are removed so logging goes back to its defaults
+def shutdown():
+    global queueHandler, listener, ring
+    root = logging.getLogger()
+    if listener is not None:
+        listener.stop() # processes everything already queued first
+        listener = None
+    for handler in (queueHandler, ring):
+        if handler is not None:
+            root.removeHandler(handler)
+    queueHandler = ring = None
+    for handler in outputs:
+        handler.close()
+
+atexit.register(shutdown)
+
+# msg(text, lvl) from the apps, 1 = error, 2 = warning, 3 = info. Prefer log calls with arguments,
+# an f-string passed in here has already been built whether or not it's shown
+def msg(text, lvl=1, *args):
+    logger = logging.getLogger("btwind.app")
+    level = msgLevels.get(lvl, logging.DEBUG)
+    if logger.isEnabledFor(level):
+        logger.log(level, text, *args)
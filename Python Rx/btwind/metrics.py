@@ -0,0 +1,266 @@
+'''
+
+btwind metrics endpoint
+
+An optional HTTP endpoint in the receiver process that serves its counters and
+gauges in the Prometheus text format, so an unattended receiver can be watched
+from Prometheus, a dashboard or plain curl:
+
+    [Metrics]
+    enabled = 1
+    host = 127.0.0.1
+    port = 9108
+
+    curl http://127.0.0.1:9108/metrics
+
+Per station: frames, samples, parse errors by kind (crc, decode), resyncs,
+sequence gaps, connection attempts and reconnects, the command queue depth and drops,
+link timing from linkhealth.py (interval, jitter, inter-arrival histogram,
+degraded) and the latest mph, gust and temperature. For the process: sink
+queue depth and waits (channels.py), backlog (outbox and MQTT), CPU seconds and resident memory.
+
+Scraping never touches the receive path. The latest sample per station is one
+dict assignment in the sink, everything else is read from the stats() the
+engines already keep, on the HTTP server's own thread, and a rendered page is
+reused for scrapes that come within a second of each other.
+
+'''
+import logging
+import os
+import resource
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .config import defaults as settingDefaults
+
+log = logging.getLogger(__name__)
+defaults = settingDefaults["Metrics"]
+
+# (metric, type, help, stats key) for the per station numbers
+stationMetrics = (
+    ("btwind_frames_total", "counter", "Complete frames received", "frames"),
+    ("btwind_samples_total", "counter", "Samples passed on to the sinks", "samples"),
+    ("btwind_resyncs_total", "counter", "Times bytes were skipped to find the next frame", "resyncs"),
+    ("btwind_discarded_bytes_total", "counter", "Bytes skipped between frames", "discarded"),
+    ("btwind_unknown_frames_total", "counter", "Binary frames of an unknown type", "unknown"),
+    ("btwind_sequence_gaps_total", "counter", "Samples the sequence numbers say were lost", "gaps"),
+    ("btwind_duplicates_total", "counter", "Samples dropped as repeats", "duplicates"),
+    ("btwind_sequence_jumps_total", "counter", "Sequence numbers that restarted the numbering", "jumps"),
+    ("btwind_connect_attempts_total", "counter", "Connection attempts", "attempts"),
+    ("btwind_reconnects_total", "counter", "Connections after the first", "reconnects"),
+    ("btwind_connected", "gauge", "1 while the link is up", "connected"),
+    ("btwind_uptime_seconds", "gauge", "Seconds the current connection has been up", "uptime"),
+    ("btwind_command_queue_depth", "gauge", "Commands waiting to be sent to the station", "commandsQueued"),
+    ("btwind_commands_dropped_total", "counter", "Commands dropped because the command queue was full", "commandsDropped"),
+    ("btwind_pulses_total", "counter", "Anemometer pulses received, pulse mode only", "pulses"),
+    ("btwind_pulses_lost_total", "counter", "Pulses in pulse frames that never arrived", "pulsesLost"),
+    ("btwind_backfilled_total", "counter", "Samples the station kept while the link was down, received later", "backfilled"),
+    ("btwind_backfill_duplicates_total", "counter", "Backfilled samples dropped as already received live", "backfillDuplicates"),
+    ("btwind_link_bytes_per_second", "gauge", "Bytes received per second over the last minute", "bytesPerSec"),
+    ("btwind_link_frames_per_second", "gauge", "Frames received per second over the last minute", "framesPerSec"),
+    ("btwind_clock_drift_ppm", "gauge", "How fast the station's clock runs against the receiver's, parts per million", "clockDriftPpm"),
+    ("btwind_clock_restarts_total", "counter", "Times the station's clock went backwards, a restart", "clockRestarts"),
+)
+
+# (metric, help, stats key) for the per station times, kept in milliseconds in stats()
+stationSeconds = (
+    ("btwind_link_interval_seconds", "Smoothed time between frames", "intervalMs"),
+    ("btwind_link_jitter_seconds", "Smoothed change between consecutive frame intervals", "jitterMs"),
+    ("btwind_link_since_last_frame_seconds", "Time since the last frame", "sinceLastMs"),
+    ("btwind_link_down_seconds_total", "Time spent reconnecting", "downTotalMs"),
+    ("btwind_link_latency_seconds", "Smoothed time from the station taking a sample to it arriving, over the quickest", "latencyMs"),
+)
+
+# (metric, sample field, help) for the latest sample of each station
+sampleMetrics = (
+    ("btwind_wind_mph", "mph", "Latest wind speed"),
+    ("btwind_gust_mph", "gust", "Latest highest gust since the station's last reset"),
+    ("btwind_temperature_fahrenheit", "temp", "Latest temperature"),
+    ("btwind_wind_speed_mph", "speed", "Latest wind speed worked out from the pulse times, pulse mode only"),
+    ("btwind_gust3_mph", "gust3", "Highest 3 second mean wind since the sample before, pulse mode only"),
+    ("btwind_wind_chill_fahrenheit", "windchill", "Latest NWS wind chill, only at 50 F and below with 3 mph or more"),
+    ("btwind_feels_like_fahrenheit", "feelslike", "Latest feels like temperature, the wind chill or the temperature"),
+)
+
+# (metric, help, stats key) for the wind analytics of each station, see analytics.py
+analyticsMetrics = (
+    ("btwind_sustained_wind_mph", "Mean wind over the sustained window, 2 minutes by default", "sustained"),
+    ("btwind_period_mean_wind_mph", "Mean wind over the analytics period, 10 minutes by default", "mean"),
+    ("btwind_period_gust_mph", "Highest 3 second mean wind in the period", "gust"),
+    ("btwind_period_lull_mph", "Lowest 3 second mean wind in the period", "lull"),
+    ("btwind_gust_factor", "Period gust over the period mean", "gustFactor"),
+    ("btwind_turbulence_intensity", "Standard deviation of the wind over its mean in the period", "turbulence"),
+)
+
+# (metric, type, help, section, stats key) for the sinks
+sinkMetrics = (
+    ("btwind_sink_queue_depth", "gauge", "Samples waiting for the storage and outbox sinks", "sinkqueue", "depth"),
+    ("btwind_sink_queue_max_depth", "gauge", "Most samples ever waiting for the sinks", "sinkqueue", "maxDepth"),
+    ("btwind_sink_queue_blocked_total", "counter", "Times the receive path waited for room in the sink queue", "sinkqueue", "blocked"),
+    ("btwind_sink_failures_total", "counter", "Samples a sink raised an error on", "sinkqueue", "failures"),
+    ("btwind_backfill_queue_depth", "gauge", "Backfill frames waiting to be merged into storage", "backfill", "depth"),
+    ("btwind_backfill_merged_total", "counter", "Backfilled samples merged into storage", "backfill", "merged"),
+    ("btwind_backfill_skipped_total", "counter", "Backfilled samples storage already had", "backfill", "skipped"),
+    ("btwind_outbox_backlog", "gauge", "Samples in the outbox waiting for the broker", "outbox", "backlog"),
+    ("btwind_outbox_bytes", "gauge", "Bytes on disk in the outbox", "outbox", "bytes"),
+    ("btwind_outbox_evicted_total", "counter", "Outbox samples dropped to stay under the size limit", "outbox", "evicted"),
+    ("btwind_mqtt_connected", "gauge", "1 while the MQTT broker is connected", "mqtt", "connected"),
+    ("btwind_mqtt_pending", "gauge", "MQTT values waiting to be published", "mqtt", "pending"),
+    ("btwind_mqtt_published_total", "counter", "MQTT messages published", "mqtt", "published"),
+)
+
+# a label value with \, " and newlines escaped
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def number(value):
+    if value is True or value is False:
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+# bytes of resident memory, None where /proc isn't available
+def residentBytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+# renders the receiver's stats() as a Prometheus text page
+def render(stats, latest):
+    lines = []
+    def family(name, kind, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    stations = stats.get("stations", {})
+    for name, kind, help, key in stationMetrics:
+        family(name, kind, help)
+        for station, s in stations.items():
+            if s.get(key) is not None:
+                lines.append(f'{name}{{station="{label(station)}"}} {number(s[key])}')
+    family("btwind_parse_errors_total", "counter", "Frames thrown away, crc = bad binary crc, decode = didn't decode")
+    for station, s in stations.items():
+        lines.append(f'btwind_parse_errors_total{{station="{label(station)}",kind="crc"}} {number(s.get("crcErrors", 0))}')
+        lines.append(f'btwind_parse_errors_total{{station="{label(station)}",kind="decode"}} {number(s.get("corrupt", 0))}')
+    for name, help, key in stationSeconds:
+        family(name, "counter" if name.endswith("_total") else "gauge", help)
+        for station, s in stations.items():
+            if s.get(key) is not None:
+                lines.append(f'{name}{{station="{label(station)}"}} {number(s[key] / 1000)}')
+    family("btwind_link_degraded", "gauge", "1 while the link timing is off, see linkhealth.py")
+    for station, s in stations.items():
+        lines.append(f'btwind_link_degraded{{station="{label(station)}"}} {number(s.get("health") == "degraded")}')
+    family("btwind_link_interarrival_seconds", "histogram", "Time between frames")
+    for station, s in stations.items():
+        hist = s.get("intervalHistogram")
+        if not hist:
+            continue
+        total = 0
+        for edge, count in hist.items(): # per bucket counts, prometheus buckets are cumulative
+            total += count
+            le = edge if edge == "+Inf" else number(float(edge) / 1000)
+            lines.append(f'btwind_link_interarrival_seconds_bucket{{station="{label(station)}",le="{le}"}} {total}')
+        lines.append(f'btwind_link_interarrival_seconds_sum{{station="{label(station)}"}} {number(s["intervalSumMs"] / 1000)}')
+        lines.append(f'btwind_link_interarrival_seconds_count{{station="{label(station)}"}} {total}')
+
+    now = time.time()
+    for metric, field, help in sampleMetrics:
+        family(metric, "gauge", help)
+        for station, m in latest.items():
+            if getattr(m, field) is not None:
+                lines.append(f'{metric}{{station="{label(station)}"}} {number(getattr(m, field))}')
+    family("btwind_sample_age_seconds", "gauge", "Time since the latest sample was received")
+    for station, m in latest.items():
+        lines.append(f'btwind_sample_age_seconds{{station="{label(station)}"}} {number(now - m.time)}')
+
+    analytics = stats.get("analytics", {})
+    for metric, help, key in analyticsMetrics:
+        if analytics:
+            family(metric, "gauge", help)
+        for station, a in analytics.items():
+            if a.get(key) is not None:
+                lines.append(f'{metric}{{station="{label(station)}"}} {number(a[key])}')
+
+    for name, kind, help, section, key in sinkMetrics:
+        if section in stats:
+            family(name, kind, help)
+            lines.append(f"{name} {number(stats[section][key])}")
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    family("process_cpu_seconds_total", "counter", "User and system CPU time")
+    lines.append(f"process_cpu_seconds_total {number(usage.ru_utime + usage.ru_stime)}")
+    rss = residentBytes()
+    if rss is not None:
+        family("process_resident_memory_bytes", "gauge", "Resident memory")
+        lines.append(f"process_resident_memory_bytes {number(rss)}")
+    return "\n".join(lines) + "\n"
+
+class metricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.owner.page().encode()
+        except Exception as e: # a bad scrape must not take the endpoint down
+            log.exception("Metrics scrape failed")
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+# The endpoint, put() is a sink that keeps the latest sample of every station
+class metricsServer(threading.Thread):
+    def __init__(self, stats, host="127.0.0.1", port=9108, cache=1.0):
+        super(metricsServer, self).__init__()
+        self.daemon = True
+        self.stats = stats # callable returning the receiver's stats() dict
+        self.cache = cache # seconds a rendered page is reused for
+        self.latest = {}   # station: latest sample
+        self.lock = threading.Lock()
+        self.rendered = None
+        self.renderedAt = 0.0
+        self.scrapes = 0
+        self.httpd = ThreadingHTTPServer((host, port), metricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.address = "%s:%d" % self.httpd.server_address[:2]
+
+    @classmethod
+    def fromConfig(cls, config, stats, **kwargs):
+        get = lambda key: config.get('Metrics', key, fallback=defaults.get(key))
+        return cls(stats, get('host'), int(get('port')), **kwargs)
+
+    def put(self, m):
+        self.latest[m.station] = m
+
+    # the current page, rendered at most once per cache interval however many scrapers there are
+    def page(self):
+        with self.lock:
+            self.scrapes += 1
+            now = time.monotonic()
+            if self.rendered is None or now - self.renderedAt >= self.cache:
+                self.rendered = render(self.stats(), dict(self.latest))
+                self.renderedAt = now
+            return self.rendered
+
+    def run(self):
+        log.info("Serving metrics on http://%s/metrics", self.address)
+        self.httpd.serve_forever(poll_interval=0.5)
+        self.httpd.server_close()
+
+    def stop(self):
+        if self.is_alive():
+            self.httpd.shutdown() # waits for serve_forever to return
+        else:
+            self.httpd.server_close()
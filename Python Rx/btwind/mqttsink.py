@@ -0,0 +1,158 @@
+'''
+
+btwind MQTT sink
+
+One long lived MQTT client per process instead of a connect/publish/disconnect
+for every datagram. put() only records the latest value for each topic and
+returns, a background thread publishes whatever changed at most once every
+interval seconds, so a slow or missing broker never holds up the receiver or UI.
+While the broker is away values keep coalescing and go out on reconnect.
+
+Behind the outbox (the default) records go through sendBatch() instead. That
+path is not coalesced or held to the interval, the point of the outbox is that
+every sample reaches the broker, so it is paced by the outbox: live samples as
+they come and the backlog at Outbox/replayrate records per second. A publish
+paho doesn't accept fails the batch and the outbox keeps it for later.
+
+Settings come from the [MQTT] section of btwindrx.ini, every topic_<field> option
+publishes that sample field, topics may contain {station} for multi-station use.
+clientFactory can be any callable returning an object with the paho Client
+interface, which is how the sink is run against a local stand-in broker.
+
+'''
+import logging
+import threading
+import time
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError: # only needed when the sink is enabled
+    mqtt = None
+
+from .config import defaults as settingDefaults
+
+log = logging.getLogger(__name__)
+defaults = settingDefaults["MQTT"]
+
+class mqttSink(threading.Thread):
+    def __init__(self, broker="localhost", port=1883, clientId="btwindrx", topics=None, qos=1, retain=False,
+            interval=5.0, keepalive=60, clientFactory=None):
+        super(mqttSink, self).__init__()
+        self.daemon = True
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self.lock = threading.Lock()
+        self.topics = topics or {"temp": defaults["topic_temp"], "mph": defaults["topic_mph"]} # field: topic
+        self.qos = qos
+        self.retain = retain
+        self.interval = interval # minimum seconds between publish rounds
+        self.pending = {} # topic: latest payload not yet published
+        self.connected = False
+
+        # counters
+        self.received = 0  # samples handed to put()
+        self.published = 0 # messages published
+        self.coalesced = 0 # values replaced by a newer one before they were published
+
+        if clientFactory is None:
+            if mqtt is None:
+                raise ImportError("paho-mqtt is required for the MQTT sink ($ pip3 install paho-mqtt)")
+            clientFactory = paho
+        self.client = clientFactory(client_id=clientId, clean_session=False) # persistent session, the broker keeps qos>0 state
+        self.client.on_connect = self.onConnect
+        self.client.on_disconnect = self.onDisconnect
+        self.client.reconnect_delay_set(1, 60)
+        self.client.connect_async(broker, port, keepalive)
+        self.broker = f"{broker}:{port}"
+
+    # build a sink from a config parser holding an [MQTT] section
+    @classmethod
+    def fromConfig(cls, config, **kwargs):
+        get = lambda key: config.get('MQTT', key, fallback=defaults.get(key))
+        topics = {key[6:]: value for key, value in config.items('MQTT') if key.startswith('topic_') and value}
+        return cls(broker=get('broker'), port=int(get('port')), clientId=get('clientid'), topics=topics,
+            qos=int(get('qos')), retain=get('retain') == '1', interval=float(get('interval')), **kwargs)
+
+    def run(self):
+        self.client.loop_start() # paho's network thread handles the socket, keepalive and reconnects
+        last = 0
+        while not self.stopped():
+            self._wake.wait()
+            self._wake.clear()
+            wait = last + self.interval - time.time()
+            if wait > 0 and self._stop_event.wait(wait): # rate limit, values keep coalescing meanwhile
+                break
+            if self.connected:
+                self.flush()
+                last = time.time()
+        self.client.loop_stop()
+        self.client.disconnect()
+        log.info("MQTT sink is exiting")
+
+    # publish everything pending, called on the sink thread
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for topic, payload in pending.items():
+            self.client.publish(topic, payload, qos=self.qos, retain=self.retain)
+            self.published += 1
+
+    # publish every record as is (no coalescing), used by the outbox. False while the broker is away or as soon
+    # as paho refuses a publish, the outbox then sends the whole batch again later
+    def sendBatch(self, records):
+        if not self.connected:
+            return False
+        for m in records:
+            for field, topic in self.topics.items():
+                value = getattr(m, field, None)
+                if value is not None:
+                    info = self.client.publish(topic.format(station=m.station), str(value), qos=self.qos,
+                        retain=self.retain)
+                    if info.rc != 0: # MQTT_ERR_SUCCESS
+                        log.warning("MQTT publish to %s failed: %s", self.broker, info.rc)
+                        return False
+                    self.published += 1
+        return True
+
+    # hand a sample to the sink, never blocks
+    def put(self, m):
+        with self.lock:
+            for field, topic in self.topics.items():
+                value = getattr(m, field, None)
+                if value is not None:
+                    topic = topic.format(station=m.station)
+                    if topic in self.pending:
+                        self.coalesced += 1
+                    self.pending[topic] = str(value)
+            self.received += 1
+        self._wake.set()
+
+    def onConnect(self, client, userdata, flags, rc):
+        if rc == 0:
+            log.info("Connected to MQTT broker %s", self.broker)
+            self.connected = True
+            self._wake.set() # publish whatever piled up while we were away
+        else:
+            log.error("MQTT broker %s refused the connection: %s", self.broker, rc)
+
+    def onDisconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            log.warning("Lost connection to MQTT broker %s, paho will reconnect", self.broker)
+
+    def stats(self):
+        return {"connected": self.connected, "received": self.received, "published": self.published,
+            "coalesced": self.coalesced, "pending": len(self.pending)}
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+# paho 2.x wants the callback api version up front, the sink uses the 1.x callback signatures
+def paho(**kwargs):
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        kwargs['callback_api_version'] = mqtt.CallbackAPIVersion.VERSION1
+    return mqtt.Client(**kwargs)
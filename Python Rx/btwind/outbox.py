@@ -0,0 +1,286 @@
+'''
+
+btwind store and forward outbox
+
+Sits in front of an upstream sink (MQTT or anything with a sendBatch(records)
+method returning True when the records were accepted). Every sample is appended
+to a local log made of segment files, one json record per line, and fsynced in
+batches. A drainer thread hands records to the sink: while the sink is up new
+samples go straight out (the live lane), while it is down they stay on disk.
+Once the sink is back the backlog is replayed oldest first in bulk batches,
+interleaved with live samples so replay never holds up current data.
+
+Disk use is bounded, when the log grows past maxBytes the oldest segment is
+deleted whether or not it was delivered. Delivery state is kept as a list of
+undelivered seq ranges plus the live cursor in a small state file, so a restart
+picks up where it left off (at least once, a crash can repeat a few records).
+
+'''
+import bisect
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from .samples import sample
+from .supervisor import backoff
+
+log = logging.getLogger(__name__)
+
+class outbox(threading.Thread):
+    def __init__(self, path, sink, maxBytes=50 * 1024 * 1024, segmentBytes=1024 * 1024, batch=200,
+            syncEvery=1.0, syncCount=100, replayRate=100):
+        super(outbox, self).__init__()
+        self.daemon = True
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self.lock = threading.Lock()
+        self.path = path
+        self.sink = sink
+        self.maxBytes = maxBytes
+        self.segmentBytes = segmentBytes
+        self.batch = batch # most records per sendBatch call
+        self.syncEvery = syncEvery # fsync at least this often (sec) ...
+        self.syncCount = syncCount # ... or after this many records
+        self.replayRate = replayRate # backlog records per second at most, live records are not limited
+        self.backoff = backoff(1.0, 30.0)
+
+        # counters
+        self.written = 0   # records appended
+        self.delivered = 0 # records accepted by the sink, live and replayed
+        self.replayed = 0  # records delivered from the backlog
+        self.evicted = 0   # undelivered records lost to the disk limit
+        self.drainRate = 0.0 # records delivered per second, smoothed
+        self.up = False    # sink accepted the last batch
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = [] # first seq of each segment file, oldest first
+        self.counts = {}   # first seq: number of records in that segment
+        self.sizes = {}    # first seq: bytes in that segment
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.log'):
+                self.openSegment(int(name[:-4]))
+        self.head = self.segments[-1] + self.counts[self.segments[-1]] if self.segments else 0 # next seq to write
+        if not self.segments:
+            self.newSegment(0)
+        self.file = open(self.segmentPath(self.segments[-1]), 'ab')
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+        # delivery state, the live lane starts where the last run left off and anything
+        # between there and the head (written but never delivered) becomes backlog
+        self.live = collections.deque() # (seq, record) written since the live cursor, memory copy of the live lane
+        self.ranges, self.liveCursor = self.loadState()
+        self.addRange(self.liveCursor, self.head)
+        self.liveCursor = self.head
+
+    def segmentPath(self, base):
+        return os.path.join(self.path, f"{base:012d}.log")
+
+    # scan an existing segment, dropping a torn last line left by a crash
+    def openSegment(self, base):
+        p = self.segmentPath(base)
+        with open(p, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+        self.segments.append(base)
+        self.counts[base] = data.count(b'\n', 0, end)
+        self.sizes[base] = end
+
+    def newSegment(self, base):
+        self.segments.append(base)
+        self.counts[base] = 0
+        self.sizes[base] = 0
+
+    def loadState(self):
+        try:
+            with open(os.path.join(self.path, 'state.json')) as f:
+                state = json.load(f)
+            return [tuple(r) for r in state["ranges"]], state["live"]
+        except (OSError, ValueError, KeyError):
+            return [], self.segments[0] if self.segments else 0 # no state, everything on disk is backlog
+
+    def saveState(self):
+        p = os.path.join(self.path, 'state.json')
+        with open(p + '.tmp', 'w') as f:
+            json.dump({"ranges": self.ranges, "live": self.liveCursor}, f)
+        os.replace(p + '.tmp', p) # atomic, the old state survives a crash mid-write
+
+    # record [start, end) as undelivered, merging with the last range when they touch
+    def addRange(self, start, end):
+        if end <= start:
+            return
+        if self.ranges and self.ranges[-1][1] >= start:
+            self.ranges[-1] = (self.ranges[-1][0], max(end, self.ranges[-1][1]))
+        else:
+            self.ranges.append((start, end))
+
+    # append a sample, called from the receive path, never waits on the sink
+    def put(self, m):
+        line = (json.dumps(m.asDict(), separators=(',', ':')) + '\n').encode()
+        with self.lock:
+            base = self.segments[-1]
+            if self.sizes[base] >= self.segmentBytes: # start a new segment
+                self.sync()
+                self.file.close()
+                self.newSegment(self.head)
+                base = self.head
+                self.file = open(self.segmentPath(base), 'ab')
+                self.evict()
+            self.file.write(line)
+            self.sizes[base] += len(line)
+            self.counts[base] += 1
+            if self.up:
+                self.live.append((self.head, m))
+            self.head += 1
+            self.written += 1
+            self.unsynced += 1
+        self._wake.set()
+
+    # flush and fsync the current segment, caller holds the lock
+    def sync(self):
+        if self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.lastSync = time.time()
+
+    # delete the oldest segments until the log fits in maxBytes, caller holds the lock
+    def evict(self):
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.maxBytes:
+            base = self.segments.pop(0)
+            end = self.segments[0]
+            lost = sum(min(e, end) - s for s, e in self.ranges if s < end)
+            if self.liveCursor < end: # the live lane fell that far behind, skip it forward
+                lost += end - self.liveCursor
+                self.liveCursor = end
+                while self.live and self.live[0][0] < end:
+                    self.live.popleft()
+            self.ranges = [(max(s, end), e) for s, e in self.ranges if e > end]
+            self.evicted += lost
+            os.remove(self.segmentPath(base))
+            del self.counts[base], self.sizes[base]
+            if lost:
+                log.warning("Outbox full, dropped segment %d with %d undelivered records", base, lost)
+
+    # read count records starting at seq from disk
+    def read(self, seq, count):
+        records = []
+        with self.lock:
+            self.file.flush() # make the current segment readable
+            i = bisect.bisect_right(self.segments, seq) - 1
+            segments = self.segments[max(i, 0):]
+        for base in segments:
+            if len(records) >= count:
+                break
+            try:
+                with open(self.segmentPath(base), 'rb') as f:
+                    for n, line in enumerate(f):
+                        if base + n < seq:
+                            continue
+                        if len(records) >= count or not line.endswith(b'\n'):
+                            break
+                        records.append(sample.fromDict(json.loads(line)))
+            except FileNotFoundError: # evicted while we were reading
+                continue
+        return records
+
+    def run(self):
+        last = time.time()
+        while not self.stopped():
+            self._wake.wait(self.syncEvery)
+            self._wake.clear()
+            with self.lock:
+                if self.unsynced >= self.syncCount or time.time() - self.lastSync >= self.syncEvery:
+                    self.sync()
+            sent = self.drain()
+            now = time.time()
+            self.drainRate += (sent / max(now - last, 1e-3) - self.drainRate) * 0.2
+            last = now
+            if not self.up and self.ranges: # sink down, probe again after a backoff
+                self._stop_event.wait(self.backoff.next())
+            elif self.ranges: # keep replaying at replayRate without waiting for new samples
+                self._stop_event.wait(self.batch / self.replayRate)
+                self._wake.set()
+        with self.lock:
+            self.sync()
+            self.file.close()
+        self.saveState()
+        log.info("Outbox is exiting")
+
+    # one round of delivery, live lane first then one backlog batch, returns records sent
+    def drain(self):
+        sent = 0
+        if self.up:
+            while 1: # live lane
+                with self.lock:
+                    if self.live and self.live[0][0] > self.liveCursor: # written just before the sink came back
+                        self.addRange(self.liveCursor, self.live[0][0])
+                        self.liveCursor = self.live[0][0]
+                    batch = [self.live.popleft() for i in range(min(self.batch, len(self.live)))]
+                if not batch:
+                    break
+                if not self.send([m for seq, m in batch]):
+                    with self.lock: # live records are on disk, hand them to the backlog
+                        self.addRange(batch[0][0], self.head)
+                        self.liveCursor = self.head
+                        self.live.clear()
+                    break
+                self.liveCursor = batch[-1][0] + 1
+                sent += len(batch)
+        else: # probing, anything written while down joins the backlog first
+            with self.lock:
+                self.addRange(self.liveCursor, self.head)
+                self.liveCursor = self.head
+        if self.ranges: # backlog lane, one batch per round
+            start, end = self.ranges[0]
+            records = self.read(start, min(self.batch, end - start))
+            if records and self.send(records):
+                with self.lock:
+                    if self.ranges and self.ranges[0][0] == start: # not trimmed by eviction meanwhile
+                        start += len(records)
+                        if start >= self.ranges[0][1]:
+                            self.ranges.pop(0)
+                        else:
+                            self.ranges[0] = (start, self.ranges[0][1])
+                self.replayed += len(records)
+                sent += len(records)
+            if sent:
+                self.saveState()
+        return sent
+
+    def send(self, records):
+        try:
+            ok = self.sink.sendBatch(records)
+        except Exception as e:
+            log.error("Outbox sink failed: %s", e)
+            ok = False
+        if ok:
+            if not self.up:
+                log.info("Outbox sink is back, %d records to replay", self.backlog())
+            self.up = True
+            self.backoff.reset()
+            self.delivered += len(records)
+        else:
+            self.up = False
+        return ok
+
+    # records written but not yet delivered
+    def backlog(self):
+        return sum(e - s for s, e in self.ranges) + self.head - self.liveCursor
+
+    def stats(self):
+        return {"up": self.up, "backlog": self.backlog(), "bytes": sum(self.sizes.values()),
+            "segments": len(self.segments), "written": self.written, "delivered": self.delivered,
+            "replayed": self.replayed, "evicted": self.evicted, "drainRate": self.drainRate}
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
@@ -0,0 +1,95 @@
+'''
+
+btwind wire protocol
+
+The station sends one datagram per update, either as JSON text
+
+    {"mph":"12", "gust":"20", "temp":"71.3", "seq":"41"}
+
+or, once the receiver has asked for it with the @B@ command, as a binary frame
+
+    0xA5 | len | type | payload (len bytes) | crc16
+
+len counts the payload only, crc16 is CRC-CCITT (poly 0x1021, init 0xFFFF,
+the same as binascii.crc_hqx) over len, type and payload, little endian like
+every other field. A sample (type 1) payload is <HHhHI: mph, gust, the
+temperature in 1/10 degree F, the sequence number and the station's millis()
+when it was taken, 17 bytes on the air instead of about 66 for the JSON
+datagram (where millis() is "ms"). Decoding into sample objects is in
+samples.py, the receiver lines millis() up with its own clock in clock.py.
+
+seq counts the datagrams the station has sent, 16 bits wrapping, so the
+receiver can tell lost frames from repeated ones. Firmware from before
+sequence numbers sends no seq (and a 6 byte sample payload), that still works,
+it just can't be checked, and firmware from before millis() was added sends 8
+bytes and is timed by when its frames arrive.
+
+With @P@ the station also sends the raw hall sensor pulses (type 2), the
+micros() time of every magnet pass, so the receiver can work out the speed
+itself (see pulses.py). The payload is <HI, the index of the first pulse
+(16 bits wrapping, to spot lost frames) and micros() when the frame was sent,
+then for n > 0 pulses <I, micros() of the first, and n - 1 three byte
+deltas to the next. The station buffers up to 32 pulses, sends them whenever
+the buffer is full and before every sample, so a sample's pulses are always
+there first. An empty pulse frame still tells the receiver the station's time.
+@P@ turns on binary frames as well, @J@ turns both off.
+
+The station keeps its last 300 samples (5 minutes) whether or not anyone is
+connected, seq counts them all. @F<seq>@ asks for the ones after seq (@F@ for
+every one) and they come back in backfill frames (type 3) between the live
+ones: <HI, the seq of the first sample and millis() when the frame was sent,
+then up to 31 samples of <IBBh, millis() when it was taken, mph, gust (capped
+at 255) and the temperature in 1/10 degree F. The times are the station's own,
+the receiver places them against its clock with the millis() of the frame.
+
+JSON stays the fallback, firmware that doesn't know @B@ ignores it and keeps
+sending JSON, @J@ switches back, and the station drops back to JSON on its own
+whenever the bluetooth link goes down. The framing layer accepts both formats
+at any time so nothing has to be negotiated in lock step.
+
+'''
+import binascii
+import struct
+
+sync = 0xA5
+headerFmt = struct.Struct('<BBB') # sync, payload length, type
+crcFmt = struct.Struct('<H')
+frameOverhead = headerFmt.size + crcFmt.size
+
+typeSample = 1
+sampleFmt = struct.Struct('<HHh') # mph, gust, temperature x10
+seqFmt = struct.Struct('<H')        # follows the sample fields
+timeFmt = struct.Struct('<I')       # follows seq, the station's millis()
+
+typePulses = 2
+pulseHeadFmt = struct.Struct('<HI') # index of the first pulse, station micros() when sent
+pulseTimeFmt = struct.Struct('<I')  # micros() of the first pulse, followed by 3 byte deltas
+pulseDelta = 3
+
+typeBackfill = 3
+backfillHeadFmt = struct.Struct('<HI')   # seq of the first sample, station millis() when sent
+backfillRecordFmt = struct.Struct('<IBBh') # millis() when taken, mph, gust, temperature x10
+backfillMax = 31 # samples per frame, as many as fit in a 255 byte payload
+
+binaryCmd = "@B@" # ask the station for binary frames
+jsonCmd = "@J@"   # ask the station for json datagrams
+pulseCmd = "@P@"  # ask the station for pulse frames as well
+
+# what to send when a link comes up, old firmware ignores @B@ and @P@ and sends json
+def connectCmd(protocol, pulses=False):
+    if protocol != "binary":
+        return jsonCmd
+    return binaryCmd + pulseCmd if pulses else binaryCmd
+
+# ask for the samples the station kept after seq, all of them for None
+def backfillCmd(after=None):
+    return "@F@" if after is None else "@F%d@" % after
+
+# crc of a complete binary frame's len, type and payload bytes
+def crc(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+# build a binary frame
+def encode(kind, payload):
+    body = bytes((len(payload), kind)) + payload
+    return bytes((sync,)) + body + crcFmt.pack(crc(body))
@@ -0,0 +1,175 @@
+'''
+
+btwind pulse timing
+
+The firmware's wind() works out the speed from one revolution in integer
+maths, rpm = 60000 / ms and mph = rpm / 6, so a reading is a whole number,
+carries the noise of a single revolution and assumes the cups turn once per
+10 mph of wind. In pulse mode (@P@, see protocol.py) the station sends the
+micros() time of every magnet pass instead, and pulseEstimator works the speed
+out on the receiver:
+
+    a calibration curve from revolutions per second to mph, linear between
+    the points given and carried on past the last one, in place of the / 6
+    speed, the mean over the last smooth seconds (whole revolutions, so not
+    quantised), falling as the time since the last pulse grows and 0 after
+    10 seconds without one like the firmware
+    gust3, the highest 3 second mean (the WMO gust) in the windows ending
+    since the last sample
+    variance of the per revolution speeds since the last sample
+
+Each of these is a handful of numpy operations over the pulses of the last
+few seconds, done once per sample, which fills in sample.speed, sample.gust3
+and sample.variance. Times are the station's own micros(), unwrapped every
+71 minutes, so link delays don't affect them. A lost pulse frame (the pulse
+index skips) starts the history over rather than making up a long revolution.
+
+numpy is only imported when pulse mode is turned on:
+
+    [Pulses]
+    enabled = 1
+    calibration = 0:0, 1:10     rev/s:mph points, this is the firmware's / 6
+    smooth = 3                  seconds the speed is averaged over
+    gust = 3                    seconds of the gust window
+
+'''
+import logging
+
+from .config import defaults as settingDefaults
+from .protocol import pulseHeadFmt, pulseTimeFmt, pulseDelta
+
+log = logging.getLogger(__name__)
+defaults = settingDefaults["Pulses"]
+
+idle = 10.0   # seconds without a pulse before the cups count as stopped, the firmware's 10000 ms
+wrap = 1 << 32 # micros() wraps here
+
+np = None
+
+# numpy, imported the first time pulse timing is used
+def numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+# "0:0, 1:10" to [(0.0, 0.0), (1.0, 10.0)]
+def parseCalibration(text):
+    points = []
+    for item in text.split(','):
+        rps, _, mph = item.partition(':')
+        points.append((float(rps), float(mph)))
+    if len(points) < 2:
+        raise ValueError(f"Calibration needs at least two rev/s:mph points, got {text!r}")
+    return sorted(points)
+
+# Revolutions per second to mph
+class calibration:
+    def __init__(self, points=((0.0, 0.0), (1.0, 10.0))):
+        np = numpy()
+        points = sorted(points)
+        self.rps = np.array([p[0] for p in points], dtype=float)
+        self.mph = np.array([p[1] for p in points], dtype=float)
+        self.slope = (self.mph[-1] - self.mph[-2]) / (self.rps[-1] - self.rps[-2]) # carried on past the last point
+
+    def __call__(self, rps):
+        np = numpy()
+        mph = np.interp(rps, self.rps, self.mph)
+        return np.where(rps > self.rps[-1], self.mph[-1] + (rps - self.rps[-1]) * self.slope, mph)
+
+# Pulse frames in, speed, gust and variance for each sample out
+class pulseEstimator:
+    def __init__(self, cal=None, smooth=3.0, gustWindow=3.0):
+        np = numpy()
+        self.cal = cal or calibration()
+        self.smooth = smooth
+        self.gustWindow = gustWindow
+        self.history = max(smooth, gustWindow) * 2 + idle # seconds of pulses kept
+        self.times = np.empty(0) # station time of each pulse in the history, seconds
+        self.now = None          # station micros() of the last frame, unwrapped
+        self.nextIndex = None    # index the next pulse frame should start at
+        self.lastSample = None   # station time of the last annotate(), seconds
+
+        # counters
+        self.pulses = 0
+        self.frames = 0
+        self.lost = 0 # pulses the indexes say never arrived
+
+    @classmethod
+    def fromConfig(cls, config):
+        get = lambda key: config.get('Pulses', key, fallback=defaults.get(key))
+        return cls(calibration(parseCalibration(get('calibration'))), float(get('smooth')), float(get('gust')))
+
+    # a complete pulse frame (type 2)
+    def feed(self, frame):
+        np = numpy()
+        size = frame[1]
+        if size < pulseHeadFmt.size or (size > pulseHeadFmt.size and (size - pulseHeadFmt.size - pulseTimeFmt.size) % pulseDelta):
+            raise ValueError(f"Pulse frame payload is {size} bytes")
+        index, sent = pulseHeadFmt.unpack_from(frame, 3)
+        # the station's time, carried on from the last frame across micros() wrapping
+        self.now = sent if self.now is None else self.now + ((sent - self.now) % wrap)
+        self.frames += 1
+        if size == pulseHeadFmt.size:
+            return
+        first, = pulseTimeFmt.unpack_from(frame, 3 + pulseHeadFmt.size)
+        deltas = np.frombuffer(frame, dtype=np.uint8, offset=3 + pulseHeadFmt.size + pulseTimeFmt.size,
+            count=size - pulseHeadFmt.size - pulseTimeFmt.size).reshape(-1, pulseDelta).astype(np.int64)
+        us = np.empty(len(deltas) + 1, dtype=np.int64)
+        us[0] = self.now - ((sent - first) % wrap) # every pulse in a frame came before it was sent
+        us[1:] = us[0] + np.cumsum(deltas[:, 0] | deltas[:, 1] << 8 | deltas[:, 2] << 16)
+        if self.nextIndex is not None and index != self.nextIndex:
+            self.lost += (index - self.nextIndex) & 0xFFFF
+            self.times = self.times[:0] # the gap isn't a revolution, start over from here
+        self.nextIndex = (index + len(us)) & 0xFFFF
+        self.pulses += len(us)
+        times = np.concatenate((self.times, us / 1e6))
+        keep = np.searchsorted(times, self.now / 1e6 - self.history)
+        self.times = times[min(keep, max(0, len(times) - 2)):] # the last revolution is always kept
+
+    # fill in m.speed, m.gust3 and m.variance from the pulses up to now
+    def annotate(self, m):
+        if self.now is None:
+            return
+        np = numpy()
+        now = self.now / 1e6
+        since = now - self.lastSample if self.lastSample is not None else self.smooth
+        self.lastSample = now
+        t = self.times
+        if len(t) < 2 or now - t[-1] > idle:
+            m.speed = m.gust3 = m.variance = 0.0
+            return
+        dt = np.diff(t)
+        mph = self.cal(1 / dt)                                 # speed of each revolution, ending at t[1:]
+        distance = np.concatenate(([0.0], np.cumsum(mph * dt))) # mph seconds travelled up to each pulse
+
+        k = np.searchsorted(t, now - self.smooth)
+        if k < len(t) - 1: # whole revolutions inside the smoothing window
+            speed = (distance[-1] - distance[k]) / (t[-1] - t[k])
+        else:
+            speed = mph[-1]
+        if now - t[-1] > dt[-1]: # the cups are slower than the last revolution, or stopping
+            speed = min(speed, float(self.cal(np.array([1 / (now - t[-1])]))[0]))
+
+        # 3 second means of the windows ending at every pulse since the last sample
+        ends = np.arange(max(1, np.searchsorted(t, now - since, side='right')), len(t))
+        starts = np.searchsorted(t, t[ends] - self.gustWindow)
+        span = t[ends] - t[starts]
+        full = span >= self.gustWindow / 2 # a short history at the start would exaggerate
+        gust = speed
+        if full.any():
+            gust = max(gust, float(((distance[ends] - distance[starts])[full] / span[full]).max()))
+
+        recent = mph[ends - 1] # the revolutions completed since the last sample
+        m.speed = float(speed)
+        m.gust3 = float(gust)
+        m.variance = float(recent.var()) if len(recent) > 1 else 0.0
+
+    # a new connection, the station may have restarted
+    def reset(self):
+        self.times = self.times[:0]
+        self.now = self.nextIndex = self.lastSample = None
+
+    def stats(self):
+        return {"pulses": self.pulses, "pulseFrames": self.frames, "pulsesLost": self.lost}
@@ -0,0 +1,317 @@
+'''
+
+btwind receiver
+
+Puts the core together from the settings: the sinks (sample store, rollups,
+MQTT through the outbox, the metrics endpoint, see channels.py for the
+queue in front of them), the merging of samples a station kept while its
+link was down into storage, and either the thread engine (a supervisor and
+connection thread per station) or the asyncio hub. Both follow the station list
+in the registry, adding and removing stations while running. GUIs and the
+daemon only deal with this class, they get samples through onSample(m) and link
+changes through onState(station, up), both called on the receive thread (thread
+engine) or on the event loop (asyncio engine). A lost link also writes the
+recent log records out as a post-mortem (see logs.py).
+
+'''
+import logging
+import threading
+
+from . import logs
+from .channels import normal
+from .registry import stationRegistry
+
+log = logging.getLogger(__name__)
+
+class receiver:
+    def __init__(self, config, path="btwindrx.ini", onSample=None, onState=None):
+        self.config = config
+        self.onSample = onSample
+        self.onState = onState
+        self.engine = config.get('General', 'engine', fallback='thread')
+        self.registry = stationRegistry(path, config.get('General', 'address', fallback=None))
+        self.registry.load()
+        self.sinks = []
+        self.buildSinks()
+        self.queueSinks(config.getint('General', 'sinkqueue', fallback=1000))
+        limit = config.getfloat('General', 'retrymax', fallback=60) # longest wait between attempts in sec
+        retries = config.getint('General', 'retries', fallback=0) # give up after this many failures, 0 = never
+        self.enabled = config.getboolean('General', 'connection', fallback=True) # auto connect setting
+        protocol = config.get('General', 'protocol', fallback='binary') # binary frames, or json datagrams only
+        record = config.get('General', 'record', fallback='') # replay file of the raw link, {station} allowed
+        cadence = config.getfloat('General', 'cadence', fallback=1.0) # the station's dataUpdateInterval in sec
+        self.pulses = self.pulseMode() # pulse estimator factory, None unless [Pulses] is enabled
+        self.cadence = cadence
+        backfill = self.backfillMode() # takes backfilled samples, None unless there is storage to merge them into
+        self.task = None
+        self.stopping = False # links closed by stop() are not a loss
+        if self.engine == 'asyncio':
+            from .stations import stationHub
+            self.hub = stationHub(self.registry, onSample=onSample, onState=self.stateChanged, sinks=self.sinks,
+                limit=limit, retries=retries, protocol=protocol, record=record, cadence=cadence, pulses=self.pulses,
+                backfill=backfill)
+        else:
+            self.watcherArgs = dict(onSample=onSample, onState=self.stateChanged, sinks=self.sinks, limit=limit,
+                retries=retries, protocol=protocol, record=record, cadence=cadence, pulses=self.pulses, backfill=backfill)
+            stations = self.registry.stations or {self.station(): ''}
+            self.watchers = {name: self.makeWatcher(name, address) for name, address in stations.items()}
+            self.poll = 5.0 # seconds between checks of the settings file, as the hub does
+            self.follower = threading.Thread(target=self.followRegistry, name="registry", daemon=True)
+            self.following = threading.Event() # set to stop following
+
+    def makeWatcher(self, name, address):
+        from .connection import connectionSupervisor
+        return connectionSupervisor(name, address, enabled=self.enabled, **self.watcherArgs)
+
+    # thread engine, re-read the registry every poll seconds and apply changes to the station list
+    def followRegistry(self):
+        while not self.following.wait(self.poll):
+            try:
+                if self.registry.load():
+                    self.syncWatchers(self.registry.stations)
+            except Exception:
+                log.exception("Applying the station list failed")
+
+    # stop supervisors for removed or changed stations and start new ones, like stationHub.sync
+    def syncWatchers(self, stations):
+        watchers = dict(self.watchers) # replaced whole, other threads iterate over the old one
+        for name in list(watchers):
+            if stations.get(name) != watchers[name].address:
+                log.info("Removing station %s", name)
+                watcher = watchers.pop(name)
+                watcher.stop()
+                watcher.join()
+        for name, address in stations.items():
+            if name in watchers:
+                continue
+            log.info("Adding station %s at %s", name, address)
+            watchers[name] = self.makeWatcher(name, address)
+            watchers[name].start()
+        self.watchers = watchers
+
+    def stateChanged(self, station, up):
+        if not up and not self.stopping:
+            path = logs.dump(station, "connection lost")
+            if path:
+                log.info("Wrote the recent log to %s", path)
+        if self.onState:
+            self.onState(station, up)
+
+    def buildSinks(self):
+        c = self.config
+        if c.getboolean('Metrics', 'enabled', fallback=False):
+            from .metrics import metricsServer
+            try:
+                self.metrics = metricsServer.fromConfig(c, self.stats)
+                self.sinks.append(self.metrics.put)
+            except OSError as e: # port in use, the receiver runs without it
+                log.error("Metrics endpoint is disabled: %s", e)
+        if c.getboolean('Analytics', 'enabled', fallback=True):
+            from .analytics import windAnalytics
+            self.analytics = windAnalytics.fromConfig(c) # sustained wind, gust factor etc for the metrics page
+            self.sinks.append(self.analytics.put)
+        if c.getboolean('Storage', 'enabled', fallback=True):
+            from .ringstore import sampleStore
+            from .rollups import rollupStore
+            self.store = sampleStore(c.get('Storage', 'path', fallback='data'), c.getfloat('Storage', 'days', fallback=14))
+            self.rollups = rollupStore(c.get('Storage', 'path', fallback='data')) # 1 sec to 1 day summaries next to the samples
+            self.sinks += [self.store.put, self.rollups.put]
+        if c.getboolean('MQTT', 'enabled', fallback=False):
+            try:
+                from .mqttsink import mqttSink
+                self.mqtt = mqttSink.fromConfig(c)
+            except ImportError as e:
+                log.error("MQTT publishing is disabled: %s", e)
+                return
+            if c.getboolean('Outbox', 'enabled', fallback=True):
+                from .outbox import outbox
+                # samples are logged to disk first and replayed to the broker if it goes away
+                self.outbox = outbox(c.get('Outbox', 'path', fallback='outbox'), self.mqtt,
+                    maxBytes=int(c.getfloat('Outbox', 'maxmb', fallback=50) * 1024 * 1024),
+                    batch=c.getint('Outbox', 'batch', fallback=200),
+                    replayRate=c.getfloat('Outbox', 'replayrate', fallback=100))
+                self.sinks.append(self.outbox.put)
+            else:
+                self.sinks.append(self.mqtt.put)
+
+    # ask stations for their raw pulse times and work out the speed here (see pulses.py), needs numpy
+    def pulseMode(self):
+        if not self.config.getboolean('Pulses', 'enabled', fallback=False):
+            return None
+        try:
+            from .pulses import pulseEstimator, numpy
+            numpy()
+            pulseEstimator.fromConfig(self.config) # settings errors show up now rather than on connect
+        except (ImportError, ValueError) as e:
+            log.error("Pulse mode is disabled: %s", e)
+            return None
+        return lambda: pulseEstimator.fromConfig(self.config)
+
+    # ask stations on connect for the samples they kept while the link was down (see protocol.py) and merge them
+    # into storage in time order on a thread of their own, so a backfill never holds up the live samples
+    def backfillMode(self):
+        if not self.config.getboolean('General', 'backfill', fallback=True) or not hasattr(self, 'store'):
+            return None
+        from .channels import sinkQueue
+        self.backfillQueue = sinkQueue([self.mergeBackfill], 64, batch=1, name="backfill") # a frame's samples per item
+        self.backfillMerged = 0
+        self.backfillSkipped = 0 # already stored
+        return self.backfillQueue.putAsync if self.engine == 'asyncio' else self.backfillQueue.put
+
+    def mergeBackfill(self, samples):
+        added = self.store.merge(samples, self.cadence / 2) # within half an update of a stored one is the same sample
+        for m in added:
+            self.rollups.put(m) # into the written rows of their periods, see rollups.py
+        self.backfillMerged += len(added)
+        self.backfillSkipped += len(samples) - len(added)
+        log.debug("Backfill from %s: %d samples, %d new", samples[0].station, len(samples), len(added))
+
+    # run the storage and outbox sinks on a thread of their own behind a bounded queue of this many samples.
+    # The receive path only waits on them once it's full, nothing is dropped
+    def queueSinks(self, size):
+        fast = [getattr(self, name).put for name in ('metrics', 'analytics') if hasattr(self, name)]
+        slow = [s for s in self.sinks if s not in fast]
+        if size <= 0 or not slow:
+            return
+        from .channels import sinkQueue
+        self.sinkQueue = sinkQueue(slow, size)
+        self.sinks = [s for s in self.sinks if s not in slow]
+        self.sinks.append(self.sinkQueue.putAsync if self.engine == 'asyncio' else self.sinkQueue.put)
+
+    # name of the station shown by a single station display, General/station or the first one
+    def station(self):
+        return self.registry.primary(self.config.get('General', 'station', fallback=''))
+
+    # start the sinks and the engine, the asyncio engine needs to be started from the running loop
+    def start(self):
+        if hasattr(self, 'metrics'):
+            self.metrics.start()
+        if hasattr(self, 'mqtt'):
+            self.mqtt.start()
+        if hasattr(self, 'outbox'):
+            self.outbox.start()
+        if hasattr(self, 'sinkQueue'):
+            self.sinkQueue.start()
+        if hasattr(self, 'backfillQueue'):
+            self.backfillQueue.start()
+        if hasattr(self, 'watchers'):
+            for watcher in self.watchers.values():
+                watcher.start()
+            self.follower.start()
+        elif self.enabled:
+            self.startHub()
+
+    def startHub(self):
+        import asyncio
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.hub.run())
+
+    # turn the connection on or off (the connection setting)
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if hasattr(self, 'watchers'):
+            for watcher in self.watchers.values():
+                watcher.setEnabled(enabled)
+        elif enabled:
+            self.startHub()
+        elif self.task:
+            self.task.cancel()
+
+    def configure(self, limit=None, retries=None):
+        if hasattr(self, 'hub'):
+            self.hub.configure(limit, retries)
+            return
+        if limit is not None:
+            self.watcherArgs['limit'] = limit
+        if retries is not None:
+            self.watcherArgs['retries'] = retries
+        for watcher in self.watchers.values():
+            if limit is not None:
+                watcher.backoff.limit = limit
+            if retries is not None:
+                watcher.maxRetries = retries
+
+    # switch every station between binary frames and json, now and on future connections
+    def setProtocol(self, protocol):
+        from .protocol import connectCmd
+        cmd = connectCmd(protocol, self.pulses is not None)
+        if hasattr(self, 'hub'):
+            self.hub.protocol = protocol
+            for engine in self.hub.engines.values():
+                engine.protocol = protocol
+                engine.send(cmd)
+        else:
+            self.watcherArgs['protocol'] = protocol
+            for watcher in self.watchers.values():
+                watcher.protocol = protocol
+                watcher.send(cmd)
+
+    # the linkHealth of a station, the displayed one by default, None if it isn't running
+    def health(self, station=None):
+        if hasattr(self, 'hub'):
+            engine = self.hub.engines.get(station or self.station())
+            return engine.health if engine else None
+        watcher = self.watchers.get(station or self.station())
+        return watcher.health if watcher else None
+
+    # send a command to a station, the displayed one by default
+    def send(self, cmd, station=None, level=normal):
+        if hasattr(self, 'hub'):
+            self.hub.send(station or self.station(), cmd, level)
+        else:
+            watcher = self.watchers.get(station or self.station())
+            if watcher:
+                watcher.send(cmd, level)
+
+    # stop the engine, then flush and close the sinks
+    def stop(self):
+        self.stopping = True
+        if hasattr(self, 'watchers'):
+            self.following.set()
+            if self.follower.is_alive():
+                self.follower.join() # no station is added after this
+            for watcher in self.watchers.values():
+                watcher.stop() # the watcher stops its connection thread on the way out
+            for watcher in self.watchers.values():
+                if watcher.is_alive():
+                    watcher.join() # wait for the connection thread to finish writing
+        elif self.task:
+            self.task.cancel() # closes every station connection, no sink is called after this
+        if hasattr(self, 'sinkQueue'):
+            self.sinkQueue.stop()
+            if self.sinkQueue.is_alive():
+                self.sinkQueue.join() # the samples still queued go to the sinks before they close
+        if hasattr(self, 'backfillQueue'):
+            self.backfillQueue.stop()
+            if self.backfillQueue.is_alive():
+                self.backfillQueue.join()
+        if hasattr(self, 'outbox'):
+            self.outbox.stop()
+            self.outbox.join() # let it fsync and save its state
+        if hasattr(self, 'mqtt'):
+            self.mqtt.stop()
+        if hasattr(self, 'store'):
+            self.store.close()
+            self.rollups.close() # writes the open buckets so a restart picks them up
+        if hasattr(self, 'metrics'):
+            self.metrics.stop()
+
+    def stats(self):
+        stats = {"engine": self.engine}
+        if hasattr(self, 'hub'):
+            stats["stations"] = self.hub.stats()
+        else:
+            stats["stations"] = {name: watcher.stats() for name, watcher in self.watchers.items()}
+        if hasattr(self, 'mqtt'):
+            stats["mqtt"] = self.mqtt.stats()
+        if hasattr(self, 'outbox'):
+            stats["outbox"] = self.outbox.stats()
+        if hasattr(self, 'sinkQueue'):
+            stats["sinkqueue"] = self.sinkQueue.stats()
+        if hasattr(self, 'analytics'):
+            stats["analytics"] = self.analytics.stats()
+        if hasattr(self, 'backfillQueue'):
+            stats["backfill"] = self.backfillQueue.stats()
+            stats["backfill"].update(merged=self.backfillMerged, skipped=self.backfillSkipped)
+            stats["backfill"].update(self.rollups.stats())
+        return stats
@@ -0,0 +1,55 @@
+'''
+
+btwind station registry
+
+Stations are listed in the [Stations] section of btwindrx.ini as name = address,
+where address is a bluetooth MAC for RFCOMM, host:port for TCP or any of the
+transport addresses in transports.py:
+
+    [Stations]
+    backyard = 00:18:E4:0C:68:00
+    dock = 00:18:E4:0C:68:01
+    bench = serial:///dev/ttyACM0
+
+With no [Stations] entries the single [General] address is used as station "default".
+
+'''
+import configparser
+import os
+
+# Reads the station list from the settings file and notices when it changes
+class stationRegistry:
+    def __init__(self, path="btwindrx.ini", address=None):
+        self.path = path
+        self.address = address # used for station "default" when the file has no address at all
+        self.mtime = None
+        self.stations = {} # name: address, in file order
+
+    # re-read the file, returns True if it changed since the last load
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime and self.stations:
+            return False
+        self.mtime = mtime
+        config = configparser.ConfigParser()
+        config.read(self.path)
+        stations = {}
+        if config.has_section('Stations'):
+            for name, address in config.items('Stations'):
+                if address.strip():
+                    stations[name] = address.strip()
+        if not stations:
+            address = config.get('General', 'address', fallback=self.address)
+            if address:
+                stations['default'] = address
+        self.stations = stations
+        return True
+
+    # the station shown in a single station display, the named one if it exists or the first
+    def primary(self, name=''):
+        if name in self.stations:
+            return name
+        return next(iter(self.stations), None)
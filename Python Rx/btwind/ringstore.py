@@ -0,0 +1,286 @@
+'''
+
+btwind sample storage
+
+A fixed size ring of packed fixed size records in a memory mapped file. Appends
+are O(1) and once the ring is full the oldest record is overwritten. Readers get
+memoryview slices straight over the map (views()), which numpy can wrap without
+copying: numpy.frombuffer(view, dtype=sampleRing.dtype).
+
+File layout: a 128 byte header holding the record format and two copies of the
+ring state (head, count) each with a generation number and crc. Every append
+writes the record first and then the older state copy, so whichever copy is valid
+with the highest generation always describes complete records and a crash at any
+point leaves the ring readable. flush() pushes the map to disk (the sample store
+does it every few seconds) which covers power loss as well as a process crash.
+
+A sample record is 8 bytes, time in 1/10 sec since the file's epoch, mph, gust
+and temperature in 1/10 degree, so a week of 1 Hz samples takes under 5 MB.
+Records are kept in time order, samples that arrive late (a station's backfill)
+are merged in: the newer records and the late ones are written back in order
+over the end of the ring. That change goes to a journal next to the file
+(<file>.journal, with a crc) and is synced before the ring is touched, then
+the records are written and the state committed once. A ring opened with a
+valid journal still there finishes the merge first, so a crash mid merge
+loses nothing.
+
+'''
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+headerFmt = struct.Struct('<4sHHId') # magic, version, record size, capacity, epoch
+stateFmt = struct.Struct('<QII')     # generation, head, count
+crcFmt = struct.Struct('<I')
+journalFmt = struct.Struct('<IIII') # first slot, head, count, bytes of records, then the records and a crc
+stateOffsets = (32, 64)
+dataOffset = 128
+magic = b'BTWR'
+version = 1
+
+# A ring of fixed size records in a memory mapped file
+class ringFile:
+    def __init__(self, path, recordSize, capacity, epoch=None):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) >= dataOffset
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if exists:
+            head = os.pread(self.fd, headerFmt.size, 0)
+            m, v, self.recordSize, self.capacity, self.epoch = headerFmt.unpack(head)
+            if m != magic or v != version or self.recordSize != recordSize:
+                os.close(self.fd)
+                raise ValueError(f"{path} is not a btwind ring file with {recordSize} byte records")
+        else:
+            self.recordSize, self.capacity = recordSize, capacity
+            self.epoch = float(int(time.time() if epoch is None else epoch))
+        size = dataOffset + self.recordSize * self.capacity
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.data = memoryview(self.map)[dataOffset:]
+        if exists:
+            self.gen, self.head, self.count = self.loadState()
+        else:
+            headerFmt.pack_into(self.map, 0, magic, version, self.recordSize, self.capacity, self.epoch)
+            self.gen, self.head, self.count = 0, 0, 0
+            self.saveState()
+            self.saveState() # both copies valid
+        self.recover()
+
+    # pick the valid state copy with the highest generation
+    def loadState(self):
+        best = (0, 0, 0)
+        for off in stateOffsets:
+            raw = bytes(self.map[off:off + stateFmt.size])
+            crc, = crcFmt.unpack_from(self.map, off + stateFmt.size)
+            if zlib.crc32(raw) == crc:
+                state = stateFmt.unpack(raw)
+                if state[0] >= best[0]:
+                    best = state
+        return best
+
+    # write the state into the copy not holding the current generation
+    def saveState(self):
+        self.gen += 1
+        off = stateOffsets[self.gen & 1]
+        stateFmt.pack_into(self.map, off, self.gen, self.head, self.count)
+        crcFmt.pack_into(self.map, off + stateFmt.size, zlib.crc32(self.map[off:off + stateFmt.size]))
+
+    # append one record (bytes or a packing function writing into the map at an offset)
+    def append(self, pack, *values):
+        if self.count == self.capacity: # full, give up the oldest record before overwriting it
+            self.count -= 1
+            self.saveState()
+        pack(self.data, self.head * self.recordSize, *values)
+        self.head = (self.head + 1) % self.capacity
+        self.count += 1
+        self.saveState()
+
+    # replace the newest n records with records (bytes of whole records), the oldest go once it's over capacity.
+    # Journaled so a crash leaves either the old records or the new ones, returns how many of the new records
+    # didn't fit, those are left off the front
+    def replaceTail(self, n, records):
+        rs = self.recordSize
+        total = len(records) // rs
+        lost = max(0, total - self.capacity)
+        records = records[lost * rs:]
+        start = (self.head - n + lost) % self.capacity
+        head = (start + total - lost) % self.capacity
+        count = min(self.capacity, self.count - n + total - lost)
+        entry = journalFmt.pack(start, head, count, len(records)) + records
+        fd = os.open(self.path + '.journal', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, entry + crcFmt.pack(zlib.crc32(entry)))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.applyJournal(start, head, count, records)
+        return lost
+
+    def applyJournal(self, start, head, count, records):
+        rs = self.recordSize
+        first = min(len(records), (self.capacity - start) * rs) # up to the end of the map, the rest wraps
+        self.data[start * rs:start * rs + first] = records[:first]
+        self.data[:len(records) - first] = records[first:]
+        self.head, self.count = head, count
+        self.saveState()
+        self.flush()
+        os.unlink(self.path + '.journal')
+
+    # finish a merge a crash interrupted, a journal that didn't get written completely is thrown away
+    def recover(self):
+        try:
+            with open(self.path + '.journal', 'rb') as f:
+                entry = f.read()
+        except FileNotFoundError:
+            return
+        body = entry[:-crcFmt.size]
+        if len(entry) >= journalFmt.size + crcFmt.size and zlib.crc32(body) == crcFmt.unpack(entry[-crcFmt.size:])[0]:
+            start, head, count, size = journalFmt.unpack_from(body)
+            if size == len(body) - journalFmt.size:
+                self.applyJournal(start, head, count, body[journalFmt.size:])
+                return
+        os.unlink(self.path + '.journal')
+
+    # remove and return the newest record as a memoryview slice (valid until the next append)
+    def pop(self):
+        if not self.count:
+            return None
+        self.head = (self.head - 1) % self.capacity
+        self.count -= 1
+        self.saveState()
+        return self.data[self.head * self.recordSize:(self.head + 1) * self.recordSize]
+
+    # the i'th record oldest first as a memoryview slice
+    def at(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        j = (self.head - self.count + i) % self.capacity
+        return self.data[j * self.recordSize:(j + 1) * self.recordSize]
+
+    def __len__(self):
+        return self.count
+
+    # memoryview slices covering the records oldest first, one slice or two if the ring has wrapped
+    def views(self):
+        rs = self.recordSize
+        start = (self.head - self.count) % self.capacity
+        if start + self.count <= self.capacity:
+            return [self.data[start * rs:(start + self.count) * rs]]
+        return [self.data[start * rs:], self.data[:self.head * rs]]
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.data.release()
+        self.map.close()
+        os.close(self.fd)
+
+# Samples stored as (time, mph, gust, temperature) in a ringFile
+class sampleRing(ringFile):
+    record = struct.Struct('<IBBh') # time in 1/10 sec since epoch, mph, gust, temp in 1/10 degree
+    dtype = [('t', '<u4'), ('mph', 'u1'), ('gust', 'u1'), ('temp', '<i2')] # numpy dtype spec of a record
+
+    def __init__(self, path, capacity=14 * 86400, epoch=None):
+        super(sampleRing, self).__init__(path, self.record.size, capacity, epoch)
+
+    # t is unix time in seconds, values outside the record's range are clamped
+    def add(self, t, mph, gust, temp):
+        self.append(self.record.pack_into, *self.raw(t, mph, gust, temp))
+
+    # the record fields for a sample
+    def raw(self, t, mph, gust, temp):
+        return (max(0, int((t - self.epoch) * 10)), min(max(mph, 0), 255), min(max(gust, 0), 255),
+            min(max(round(temp * 10), -32768), 32767))
+
+    # add (t, mph, gust, temp) rows that may be older than the newest records, keeping the ring in time order.
+    # A row within tolerance sec of a stored record (or an earlier row) is taken as already stored and skipped,
+    # returns the indexes of the rows added that are in the ring afterwards
+    def merge(self, rows, tolerance=0.5):
+        new = sorted((self.raw(*row), i) for i, row in enumerate(rows))
+        if not new:
+            return []
+        gap = tolerance * 10
+        n = 0 # stored records from just before the oldest row on
+        while n < self.count and self.record.unpack_from(self.at(-1 - n))[0] >= new[0][0][0] - gap:
+            n += 1
+        tail = [(self.record.unpack(self.at(k)), None) for k in range(self.count - n, self.count)]
+        times = [r[0] for r, i in tail]
+        added = 0
+        for r, i in new:
+            k = bisect.bisect_left(times, r[0] - gap)
+            if k < len(times) and times[k] <= r[0] + gap:
+                continue
+            bisect.insort(times, r[0])
+            tail.append((r, i))
+            added += 1
+        if not added:
+            return []
+        tail.sort(key=lambda e: e[0][0]) # stable, stored records stay ahead of new ones at the same time
+        self.replaceTail(n, b''.join(self.record.pack(*r) for r, i in tail))
+        kept = tail[max(0, len(tail) - self.count):] # a full ring gives up its oldest, maybe the front of the tail
+        return sorted(i for r, i in kept if i is not None)
+
+    # decoded samples oldest first as (unix time, mph, gust, temp)
+    def samples(self):
+        epoch = self.epoch
+        for view in self.views():
+            for t, mph, gust, temp in self.record.iter_unpack(view):
+                yield epoch + t / 10, mph, gust, temp / 10
+
+    def latest(self):
+        if not self.count:
+            return None
+        rs = self.recordSize
+        i = (self.head - 1) % self.capacity
+        t, mph, gust, temp = self.record.unpack_from(self.data, i * rs)
+        return self.epoch + t / 10, mph, gust, temp / 10
+
+# Keeps one sampleRing per station in a directory, takes samples from the receive path
+class sampleStore:
+    def __init__(self, path="data", days=14, flushEvery=5.0):
+        self.path = path
+        self.capacity = int(days * 86400)
+        self.flushEvery = flushEvery
+        self.rings = {} # station name: sampleRing
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+        os.makedirs(path, exist_ok=True)
+
+    def ring(self, station):
+        if station not in self.rings:
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', station)
+            self.rings[station] = sampleRing(os.path.join(self.path, name + '.ring'), self.capacity)
+        return self.rings[station]
+
+    # late samples for one station, see sampleRing.merge, returns the ones added
+    def merge(self, samples, tolerance=0.5):
+        if not samples:
+            return []
+        with self.lock:
+            added = self.ring(samples[0].station).merge([(m.time, m.mph, m.gust, m.temp) for m in samples], tolerance)
+        return [samples[i] for i in added]
+
+    # sink interface, m is a samples.sample stored under m.station at m.time
+    def put(self, m):
+        with self.lock:
+            self.ring(m.station).add(m.time, m.mph, m.gust, m.temp)
+            if time.time() - self.lastFlush > self.flushEvery:
+                for ring in self.rings.values():
+                    ring.flush()
+                self.lastFlush = time.time()
+
+    def close(self):
+        with self.lock:
+            for ring in self.rings.values():
+                ring.flush()
+                ring.close()
+            self.rings.clear()
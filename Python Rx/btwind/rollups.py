@@ -0,0 +1,256 @@
+'''
+
+btwind rollups
+
+Keeps running summaries of the sample stream at 1 sec, 1 min, 1 hour and 1 day
+resolution. Each sample updates the open bucket of every tier in constant time,
+when a bucket's period ends it is written as one fixed size row to that tier's
+ring file next to the raw samples (data/<station>.<seconds>.roll). A month of
+history is then 720 hourly rows instead of millions of samples.
+
+A row holds the bucket start (unix time), sample count, mph min/max/mean,
+peak gust, temperature low/high/mean and the lowest feels like temperature
+(see derived.py, None in rows written before it was kept). Day buckets follow
+local midnight.
+
+A sample from a period whose row is already written (a station's backfill) is
+added to that row in place, or dropped for that tier if the period has no row
+(nothing was received in it), it never goes into the open bucket.
+
+Values are clamped to what a row holds, like the sample ring does, and a row
+is packed before the ring drops its oldest one for it.
+
+'''
+import bisect
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from .ringstore import ringFile
+
+log = logging.getLogger(__name__)
+
+tiers = ((1, 2 * 86400), (60, 366 * 1440), (3600, 10 * 8760), (86400, 100 * 366)) # (seconds, rows kept)
+
+# One tier's rows in a ring file
+class rollupRing(ringFile):
+    # start, count, mph min, max, mean, gust, temp lo, hi (1/10 deg), mean, feels like lo (whole deg + 128, 0 = none)
+    record = struct.Struct('<IIBBfBhhfB')
+    dtype = [('start', '<u4'), ('count', '<u4'), ('mphMin', 'u1'), ('mphMax', 'u1'), ('mphMean', '<f4'),
+        ('gust', 'u1'), ('tempLo', '<i2'), ('tempHi', '<i2'), ('tempMean', '<f4'), ('feelsLo', 'u1')]
+
+    def __init__(self, path, capacity):
+        super(rollupRing, self).__init__(path, self.record.size, capacity)
+
+    # packed first, a bucket that doesn't fit a row raises struct.error before the ring gives up its oldest row
+    def add(self, b):
+        row = self.pack(b)
+        self.append(copyInto, row)
+
+    # a bucket's row as bytes
+    def pack(self, b):
+        return self.record.pack(b.start, b.count, b.mphMin, b.mphMax, b.mphSum / b.count, b.gust,
+            b.tempLo, b.tempHi, b.tempSum / b.count / 10, packFeels(b.feelsLo))
+
+    # the index of the row starting at start, None if there isn't one
+    def find(self, start):
+        i = bisect.bisect_left(_starts(self), start)
+        return i if i < len(self) and self.startAt(i) == start else None
+
+    def row(self, i):
+        start, count, mphMin, mphMax, mphMean, gust, tempLo, tempHi, tempMean, feels = self.record.unpack(self.at(i))
+        return {"start": start, "count": count, "mphMin": mphMin, "mphMax": mphMax, "mphMean": mphMean,
+            "gust": gust, "tempLo": tempLo / 10, "tempHi": tempHi / 10, "tempMean": tempMean, "feelsLo": unpackFeels(feels)}
+
+    def startAt(self, i):
+        return struct.unpack_from('<I', self.at(i))[0]
+
+    # rows with t0 <= start < t1, found by binary search since rows are in time order
+    def query(self, t0, t1):
+        starts = _starts(self)
+        return [self.row(i) for i in range(bisect.bisect_left(starts, t0), bisect.bisect_left(starts, t1))]
+
+def copyInto(buf, offset, row):
+    buf[offset:offset + len(row)] = row
+
+# the feels like low in the byte that used to be padding, so older files still open
+def packFeels(value):
+    return 0 if value is None else min(255, max(1, round(value) + 128))
+
+def unpackFeels(byte):
+    return None if byte == 0 else byte - 128
+
+# lazy sequence of row start times for bisect
+class _starts:
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.ring)
+
+    def __getitem__(self, i):
+        return self.ring.startAt(i)
+
+# Accumulator for the open bucket of a tier
+class bucket:
+    __slots__ = ('start', 'count', 'mphMin', 'mphMax', 'mphSum', 'gust', 'tempLo', 'tempHi', 'tempSum', 'feelsLo')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.mphMin = 255
+        self.mphMax = 0
+        self.mphSum = 0
+        self.gust = 0
+        self.tempLo = 32767
+        self.tempHi = -32768
+        self.tempSum = 0
+        self.feelsLo = None
+
+    # mph and gust are ints, temp is an int in 1/10 degree, feels is the sample's feelslike or None
+    def add(self, mph, gust, temp, feels=None):
+        self.count += 1
+        self.mphSum += mph
+        if mph < self.mphMin: self.mphMin = mph
+        if mph > self.mphMax: self.mphMax = mph
+        if gust > self.gust: self.gust = gust
+        self.tempSum += temp
+        if temp < self.tempLo: self.tempLo = temp
+        if temp > self.tempHi: self.tempHi = temp
+        if feels is not None and (self.feelsLo is None or feels < self.feelsLo): self.feelsLo = feels
+
+    # reopen a row written by a previous run, so a restart inside a bucket continues it
+    @classmethod
+    def fromRow(cls, row):
+        start, count, mphMin, mphMax, mphMean, gust, tempLo, tempHi, tempMean, feels = rollupRing.record.unpack(row)
+        b = cls(start)
+        b.feelsLo = unpackFeels(feels)
+        b.count, b.mphMin, b.mphMax, b.gust, b.tempLo, b.tempHi = count, mphMin, mphMax, gust, tempLo, tempHi
+        b.mphSum = round(mphMean * count)
+        b.tempSum = round(tempMean * 10 * count)
+        return b
+
+# Rollups for one station, every tier
+class stationRollups:
+    def __init__(self, path, station):
+        self.offset = time.localtime().tm_gmtoff # day buckets start at local midnight
+        self.rings = {}
+        self.open = {} # seconds: bucket
+        self.late = 0        # samples added to a row already written, counted per tier
+        self.lateDropped = 0 # and dropped because their period has no row
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', station)
+        for size, capacity in tiers:
+            ring = rollupRing(os.path.join(path, f"{name}.{size}.roll"), capacity)
+            self.rings[size] = ring
+            if len(ring): # the newest row may be a bucket that was still open at shutdown
+                self.open[size] = bucket.fromRow(ring.pop())
+
+    def start(self, size, t):
+        if size >= 86400:
+            return int((t + self.offset) // size * size - self.offset)
+        return int(t // size * size)
+
+    def add(self, t, mph, gust, temp, feels=None):
+        mph, gust = min(max(int(mph), 0), 255), min(max(int(gust), 0), 255) # what the row's bytes hold
+        temp = min(max(round(temp * 10), -32768), 32767)
+        for size, ring in self.rings.items():
+            start = self.start(size, t)
+            b = self.open.get(size)
+            if b is not None and start < b.start: # from a period already written
+                self.addLate(ring, start, mph, gust, temp, feels)
+                continue
+            if b is None or start > b.start: # period over, write the row and open the next bucket
+                if b is not None and b.count:
+                    self.write(ring, b)
+                b = self.open[size] = bucket(start)
+            b.add(mph, gust, temp, feels)
+
+    # fold a late sample into the written row of its period
+    def addLate(self, ring, start, mph, gust, temp, feels):
+        i = ring.find(start)
+        if i is None:
+            self.lateDropped += 1
+            return
+        b = bucket.fromRow(ring.at(i))
+        b.add(mph, gust, temp, feels)
+        try:
+            row = ring.pack(b)
+        except struct.error as e:
+            log.error("Rollup row for %d in %s left as it was: %s", start, ring.path, e)
+            return
+        copyInto(ring.at(i), 0, row)
+        self.late += 1
+
+    # write a closed bucket's row, one that can't be packed is dropped so the tier carries on
+    def write(self, ring, b):
+        try:
+            ring.add(b)
+        except struct.error as e:
+            log.error("Dropped the rollup row for %d in %s: %s", b.start, ring.path, e)
+
+    # the open bucket of a tier as a row dict, e.g. today's highs and lows
+    def current(self, size):
+        b = self.open.get(size)
+        if b is None or not b.count:
+            return None
+        return {"start": b.start, "count": b.count, "mphMin": b.mphMin, "mphMax": b.mphMax, "mphMean": b.mphSum / b.count,
+            "gust": b.gust, "tempLo": b.tempLo / 10, "tempHi": b.tempHi / 10, "tempMean": b.tempSum / b.count / 10,
+            "feelsLo": b.feelsLo}
+
+    # rows between t0 and t1 from the finest tier that returns at most maxRows, including the open bucket
+    def query(self, t0, t1, maxRows=1000, size=None):
+        if size is None:
+            size = next((s for s, c in tiers if (t1 - t0) / s <= maxRows), tiers[-1][0])
+        rows = self.rings[size].query(t0, t1)
+        cur = self.current(size)
+        if cur and t0 <= cur["start"] < t1:
+            rows.append(cur)
+        return rows
+
+    # write open buckets so a restart can pick them up again
+    def close(self):
+        for size, ring in self.rings.items():
+            b = self.open.get(size)
+            if b is not None and b.count:
+                self.write(ring, b)
+            ring.flush()
+            ring.close()
+
+# Rollups for every station, takes samples from the receive path like sampleStore
+class rollupStore:
+    def __init__(self, path="data"):
+        self.path = path
+        self.stations = {}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def station(self, name):
+        if name not in self.stations:
+            self.stations[name] = stationRollups(self.path, name)
+        return self.stations[name]
+
+    def put(self, m):
+        with self.lock:
+            self.station(m.station).add(m.time, m.mph, m.gust, m.temp, m.feelslike)
+
+    def query(self, station, t0, t1, maxRows=1000, size=None):
+        with self.lock:
+            return self.station(station).query(t0, t1, maxRows, size)
+
+    def current(self, station, size=86400):
+        with self.lock:
+            return self.station(station).current(size)
+
+    def stats(self):
+        with self.lock:
+            return {"late": sum(s.late for s in self.stations.values()),
+                "lateDropped": sum(s.lateDropped for s in self.stations.values())}
+
+    def close(self):
+        with self.lock:
+            for s in self.stations.values():
+                s.close()
+            self.stations.clear()
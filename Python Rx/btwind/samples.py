@@ -0,0 +1,203 @@
+'''
+
+btwind samples
+
+A sample is one station update with typed fields: integer mph and gust, the
+temperature as a float in degrees F, the wall clock time it was taken (when
+it was received unless the station's clock says otherwise, see clock.py), the
+monotonic time it was received, the station's millis() if it sent it and the
+station name. In pulse mode the receiver's own estimates (see pulses.py) are
+added as floats: speed, gust3 and variance, None otherwise. windchill and
+feelslike are filled in on the receive path (see derived.py). It uses
+__slots__ so a sample costs a fraction of the dict of strings json.loads makes, and consumers get numbers
+they can use directly.
+
+sampleBatch is the columnar form for bulk work (benchmarks, backfill, analysis):
+one array per field, no object per sample, and every column can be handed to
+numpy without copying: numpy.frombuffer(batch.mph, dtype=numpy.uint16).
+
+Both convert to and from the station's JSON datagram and binary frame (see
+protocol.py).
+
+'''
+import json
+import time
+from array import array
+
+from .protocol import (sync, headerFmt, sampleFmt, seqFmt, timeFmt, typeSample, backfillHeadFmt, backfillRecordFmt,
+    encode)
+from .clock import host
+
+sampleOffset = headerFmt.size
+seqOffset = sampleOffset + sampleFmt.size
+timeOffset = seqOffset + seqFmt.size
+
+class sample:
+    __slots__ = ('mph', 'gust', 'temp', 'time', 'received', 'station', 'seq', 'speed', 'gust3', 'variance',
+        'windchill', 'feelslike', 'device')
+
+    def __init__(self, mph, gust, temp, t=None, received=None, station="default", seq=None, speed=None, gust3=None,
+            variance=None, windchill=None, feelslike=None, device=None):
+        self.mph = mph           # int
+        self.gust = gust         # int, highest gust since the station's last reset
+        self.temp = temp         # float, degrees F
+        self.time = time.time() if t is None else t # wall clock time taken, for storage
+        self.received = time.monotonic() if received is None else received # for intervals and latency
+        self.station = station
+        self.seq = seq           # the station's datagram counter, None from firmware that doesn't send it
+        self.speed = speed       # float mph from the pulse times, mean over the smoothing window
+        self.gust3 = gust3       # float mph, highest 3 second mean since the last sample
+        self.variance = variance # of the per revolution speeds since the last sample, mph squared
+        self.windchill = windchill # float degrees F, None where it isn't defined (warm or calm)
+        self.feelslike = feelslike # float degrees F
+        self.device = device       # the station's millis() when it was taken, None from firmware that doesn't send it
+
+    # from a {"mph":"12", "gust":"20", "temp":"71.3", "seq":"41", "ms":"81234"} datagram (numbers may be quoted or
+    # not), received at wall clock time t and monotonic time received
+    @classmethod
+    def fromJson(cls, frame, t=None, received=None):
+        d = json.loads(frame)
+        try:
+            seq, ms = d.get("seq"), d.get("ms")
+            return cls(int(d["mph"]), int(d["gust"]), float(d["temp"]), t, received, seq=None if seq is None else int(seq),
+                device=None if ms is None else int(ms))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Not a sample datagram: {e!r}")
+
+    # from a complete binary sample frame
+    @classmethod
+    def fromFrame(cls, frame, t=None, received=None):
+        size = frame[1]
+        if size < sampleFmt.size:
+            raise ValueError(f"Sample frame payload is {size} bytes")
+        mph, gust, temp = sampleFmt.unpack_from(frame, sampleOffset)
+        seq = seqFmt.unpack_from(frame, seqOffset)[0] if size >= sampleFmt.size + seqFmt.size else None
+        ms = timeFmt.unpack_from(frame, timeOffset)[0] if size >= sampleFmt.size + seqFmt.size + timeFmt.size else None
+        return cls(mph, gust, temp / 10, t, received, seq=seq, device=ms)
+
+    # the samples in a complete backfill frame (type 3) received at wall clock time t and monotonic time
+    # received, each placed that far before them as the station's millis() says it was taken
+    @classmethod
+    def fromBackfill(cls, frame, t=None, received=None):
+        size = frame[1]
+        if size < backfillHeadFmt.size or (size - backfillHeadFmt.size) % backfillRecordFmt.size:
+            raise ValueError(f"Backfill frame payload is {size} bytes")
+        t = time.time() if t is None else t
+        received = time.monotonic() if received is None else received
+        first, sent = backfillHeadFmt.unpack_from(frame, sampleOffset)
+        samples = []
+        for i, (ms, mph, gust, temp) in enumerate(backfillRecordFmt.iter_unpack(
+                frame[sampleOffset + backfillHeadFmt.size:sampleOffset + size])):
+            age = ((sent - ms) & 0xFFFFFFFF) / 1000 # millis() wraps every 49 days
+            samples.append(cls(mph, gust, temp / 10, t - age, received - age, seq=(first + i) & 0xFFFF, device=ms))
+        return samples
+
+    # from a dict as written by asDict() (outbox records), extra keys are ignored
+    @classmethod
+    def fromDict(cls, d):
+        return cls(int(d["mph"]), int(d["gust"]), float(d["temp"]), d.get("time"), d.get("received"),
+            d.get("station", "default"), d.get("seq"), d.get("speed"), d.get("gust3"), d.get("variance"),
+            d.get("windchill"), d.get("feelslike"), d.get("device"))
+
+    # the datagram the station would have sent, as bytes
+    def toJson(self):
+        if self.seq is None:
+            return b'{"mph":"%d", "gust":"%d", "temp":"%.1f"}' % (self.mph, self.gust, self.temp)
+        if self.device is None:
+            return b'{"mph":"%d", "gust":"%d", "temp":"%.1f", "seq":"%d"}' % (self.mph, self.gust, self.temp, self.seq)
+        return b'{"mph":"%d", "gust":"%d", "temp":"%.1f", "seq":"%d", "ms":"%d"}' % (self.mph, self.gust, self.temp,
+            self.seq, self.device)
+
+    def toFrame(self):
+        payload = sampleFmt.pack(self.mph, self.gust, round(self.temp * 10))
+        if self.seq is not None:
+            payload += seqFmt.pack(self.seq & 0xFFFF)
+            if self.device is not None:
+                payload += timeFmt.pack(self.device & 0xFFFFFFFF)
+        return encode(typeSample, payload)
+
+    def asDict(self):
+        d = {"mph": self.mph, "gust": self.gust, "temp": self.temp, "time": self.time, "station": self.station,
+            "seq": self.seq}
+        if self.speed is not None:
+            d.update(speed=self.speed, gust3=self.gust3, variance=self.variance)
+        if self.feelslike is not None:
+            d.update(windchill=self.windchill, feelslike=self.feelslike)
+        if self.device is not None:
+            d["device"] = self.device
+        return d
+
+    def __repr__(self):
+        return f"sample({self.mph}, {self.gust}, {self.temp}, station={self.station!r})"
+
+# turn a complete frame from the framing layer into a sample received at wall clock time t and monotonic time
+# received (now if not given), returns None for binary frame types this receiver doesn't know
+def decode(frame, t=None, received=None):
+    if frame[0] != sync:
+        return sample.fromJson(frame, t, received)
+    if frame[2] == typeSample:
+        return sample.fromFrame(frame, t, received)
+    return None
+
+# Samples of one station stored as columns
+class sampleBatch:
+    def __init__(self, station="default"):
+        self.station = station
+        self.mph = array('H')
+        self.gust = array('H')
+        self.temp = array('d')
+        self.time = array('d')
+        self.received = array('d')
+        self.seq = array('l') # -1 where the station sent none
+        self.device = array('q') # station millis(), -1 where it sent none
+
+    def __len__(self):
+        return len(self.mph)
+
+    def __getitem__(self, i):
+        seq, device = self.seq[i], self.device[i]
+        return sample(self.mph[i], self.gust[i], self.temp[i], self.time[i], self.received[i], self.station,
+            None if seq < 0 else seq, device=None if device < 0 else device)
+
+    def append(self, s):
+        self.mph.append(s.mph)
+        self.gust.append(s.gust)
+        self.temp.append(s.temp)
+        self.time.append(s.time)
+        self.received.append(s.received)
+        self.seq.append(-1 if s.seq is None else s.seq)
+        self.device.append(-1 if s.device is None else s.device)
+
+    # decode a binary frame straight into the columns, no sample object is made
+    def appendFrame(self, frame, t=None, received=None):
+        size = frame[1]
+        if size < sampleFmt.size:
+            raise ValueError(f"Sample frame payload is {size} bytes")
+        mph, gust, temp = sampleFmt.unpack_from(frame, sampleOffset)
+        self.seq.append(seqFmt.unpack_from(frame, seqOffset)[0] if size >= sampleFmt.size + seqFmt.size else -1)
+        self.device.append(timeFmt.unpack_from(frame, timeOffset)[0]
+            if size >= sampleFmt.size + seqFmt.size + timeFmt.size else -1)
+        self.mph.append(mph)
+        self.gust.append(gust)
+        self.temp.append(temp / 10)
+        self.time.append(time.time() if t is None else t)
+        self.received.append(time.monotonic() if received is None else received)
+
+    # decode every frame the framing layer returned, json or binary
+    def extendFrames(self, frames):
+        now, mono = host.now() # one read of the clocks for the lot, they arrived together
+        for frame in frames:
+            if frame[0] == sync:
+                if frame[2] == typeSample:
+                    self.appendFrame(frame, now, mono)
+            else:
+                self.append(sample.fromJson(frame, now, mono))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # bytes used by the columns
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.mph, self.gust, self.temp, self.time, self.received, self.seq,
+            self.device))
@@ -0,0 +1,494 @@
+'''
+
+btwind station simulator
+
+Stands in for the btwindv2_ino firmware so the receiver can be load tested and
+soak tested without hardware. Each simulated station runs the firmware's own
+logic against a simulated anemometer and temperature sensor: wind() turning
+magnet pulses into rpm and mph with the same integer maths, the 10 second
+no-rotation reset, gust tracking, the TMP421's 1/16 degree C readings through
+getTempTenths() and getTemp(), updateData()'s JSON datagram or binary frame
+with its sequence number and millis(), the pulse frames of pulse mode (the micros() time of
+every magnet pass, see protocol.py), the backlog of recent samples and the
+backfill frames sent from it, and the @R@, @L@, @B@, @J@, @P@ and @F<seq>@
+commands. A TCP station carries on taking samples between receivers, so a
+receiver that reconnects finds them in the backlog.
+
+Time inside a station is the firmware's millis(), one updateData() per 1000 ms,
+and the rate sets how many updates are sent per real second. At 1 Hz the
+station runs in real time, at 1000 Hz it lives through a thousand seconds of
+wind every second. The link can be made worse on purpose: noise bytes between
+datagrams, dropped datagrams (the sequence numbers still count them) and
+corrupted bytes inside them.
+
+    python3 -m btwind.simulator --tcp 127.0.0.1:5000 --stations 3 --rate 100
+    python3 -m btwind.simulator --pty --dropout 0.01 --corrupt 0.01 --noise 0.01
+
+A station serves one receiver at a time over TCP (like the bluetooth shield)
+or a pty the receiver opens as serial:///dev/pts/N.
+
+'''
+import argparse
+import collections
+import logging
+import math
+import os
+import random
+import select
+import socket
+import threading
+import time
+
+from .protocol import (typeSample, sampleFmt, seqFmt, timeFmt, typePulses, pulseHeadFmt, pulseTimeFmt, pulseDelta, typeBackfill,
+    backfillHeadFmt, backfillRecordFmt, backfillMax, encode)
+
+log = logging.getLogger("btwind.simulator") # not __main__ when run with -m
+
+updateInterval = 1000 # ms between updateData() calls, dataUpdateInterval in the firmware
+idleReset = 10000     # ms without a pulse before the firmware decides the cups stopped
+stepMs = 100          # ms of simulated time per wind() check
+pulseMax = 32         # pulses the firmware buffers between pulse frames
+backlogMax = 300      # samples the firmware keeps for backfill
+backfillPerUpdate = 12 # backfill frames that fit on the link between two updates, about 3 KB at 38400 baud
+
+# C int on the Mega is 16 bits
+def int16(n):
+    return ((n + 0x8000) & 0xFFFF) - 0x8000
+
+# the Arduino round(), halves away from zero
+def arduinoRound(x):
+    return math.floor(x + 0.5) if x >= 0 else math.ceil(x - 0.5)
+
+# String(rounded) with a decimal point put in front of the last digit, as the firmware does it
+def getTemp(rounded):
+    s = str(rounded)
+    return s[:-1] + "." + s[-1:]
+
+# Wind speed over time, a mean reverting random walk with occasional calm spells
+class windModel:
+    def __init__(self, mph=8.0, gustiness=0.4, calm=0.02, rng=None):
+        self.mean = mph
+        self.gustiness = gustiness # spread of the speed around the mean, as a fraction of it
+        self.calm = calm # chance per simulated minute of the wind dying for 15-60 sec
+        self.rng = rng or random.Random()
+        self.speed = mph
+        self.calmUntil = 0
+
+    # wind speed in mph for the next dt ms
+    def step(self, now, dt):
+        rng = self.rng
+        if now < self.calmUntil:
+            return 0.0
+        if self.calm and rng.random() < self.calm * dt / 60000:
+            self.calmUntil = now + rng.uniform(15000, 60000)
+            return 0.0
+        sigma = self.mean * self.gustiness
+        self.speed += (self.mean - self.speed) * dt / 5000 + rng.gauss(0, sigma) * math.sqrt(dt / 1000) * 0.5
+        self.speed = max(0.0, self.speed)
+        return self.speed
+
+# Air temperature drifting slowly around a base, read like the TMP421 does (1/16 degree C steps)
+class tempModel:
+    def __init__(self, temp=71.0, swing=3.0, rng=None):
+        self.base = temp
+        self.swing = swing
+        self.rng = rng or random.Random()
+
+    def celsius(self, now):
+        f = self.base + self.swing * math.sin(now / 3600000 * 2 * math.pi) + self.rng.gauss(0, 0.05)
+        return math.floor((f - 32) * 5 / 9 * 16) / 16
+
+# The firmware's state and logic for one station
+class firmware:
+    def __init__(self, wind=None, temp=None):
+        self.wind = wind or windModel()
+        self.temp = temp or tempModel()
+        self.millis = 0
+        self.phase = 0.0 # fraction of a revolution since the last magnet pass
+        self.moving = 0
+        self.last = 0
+        self.count = 0
+        self.mph = 0
+        self.gust = 0
+        self.dispLights = 1
+        self.binMode = 0
+        self.pulseMode = 0
+        self.pulseTimes = [] # micros() of the buffered pulses
+        self.pulseIndex = 0  # pulses counted, 16 bits
+        self.out = bytearray() # pulse frames com() sent between updates when the buffer filled up
+        self.seq = 0
+        self.backlog = collections.deque(maxlen=backlogMax) # (millis, mph, gust, tenths) of the samples before seq
+        self.backfillNext = 0 # seq of the next sample to backfill
+        self.backfillEnd = 0  # seq the backfill stops before
+        self.message = None # program message being received, None outside @...@
+
+    # one magnet pass at time now (micros() us), the body of wind()
+    def pulse(self, now, us):
+        self.pulseIndex = (self.pulseIndex + 1) & 0xFFFF
+        if self.pulseMode and len(self.pulseTimes) < pulseMax: # a full buffer waits for com(), the index shows the gap
+            self.pulseTimes.append(us & 0xFFFFFFFF)
+        if self.moving == 0: # first rotation, no reading
+            self.moving = 1
+            self.last = now
+            return
+        self.count += 1
+        rpm = int16(60000 // max(1, now - self.last))
+        self.last = now
+        self.mph = int(rpm / 6) # C division truncates towards zero
+        if self.mph > self.gust:
+            self.gust = self.mph
+
+    # run com()'s loop up to time t, wind() with the cups turning once per 10000 / mph ms as the firmware
+    # assumes, then the pulse frame if the buffer filled up in it
+    def advance(self, t):
+        while self.millis < t:
+            dt = min(stepMs, t - self.millis)
+            revs = self.wind.step(self.millis, dt) * 6 * dt / 60000
+            n = 1
+            while self.phase + revs >= n: # magnet passes inside this step, placed where they fall
+                at = self.millis + dt * (n - self.phase) / revs
+                self.pulse(int(at), int(at * 1000))
+                n += 1
+            self.phase += revs - (n - 1)
+            self.millis += dt
+            if self.moving == 1 and self.millis - self.last > idleReset:
+                self.moving = 0
+                self.mph = 0
+            if len(self.pulseTimes) == pulseMax:
+                self.out += self.pulseFrame(self.millis * 1000)
+
+    def getTempTenths(self):
+        return arduinoRound((self.temp.celsius(self.millis) * 9 / 5 + 32) * 10)
+
+    # the datagram updateData() sends, then seq++
+    def updateData(self):
+        tenths = self.getTempTenths()
+        if self.binMode:
+            data = encode(typeSample, sampleFmt.pack(self.mph & 0xFFFF, self.gust & 0xFFFF, int16(tenths))
+                + seqFmt.pack(self.seq) + timeFmt.pack(self.millis & 0xFFFFFFFF))
+        else:
+            data = b'{"mph":"%d", "gust":"%d", "temp":"%s", "seq":"%d", "ms":"%d"}' % (self.mph, self.gust,
+                getTemp(tenths).encode(), self.seq, self.millis & 0xFFFFFFFF)
+        self.backlog.append((self.millis, min(self.mph, 255), min(self.gust, 255), int16(tenths)))
+        self.seq = (self.seq + 1) & 0xFFFF
+        return data
+
+    # @F<seq>@: backfill the backlog samples after seq, all of them for @F@ (or a seq it doesn't hold)
+    def startBackfill(self, arg):
+        count = len(self.backlog)
+        self.backfillNext = (self.seq - count) & 0xFFFF
+        if arg:
+            start = ((int(arg) if arg.isdigit() else 0) + 1) & 0xFFFF # String.toInt() gives 0 for junk
+            if (self.seq - start) & 0xFFFF < count:
+                self.backfillNext = start
+        self.backfillEnd = self.seq
+
+    # buildBackfillFrame(): the next backfill frame from the backlog, b'' once it's done
+    def backfillFrame(self):
+        count = len(self.backlog)
+        if (self.seq - self.backfillEnd) & 0xFFFF >= count: # even the end has been overwritten since
+            self.backfillNext = self.backfillEnd
+            return b''
+        if (self.seq - self.backfillNext) & 0xFFFF > count: # overwritten while waiting, start at the oldest kept
+            self.backfillNext = (self.seq - count) & 0xFFFF
+        payload = backfillHeadFmt.pack(self.backfillNext, self.millis & 0xFFFFFFFF)
+        n = 0
+        while n < backfillMax and self.backfillNext != self.backfillEnd:
+            ms, mph, gust, tenths = self.backlog[count - ((self.seq - self.backfillNext) & 0xFFFF)]
+            payload += backfillRecordFmt.pack(ms & 0xFFFFFFFF, mph, gust, tenths)
+            self.backfillNext = (self.backfillNext + 1) & 0xFFFF
+            n += 1
+        return encode(typeBackfill, payload)
+
+    # sendPulses(): the buffered pulses as a pulse frame, sent at micros() us
+    def pulseFrame(self, us):
+        times = self.pulseTimes
+        payload = pulseHeadFmt.pack((self.pulseIndex - len(times)) & 0xFFFF, us & 0xFFFFFFFF)
+        if times:
+            payload += pulseTimeFmt.pack(times[0]) + b''.join(((b - a) & 0xFFFFFFFF).to_bytes(pulseDelta, 'little')
+                for a, b in zip(times, times[1:]))
+        self.pulseTimes = []
+        return encode(typePulses, payload)
+
+    # one update interval, what the station sends for it
+    def tick(self):
+        self.advance(self.millis + updateInterval)
+        data = bytes(self.out)
+        self.out.clear()
+        for i in range(backfillPerUpdate): # pumpBackfill() fills the gaps between updates
+            if self.backfillNext == self.backfillEnd:
+                break
+            data += self.backfillFrame()
+        if self.pulseMode: # the pulses up to now go ahead of the sample
+            data += self.pulseFrame(self.millis * 1000)
+        return data + self.updateData()
+
+    # bytes from the receiver, @...@ program messages
+    def receive(self, data):
+        for c in data.decode('latin-1'):
+            if self.message is None:
+                if c == '@':
+                    self.message = ''
+            elif c == '@':
+                self.command(self.message)
+                self.message = None
+            else:
+                self.message += c
+
+    def command(self, cmd):
+        if cmd == "R":
+            self.gust = 0
+        elif cmd == "B":
+            self.binMode = 1
+        elif cmd == "J":
+            self.binMode = 0
+            self.pulseMode = 0
+        elif cmd == "P":
+            self.binMode = 1
+            self.pulseMode = 1
+            self.pulseTimes = []
+        elif cmd == "L":
+            self.dispLights = 0 if self.dispLights else 1
+        elif cmd.startswith("F"):
+            self.startBackfill(cmd[1:])
+
+    # the bluetooth link went down, the next receiver has to ask for binary frames again
+    def disconnected(self):
+        self.binMode = 0
+        self.pulseMode = 0
+        self.backfillNext = self.backfillEnd
+        self.message = None
+
+# A firmware plus what the air does to its datagrams
+class station:
+    def __init__(self, name="sim", mph=8.0, gustiness=0.4, calm=0.02, temp=71.0,
+            noise=0.0, dropout=0.0, corrupt=0.0, seed=None):
+        self.name = name
+        self.rng = random.Random(seed)
+        self.firmware = firmware(windModel(mph, gustiness, calm, self.rng), tempModel(temp, rng=self.rng))
+        self.noise = noise       # chance of junk bytes before a datagram
+        self.dropout = dropout   # chance a datagram is lost
+        self.corrupt = corrupt   # chance a datagram has a byte changed
+        self.lock = threading.Lock()
+
+        # counters
+        self.updates = 0     # datagrams the firmware sent
+        self.dropped = 0
+        self.corrupted = 0
+        self.noiseBytes = 0
+        self.bytesOut = 0
+
+    # the bytes for n update intervals
+    def ticks(self, n):
+        rng = self.rng
+        out = bytearray()
+        with self.lock:
+            for i in range(n):
+                data = self.firmware.tick()
+                self.updates += 1
+                if self.noise and rng.random() < self.noise:
+                    junk = bytes(rng.randrange(256) for j in range(rng.randint(1, 8)))
+                    out += junk
+                    self.noiseBytes += len(junk)
+                if self.dropout and rng.random() < self.dropout:
+                    self.dropped += 1
+                    continue
+                if self.corrupt and rng.random() < self.corrupt:
+                    data = bytearray(data)
+                    data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+                    self.corrupted += 1
+                out += data
+        self.bytesOut += len(out)
+        return bytes(out)
+
+    # n update intervals with nobody connected, the samples only go into the backlog
+    def idle(self, n):
+        with self.lock:
+            for i in range(n):
+                self.firmware.tick()
+                self.updates += 1
+
+    def receive(self, data):
+        with self.lock:
+            self.firmware.receive(data)
+
+    def disconnected(self):
+        with self.lock:
+            self.firmware.disconnected()
+
+    def stats(self):
+        return {"updates": self.updates, "dropped": self.dropped, "corrupted": self.corrupted,
+            "noiseBytes": self.noiseBytes, "bytesOut": self.bytesOut, "seq": self.firmware.seq,
+            "mph": self.firmware.mph, "gust": self.firmware.gust}
+
+# Feeds one connected receiver at rate updates per second until it goes away or stop is set,
+# updates that fell due while busy are sent together so high rates don't depend on sleep precision
+def serveLink(sim, read, write, fileno, rate, stop):
+    start = time.monotonic()
+    sent = 0
+    while not stop.is_set():
+        due = int((time.monotonic() - start) * rate) + 1 - sent
+        if due > 0:
+            data = sim.ticks(due)
+            sent += due
+            if data:
+                write(data)
+        wait = start + sent / rate - time.monotonic()
+        r, _, _ = select.select([fileno], [], [], max(0.0, min(wait, 0.5)))
+        if r:
+            data = read()
+            if data == b'': # the receiver hung up
+                return
+            if data:
+                sim.receive(data)
+
+# Serves a station on a TCP port, one receiver at a time like the bluetooth shield
+class tcpStation(threading.Thread):
+    def __init__(self, sim, host='127.0.0.1', port=0, rate=1.0):
+        super(tcpStation, self).__init__()
+        self._stop_event = threading.Event()
+        self.daemon = True
+        self.sim = sim
+        self.rate = rate
+        self.server = socket.create_server((host, port))
+        self.address = "%s:%d" % self.server.getsockname()[:2]
+        self.port = self.server.getsockname()[1]
+        self.sock = None # the connected receiver
+        self.freeSince = time.monotonic() # when the last receiver went away
+
+    def run(self):
+        self.server.settimeout(0.5)
+        while not self.stopped():
+            try:
+                sock, peer = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            log.info("Station %s: receiver connected from %s:%d", self.sim.name, *peer[:2])
+            missed = int((time.monotonic() - self.freeSince) * self.rate) # the updates while nobody was connected
+            self.sim.idle(min(missed, 2 * backlogMax))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            try:
+                serveLink(self.sim, lambda: sock.recv(1024), sock.sendall, sock.fileno(), self.rate, self._stop_event)
+            except OSError:
+                pass
+            self.sock = None
+            sock.close()
+            self.sim.disconnected()
+            self.freeSince = time.monotonic()
+            log.info("Station %s: receiver disconnected", self.sim.name)
+        self.server.close()
+
+    # drop the link to the current receiver, like the station going out of range
+    def hangup(self):
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+# Serves a station on a pseudo terminal, receivers open the path as a serial port.
+# Nobody reading looks the same as an unconnected station, datagrams that don't fit are lost.
+class ptyStation(threading.Thread):
+    def __init__(self, sim, rate=1.0):
+        super(ptyStation, self).__init__()
+        import tty
+        self._stop_event = threading.Event()
+        self.daemon = True
+        self.sim = sim
+        self.rate = rate
+        self.master, self.slave = os.openpty() # holding the slave open keeps the master usable between receivers
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.address = "serial://" + self.path
+
+    def write(self, data):
+        try:
+            os.write(self.master, data)
+        except BlockingIOError:
+            pass
+
+    def read(self):
+        try:
+            return os.read(self.master, 1024) or None # a pty never hangs up, carry on without a receiver
+        except BlockingIOError:
+            return None
+
+    def run(self):
+        try:
+            serveLink(self.sim, self.read, self.write, self.master, self.rate, self._stop_event)
+        except OSError as e:
+            log.error("Station %s: %s", self.sim.name, e)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+# start count simulated stations, TCP on consecutive ports from port (0 = any free port) or ptys
+def startStations(count=1, rate=1.0, host='127.0.0.1', port=0, pty=False, seed=None, **kwargs):
+    servers = []
+    for i in range(count):
+        sim = station(f"sim{i}", seed=None if seed is None else seed + i, **kwargs)
+        if pty:
+            server = ptyStation(sim, rate)
+        else:
+            server = tcpStation(sim, host, port + i if port else 0, rate)
+        server.start()
+        servers.append(server)
+    return servers
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="btwind.simulator", description="btwindv2_ino station simulator")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument('--tcp', default='127.0.0.1:5000', metavar='HOST:PORT',
+        help="listen on this address, further stations on the following ports (default 127.0.0.1:5000)")
+    where.add_argument('--pty', action='store_true', help="serve each station on a pseudo terminal instead")
+    parser.add_argument('--stations', type=int, default=1, help="number of stations")
+    parser.add_argument('--rate', type=float, default=1, help="updates per second per station, 1 = real time")
+    parser.add_argument('--mph', type=float, default=8, help="mean wind speed")
+    parser.add_argument('--gustiness', type=float, default=0.4, help="wind speed spread as a fraction of the mean")
+    parser.add_argument('--calm', type=float, default=0.02, help="chance per simulated minute of a calm spell")
+    parser.add_argument('--temp', type=float, default=71, help="mean temperature, degrees F")
+    parser.add_argument('--noise', type=float, default=0, help="chance of junk bytes before a datagram")
+    parser.add_argument('--dropout', type=float, default=0, help="chance a datagram is lost")
+    parser.add_argument('--corrupt', type=float, default=0, help="chance a datagram has a damaged byte")
+    parser.add_argument('--seed', type=int, help="random seed, for repeatable runs")
+    parser.add_argument('--stats', type=float, default=0, metavar='SEC', help="log station counters every SEC seconds")
+    parser.add_argument('--log-level', default='INFO', help="DEBUG, INFO, WARNING or ERROR")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s - %(message)s')
+
+    host, _, port = args.tcp.rpartition(':')
+    servers = startStations(args.stations, args.rate, host, int(port), args.pty, args.seed, mph=args.mph,
+        gustiness=args.gustiness, calm=args.calm, temp=args.temp, noise=args.noise, dropout=args.dropout,
+        corrupt=args.corrupt)
+    print("[Stations]")
+    for server in servers:
+        print(f"{server.sim.name} = {server.address}", flush=True)
+    try:
+        while 1:
+            time.sleep(args.stats or 3600)
+            if args.stats:
+                for server in servers:
+                    log.info("Station %s: %s", server.sim.name, server.sim.stats())
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
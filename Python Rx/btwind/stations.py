@@ -0,0 +1,129 @@
+'''
+
+btwind multi-station receiver
+
+Stations come from the stationRegistry (see registry.py). The stationHub runs
+one asyncio stationEngine per station on a single loop and re-reads the file when
+it changes, so stations can be added or removed while running. Every sample is
+tagged with the name of the station it came from. With a record path every
+station's raw bytes are also written to a replay file (see transports.py).
+
+'''
+import asyncio
+import logging
+
+from .aioengine import stationEngine
+from .channels import normal
+from .registry import stationRegistry
+from .transports import transportFor, recorder
+
+log = logging.getLogger(__name__)
+
+# Runs an engine for every registered station on one event loop
+class stationHub:
+    def __init__(self, registry, onSample=None, onState=None, sinks=(), limit=60.0, retries=0, poll=5.0, protocol="binary",
+            record="", cadence=1.0, pulses=None, backfill=None):
+        self.registry = registry
+        self.onSample = onSample # called with each sample, sample.station holds the station name
+        self.onState = onState # called with (station name, True/False) when a link goes up or down
+        self.sinks = list(sinks)
+        self.limit = limit
+        self.maxRetries = retries
+        self.poll = poll # seconds between checks of the settings file
+        self.protocol = protocol # datagram format asked for on connect, binary or json
+        self.engines = {} # name: stationEngine
+        self.tasks = {} # name: task running the engine
+        self.addresses = {} # name: address the engine was started with
+        self.record = record # replay file path, {station} is replaced by the station name, blank = don't record
+        self.recorders = {} # name: recorder, kept open across engine restarts
+        self.cadence = cadence # seconds between datagrams, for the link health checks
+        self.pulses = pulses # makes a pulses.pulseEstimator per station for pulse mode, None = off
+        self.backfill = backfill # called with lists of backfilled samples, None = don't ask for them
+
+    # start engines for new stations, stop engines for removed or changed ones
+    def sync(self, stations):
+        for name in list(self.tasks):
+            if stations.get(name) != self.addresses[name]:
+                log.info("Removing station %s", name)
+                self.tasks.pop(name).cancel()
+                del self.engines[name], self.addresses[name]
+        for name, address in stations.items():
+            if name in self.tasks:
+                continue
+            try:
+                transport = transportFor(address)
+            except ValueError as e:
+                log.error("Station %s: %s", name, e)
+                continue
+            log.info("Adding station %s at %s", name, address)
+            engine = stationEngine(transport, onSample=self.tagger(name), onState=self.stater(name),
+                sinks=self.sinks, limit=self.limit, retries=self.maxRetries, protocol=self.protocol, cadence=self.cadence,
+                pulses=self.pulses, backfill=self.backfiller(name) if self.backfill else None)
+            engine.health.name = name
+            if self.record:
+                engine.stream.tap = self.recorderFor(name).write
+            self.engines[name] = engine
+            self.addresses[name] = address
+            self.tasks[name] = asyncio.ensure_future(engine.run())
+
+    def recorderFor(self, name):
+        if name not in self.recorders:
+            self.recorders[name] = recorder(self.record.format(station=name))
+        return self.recorders[name]
+
+    def tagger(self, name):
+        def tag(m):
+            m.station = name
+            if self.onSample:
+                self.onSample(m)
+        return tag
+
+    def backfiller(self, name):
+        def tag(samples):
+            for m in samples:
+                m.station = name
+            return self.backfill(samples)
+        return tag
+
+    def stater(self, name):
+        def state(up):
+            if self.onState:
+                self.onState(name, up)
+        return state
+
+    # apply new backoff settings to every engine
+    def configure(self, limit=None, retries=None):
+        if limit is not None:
+            self.limit = limit
+        if retries is not None:
+            self.maxRetries = retries
+        for engine in self.engines.values():
+            engine.backoff.limit = self.limit
+            engine.maxRetries = self.maxRetries
+
+    def send(self, name, cmd, level=normal):
+        if name in self.engines:
+            self.engines[name].send(cmd, level)
+
+    # runs until cancelled, watching the settings file for station changes
+    async def run(self):
+        try:
+            self.registry.load()
+            self.sync(self.registry.stations) # the registry may have been loaded already
+            while 1:
+                await asyncio.sleep(self.poll)
+                if self.registry.load():
+                    self.sync(self.registry.stations)
+        finally:
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+            self.tasks.clear()
+            self.engines.clear()
+            self.addresses.clear()
+            for r in self.recorders.values():
+                r.close()
+            self.recorders.clear()
+
+    def stats(self):
+        return {name: engine.stats() for name, engine in list(self.engines.items())} # may be read from another thread
@@ -0,0 +1,138 @@
+'''
+
+btwind link supervisor
+
+Keeps a connection running. Instead of polling is_alive() the supervisor sleeps
+on an event that the connection sets when it exits, then waits out a jittered
+exponential backoff before trying again so an out of range station costs
+nothing but an occasional connect attempt.
+
+'''
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Jittered exponential backoff, each delay is a random point between half and all
+# of base * factor^n, capped at limit seconds
+class backoff:
+    def __init__(self, base=1.0, limit=60.0, factor=2.0):
+        self.base = base
+        self.limit = limit
+        self.factor = factor
+        self.n = 0
+
+    def next(self):
+        delay = min(self.limit, self.base * self.factor ** self.n)
+        if delay < self.limit:
+            self.n += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.n = 0
+
+# Base class for a thread that restarts a connection whenever it exits.
+# Subclasses implement makeConnection() which returns an unstarted thread with a stop()
+# method, that thread must call linkUp() once connected and linkDown() when it exits.
+class linkSupervisor(threading.Thread):
+    def __init__(self, enabled=True, base=1.0, limit=60.0, retries=0):
+        super(linkSupervisor, self).__init__()
+        self.daemon = False
+        self._stop_event = threading.Event()
+        self._wake = threading.Event() # set on connection exit, stop or enable/disable
+        self.enabled = enabled
+        self.backoff = backoff(base, limit)
+        self.maxRetries = retries # consecutive failed attempts before giving up, 0 = never give up
+        self.connection = None
+
+        # counters
+        self.attempts = 0   # total connection attempts
+        self.retries = 0    # consecutive failed attempts since the last good connection
+        self.connects = 0   # successful connections
+        self.upSince = None # time the current connection came up, None when down
+        self.upTotal = 0.0  # seconds connected, not counting the current connection
+        self.startedAt = time.time()
+
+    def makeConnection(self):
+        raise NotImplementedError
+
+    def run(self):
+        while not self.stopped():
+            self._wake.clear()
+            if not self.enabled: # connection turned off in settings, sleep until something changes
+                self._wake.wait()
+                continue
+            self.attempts += 1
+            self.connection = self.makeConnection()
+            self.connection.start()
+            while self.connection.is_alive(): # sleep until the connection exits or we're told to change state
+                # timed, linkDown() sets the event before the thread has exited, a set cleared in that gap
+                # would otherwise leave the supervisor waiting forever
+                if not self._wake.wait(1.0):
+                    continue
+                self._wake.clear()
+                if self.stopped() or not self.enabled:
+                    self.connection.stop()
+                    self.connection.join()
+                else: # most likely linkDown(), give the thread a moment to finish exiting
+                    self.connection.join(1.0)
+            self._wake.clear() # the exit of the connection has been handled, clear before the backoff sleep
+            if self.stopped():
+                break
+            if self.connection.wasUp:
+                self.backoff.reset()
+                self.retries = 0
+                continue # reconnect right away after losing a good connection
+            self.retries += 1
+            if self.maxRetries and self.retries >= self.maxRetries:
+                log.warning("Giving up after %d failed connection attempts", self.retries)
+                self.enabled = False
+                continue
+            delay = self.backoff.next()
+            log.info("Connection attempt %d failed, retrying in %.1f sec", self.retries, delay)
+            self._wake.wait(delay) # interruptible sleep, stop or a settings change cuts it short
+        log.info("Watcher thread is exiting")
+
+    # called from the connection thread once the link is established
+    def linkUp(self):
+        self.connects += 1
+        self.upSince = time.time()
+
+    # called from the connection thread as it exits, whether or not it ever connected
+    def linkDown(self):
+        if self.upSince is not None:
+            self.upTotal += time.time() - self.upSince
+            self.upSince = None
+        self._wake.set()
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if enabled:
+            self.retries = 0
+            self.backoff.reset()
+        self._wake.set()
+
+    def uptime(self):
+        if self.upSince is None:
+            return 0.0
+        return time.time() - self.upSince
+
+    def stats(self):
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "connects": self.connects,
+            "connected": self.upSince is not None,
+            "uptime": self.uptime(),
+            "upTotal": self.upTotal + self.uptime(),
+            "runtime": time.time() - self.startedAt,
+        }
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
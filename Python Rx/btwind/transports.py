@@ -0,0 +1,273 @@
+'''
+
+btwind transports
+
+How the receiver reaches a station. Every transport can open a link two ways:
+open() returns a stream object for the thread engine (fileno, recv, send,
+settimeout and close, a plain socket for most of them) and openAsync() returns
+an asyncio (reader, writer) pair for the asyncio engine. Everything above this
+module only sees bytes, so any transport works with either engine, storage and
+sinks, on machines with or without bluetooth.
+
+Station addresses pick the transport:
+
+    00:18:E4:0C:68:00              RFCOMM channel 1 (the original link)
+    rfcomm://00:18:E4:0C:68:00:3   RFCOMM on another channel
+    host:port, tcp://host:port     TCP, a serial to TCP bridge or the station simulator
+    serial:///dev/ttyACM0          the arduino's USB serial at 38400 baud
+    serial:///dev/ttyUSB0?baud=115200
+    replay:///path/capture.rec     a recorded session played back with its original timing
+    replay:///path/capture.rec?speed=10&loop=1
+
+Replay files are written by recorder (General/record, or python3 -m btwind
+--record FILE): a magic line then one <dI (time, length) header per chunk of
+received bytes, followed by the bytes, exactly as they came off the link.
+
+'''
+import os
+import re
+import socket
+import struct
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+macAddr = re.compile(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$')
+
+# await a connect for at most timeout seconds, like open()'s socket timeout
+async def within(connect, timeout, name):
+    import asyncio
+    try:
+        return await asyncio.wait_for(connect, timeout)
+    except asyncio.TimeoutError: # not an OSError before 3.11, the engine retries on OSError
+        raise TimeoutError(f"no answer from {name} in {timeout} sec")
+
+# Bluetooth RFCOMM, pybluez when it's installed, otherwise the socket module's native support (linux)
+class rfcommTransport:
+    def __init__(self, address, channel=1):
+        self.address = address
+        self.channel = channel
+        self.name = address if channel == 1 else f"{address}:{channel}"
+
+    def open(self, timeout=30):
+        try:
+            import bluetooth
+            sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        except ImportError:
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        try:
+            sock.settimeout(timeout) # an absent station would otherwise hold up stop and settings changes for minutes
+            sock.connect((self.address, self.channel))
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def openAsync(self, timeout=30):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.setblocking(False)
+        try:
+            await within(loop.sock_connect(sock, (self.address, self.channel)), timeout, self.name)
+        except BaseException:
+            sock.close()
+            raise
+        return await asyncio.open_connection(sock=sock)
+
+class tcpTransport:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+
+    def open(self, timeout=30):
+        sock = socket.create_connection((self.host, self.port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # commands are a few bytes, don't hold them back
+        return sock
+
+    async def openAsync(self, timeout=30):
+        import asyncio
+        reader, writer = await within(asyncio.open_connection(self.host, self.port), timeout, self.name)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer
+
+# A tty file descriptor with the socket methods the thread engine uses
+class ttyStream:
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, n):
+        return os.read(self.fd, n)
+
+    def send(self, data):
+        return os.write(self.fd, data)
+
+    def settimeout(self, timeout):
+        pass # always non-blocking, the frame reader selects before reading
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# Serial port (the arduino's USB Serial runs at 38400), raw 8N1 set up with termios
+class serialTransport:
+    def __init__(self, path, baud=38400):
+        self.path = path
+        self.baud = baud
+        self.name = path
+
+    def openFd(self):
+        import termios
+        import tty
+        speed = getattr(termios, f"B{self.baud}", None)
+        if speed is None:
+            raise ValueError(f"Unsupported baud rate {self.baud}")
+        fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            attrs = termios.tcgetattr(fd)
+            attrs[2] |= termios.CLOCAL | termios.CREAD # ignore modem lines, enable the receiver
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            termios.tcflush(fd, termios.TCIFLUSH) # whatever was sitting in the driver is stale
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def open(self, timeout=30):
+        return ttyStream(self.openFd())
+
+    async def openAsync(self, timeout=30):
+        return await within(self.connect(), timeout, self.name)
+
+    async def connect(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        fd = self.openFd()
+        reader = asyncio.StreamReader()
+        readTransport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(fd, 'rb', buffering=0))
+        writeTransport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+            os.fdopen(os.dup(fd), 'wb', buffering=0))
+        writer = asyncio.StreamWriter(writeTransport, protocol, reader, loop)
+        lost = protocol.connection_lost
+        def closeBoth(exc): # closing the writer closes the read half too
+            lost(exc)
+            readTransport.close()
+        protocol.connection_lost = closeBoth
+        return reader, writer
+
+recordMagic = b'BTWREC1\n'
+recordFmt = struct.Struct('<dI') # time received, chunk length
+
+# Appends received bytes to a replay file with their arrival times
+class recorder:
+    def __init__(self, path, flushEvery=1.0):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(recordMagic)
+        self.flushEvery = flushEvery
+        self.lastFlush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.file.write(recordFmt.pack(time.time(), len(data)))
+            self.file.write(data)
+            now = time.monotonic()
+            if now - self.lastFlush > self.flushEvery:
+                self.file.flush()
+                self.lastFlush = now
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# reads (time, bytes) chunks back from a replay file
+def readRecording(path):
+    with open(path, 'rb') as f:
+        if f.read(len(recordMagic)) != recordMagic:
+            raise ValueError(f"{path} is not a btwind recording")
+        while 1:
+            head = f.read(recordFmt.size)
+            if len(head) < recordFmt.size:
+                return
+            t, n = recordFmt.unpack(head)
+            data = f.read(n)
+            if len(data) < n: # cut short by a crash while recording
+                return
+            yield t, data
+
+# Plays a recording back through a socket pair, speed 2 = twice as fast, 0 = as fast as possible.
+# After the last chunk the link stays up and quiet unless loop is set
+class replayTransport:
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.name = path
+
+    def open(self, timeout=30):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"No recording at {self.path}")
+        ours, theirs = socket.socketpair()
+        threading.Thread(target=self.play, args=(theirs,), daemon=True).start()
+        return ours
+
+    async def openAsync(self, timeout=30):
+        import asyncio
+        return await within(asyncio.open_connection(sock=self.open()), timeout, self.name)
+
+    def play(self, sock):
+        try:
+            while 1:
+                start = first = None
+                for t, data in readRecording(self.path):
+                    if first is None:
+                        start, first = time.monotonic(), t
+                    if self.speed > 0:
+                        delay = start + (t - first) / self.speed - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    sock.sendall(data)
+                if not self.loop:
+                    break
+            while sock.recv(1024): # hold the link open until the receiver closes its end, commands are ignored
+                pass
+        except (OSError, ValueError):
+            pass
+        finally:
+            sock.close()
+
+# picks the transport for a station address, raises ValueError if it can't
+def transportFor(address):
+    if macAddr.match(address):
+        return rfcommTransport(address)
+    if '://' not in address:
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Unrecognized station address {address}")
+        return tcpTransport(host, int(port))
+    url = urlsplit(address)
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    if url.scheme == 'tcp' and url.hostname and url.port:
+        return tcpTransport(url.hostname, url.port)
+    if url.scheme == 'rfcomm':
+        parts = url.netloc.split(':') # a MAC, optionally followed by :channel
+        mac, channel = ':'.join(parts[:6]), ':'.join(parts[6:])
+        if macAddr.match(mac) and (not channel or channel.isdigit()):
+            return rfcommTransport(mac, int(channel or 1))
+    if url.scheme == 'serial' and url.path:
+        return serialTransport(url.path, int(query.get('baud', 38400)))
+    if url.scheme == 'replay' and url.path:
+        return replayTransport(url.path, float(query.get('speed', 1)), query.get('loop', '0') not in ('0', ''))
+    raise ValueError(f"Unrecognized station address {address}")
@@ -17,9 +17,6 @@ It will work to some degree without the fix but it needs to pair every time
 
 TODO: Finish detailed commenting
 TODO: Backlight slider?
-TODO: Early warning about connection problems via message timing
-TODO: Daily High / Low temp?
-TODO: Wind Chill
 TODO: 
 TODO: 
 
@@ -28,17 +25,32 @@ v2.0 - GUI Base
 v2.1 - Moved listener from separate thread into connection thread
      - Added settings page and reconfigured input buttons
      - Changed watcher to a stoppable a subclass and eliminated loop delay
+     - Replaced the byte at a time recv loop with a buffered select driven frame reader
+     - Watcher now sleeps until the connection exits and backs off between failed attempts
+     - Added an optional asyncio engine that runs the connection on kivy's event loop (engine = asyncio)
+     - The asyncio engine receives from every station listed in [Stations] at once
+     - Samples are stored in a memory mapped ring file per station
+     - Added 1 sec / 1 min / 1 hour / 1 day rollups and today's high / low temperature
+     - Moved the receiver into the headless btwind package (python3 -m btwind), this app is now a thin client
+     - The display shows the newest sample at most once per frame / update interval and only rewrites changed labels
+     - Asks the station for compact crc checked binary frames (protocol = binary), json still works as a fallback
+     - Samples are typed objects (btwind.samples) instead of dicts of strings
+     - A damaged frame is skipped and counted instead of dropping the connection, sequence numbers count lost frames
+     - Stations can be reached over TCP, USB serial or a replayed recording as well as bluetooth (btwind.transports)
+     - Early warning about connection problems: the status line shows link timing and turns amber when it degrades
+     - Optional Prometheus metrics endpoint for unattended receivers ([Metrics] section)
+     - msg() and print replaced by btwind.logs: background writer, rotating log file, level set from the settings
+       page and a post-mortem of the recent log when a link is lost ([Logging] section)
+     - Bounded queues: commands go out by priority in batches, storage and the outbox run behind a lossless queue
+     - Pulse mode: the station sends its raw anemometer pulses and the receiver works out a calibrated, smoothed
+       speed and 3 second gusts from them ([Pulses] section, needs numpy)
+     - Wind analytics: sustained wind, gust factor, turbulence intensity and lulls per station ([Analytics] section)
+     - Wind chill and feels like temperature, worked out once per sample by the receiver and kept in the rollups
+     - Backfill: the station keeps 5 minutes of samples and sends the missed ones after a reconnect
+     - Samples are timed by the station's clock, its offset and drift learned from the millis() it sends
        
 '''
-import bluetooth
-import select
-from queue import Queue
-import json
-import os
-import telnetlib
-import socket
 import threading
-import time
 
 from kivy.lang import Builder
 from kivy.uix.boxlayout import BoxLayout
@@ -58,12 +70,15 @@ from kivy.clock import Clock, mainthread
 from kivy.storage.dictstore import DictStore
 from kivy.uix.settings import SettingsWithSidebar
 from json_settings import json_settings
+from btwind import logs
+from btwind.logs import msg
+from btwind.config import defaults as settingDefaults
+from btwind.receiver import receiver
+from btwind.display import latestSample, labelCache
 from kivy.uix.progressbar import ProgressBar
 from kivy.core.window import Window
 Window.size = (400, 275)
 
-DEBUGLVL = 3
-
 # kivy lang code to build the settings button ... while part of the functioning
 # code this is basically here for example so I can learn to do ui with kv lang
 Builder.load_string('''
@@ -124,170 +139,109 @@ class MainView(BoxLayout):
         self.add_widget(self.containerStack)
         self.comErr = False
 
-        # initialize data queues used to pass data between threads
-        # these queue names may seem non intuitive but they refer to the flow of data into or out of the connection thread
-        self.qIn = Queue() # this is the queue that we'll input messages to be sent to the remote host
-        self.qOut = Queue() # this is the queue that we'll recieve messages from the remote host
-
-        # start watcher thread, this thread's purpose is to start the connection on first run and restart whenever connection is lost
-        self.watcher = watcherThread(self) # initialize watcher thread
-        self.watcher.start() # start the watcher thread
+        # samples are handed to the UI through latestSample, it keeps only the newest one so a burst of frames
+        # turns into one refresh, at most once per frame or per the update setting (seconds, 0 = every frame)
+        self.latest = latestSample(storage.getfloat('General', 'update', fallback=1))
+        self.labels = labelCache() # only labels whose text changed get rewritten
+
+        # the receiver core (btwind) owns the connections and the storage/MQTT sinks, this view only displays.
+        # With the asyncio engine every station in [Stations] runs as coroutines on kivy's own event loop and
+        # the callbacks arrive on the main thread, the app starts it in on_start. The thread engine calls back
+        # on its connection thread
+        if storage.get('General', 'engine', fallback='thread') == 'asyncio':
+            self.rx = receiver(storage, "btwindrx.ini", onSample=self.stationSample, onState=self.stationState)
+        else:
+            self.rx = receiver(storage, "btwindrx.ini", onSample=self.stationSample, onState=self.queueState)
+            self.rx.start() # start watcher thread, it starts the connection on first run and restarts it whenever it's lost
+        Clock.schedule_interval(self.showHealth, 1) # link timing, a stalled link has no samples to trigger a refresh
+
+    # This sends a command to the displayed box through whichever engine is running
+    def sendCommand(self, cmd):
+        self.rx.send(cmd)
 
     # This queues up an outgoing command to toggle the display lights in the box
     def toggleDispLights(self, touch):
-        self.qIn.put("@L@") # add a command to the listener thread input queue
+        self.sendCommand("@L@")
 
     # This queues up an outgoing command to reset the high gust in the box
     def resetGust(self, touch):
-        self.qIn.put("@R@") # add a command to the listener thread input queue 
+        self.sendCommand("@R@")
+
+    # Called for every sample of every station, on the connection thread or on the main thread with the hub.
+    # Only the displayed station reaches the screen and only the newest sample is kept until the next refresh
+    def stationSample(self, m):
+        if m.station == self.rx.station():
+            delay = self.latest.put(m)
+            if delay is not None: # no refresh scheduled yet, Clock is safe to call from any thread
+                Clock.schedule_once(self.onDataUpdate, delay)
+
+    def stationState(self, name, up):
+        if name == self.rx.station():
+            self.linkState(up)
+
+    # The thread engine calls this on its connection thread
+    @mainthread
+    def queueState(self, name, up):
+        self.linkState(up)
+
+    def linkState(self, up):
+        if up:
+            self.labels.set(self.connStatusLbl, "BT: Connected")
+            self.connStatusLbl.color = [86,70,10,1]
+        else:
+            self.connLost()
+
+    # Shows the displayed station's link health (btwind.linkhealth) in the status line, once a second
+    def showHealth(self, dt=0):
+        health = self.rx.health()
+        if health is None:
+            return
+        state, reason = health.check()
+        if state == "down":
+            return # connLost has already set the line
+        self.labels.set(self.connStatusLbl, "BT: " + health.summary())
+        self.connStatusLbl.color = [86,70,10,1] if state == "ok" else [1,0.6,0,1]
 
     # Do this UI stuff whenever the connection is lost
     @mainthread
     def connLost(self):
-        self.windStatusLbl.text = "-- mph"
-        self.gustStatusLbl.text = "Highest Gust: -- mph"
-        self.tempStatusLbl.text = "Temperature: ---"
-        self.connStatusLbl.text = "BT: Disconnected"
+        self.latest.clear() # a refresh that's still scheduled must not bring the last sample back
+        self.labels.set(self.windStatusLbl, "-- mph")
+        self.labels.set(self.gustStatusLbl, "Highest Gust: -- mph")
+        self.labels.set(self.tempStatusLbl, "Temperature: ---")
+        self.labels.set(self.space2StatusLbl, "")
+        self.labels.set(self.connStatusLbl, "BT: Disconnected")
         self.connStatusLbl.color = [6,100,81,8]
 
-    # This is run whenever a complete datagram arrives, it updates UI components
-    @mainthread 
-    def onDataUpdate(self):
-        m = self.qOut.get()
-        self.windStatusLbl.text = f'{m["mph"]} mph' # update wind speed display
-        self.gustStatusLbl.text = f'Highest Gust: {m["gust"]} mph' # update high gust display
-        self.tempStatusLbl.text = f'Temperature: {m["temp"]}' # update temperature display
+    # This is scheduled on the main thread when a sample arrives and no refresh is pending, it shows the newest one
+    def onDataUpdate(self, dt=0):
+        m = self.latest.take()
+        if m is not None:
+            self.showSample(m)
+
+    # Puts a sample on the screen, must be called on the main thread
+    def showSample(self, m):
+        if m.speed is not None: # pulse mode, the receiver's own estimate
+            self.labels.set(self.windStatusLbl, f'{m.speed:.1f} mph')
+        else:
+            self.labels.set(self.windStatusLbl, f'{m.mph} mph') # update wind speed display
+        self.labels.set(self.gustStatusLbl, f'Highest Gust: {m.gust} mph') # update high gust display
+        if m.windchill is not None: # cold and windy enough for a wind chill
+            self.labels.set(self.tempStatusLbl, f'Temperature: {m.temp:.1f}  Wind Chill: {m.windchill:.0f}')
+        else:
+            self.labels.set(self.tempStatusLbl, f'Temperature: {m.temp:.1f}') # update temperature display
+        if hasattr(self.rx, 'rollups'):
+            today = self.rx.rollups.current(m.station)
+            if today:
+                self.labels.set(self.space2StatusLbl, f'Today: High {today["tempHi"]:.1f} / Low {today["tempLo"]:.1f}') # daily temperature range
+
+    # Display refresh instrumentation, update latency, skipped samples and label writes saved
+    def stats(self):
+        stats = self.latest.stats()
+        stats.update(self.labels.stats())
+        return stats
 
 
-##########################################################################################################
-#######   Begin Watcher Class   ##########################################################################
-##########################################################################################################
-
-# This is always running, it restarts the connection when
-# the conection thread exits due to failed connection or host down. 
-class watcherThread(threading.Thread):
-    def __init__(self, p):
-        super(watcherThread, self).__init__()
-        self.daemon = False
-        self._stop_event = threading.Event()
-        self.p = p
-
-    def run(self):
-        self.watcher()
-
-    def watcher(self):
-        while 1:
-            if self.stopped():
-                break
-            if not hasattr(self, "connection") or not self.connection.is_alive():
-                self.connection = connectionThread(self.p.qIn, self.p.qOut, self)
-                self.connection.start()
-        msg("Watcher thread is exiting", 3)
-        
-
-    def stop(self):
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-
-##########################################################################################################
-######### Begin Connection Class #########################################################################
-##########################################################################################################
-
-# This is always run in a separate non-daemon thread, it connects and stays alive
-# as long as the connection within it stays alive. When an established connection dies,
-# or a connect fails the thread dies The watcher will re-start it indefinitely to establish
-# a new connection.      
-class connectionThread(threading.Thread):
-    def __init__(self, qIn, qOut, p, args=()):
-        super(connectionThread, self).__init__()
-        self._stop_event = threading.Event()
-        self.daemon = False
-        self.p = p
-        self.qIn = qIn
-        self.qOut = qOut
-
-    def run(self):
-        self.connectBT()
-
-    def connectBT(self):
-        devAddr = storage.get('General', 'address') # address of the bluetooth rfcomm device from settings
-        port = 1 # communication channel
-        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM) # init the socket
-        msg(f"Attempting BT RFCOMM connection with {devAddr}", 3)
-        try:
-            sock.connect((devAddr, port)) # try to connect
-            sock.settimeout(1) # not sure if this is needed, sts the socket timeout to blocking
-        except bluetooth.btcommon.BluetoothError as e:
-            msg(f"Failed to establish connection with {devAddr}: {e}")
-            return # no connection, jump on outta this thread and watcher will start a new one soon to try again
-        msg(f"Successfully connected with {devAddr}", 3)
-        self.p.p.connStatusLbl.text = "BT: Connected" # update UI
-        self.p.p.connStatusLbl.color = [86,70,10,1]
-        sock.settimeout(0) # this is necessary, it allows non-blocking access to the coms
-        while 1:
-            self.clear() # this is absolutely necessary, the stop flag remains set even though the thread was restarted listen would then return stop in stage 1
-            if self.listen(sock) == 'stop': # check for some data, if stop is returned, close out this connection
-                msg("Connection thread is exiting, stop was returned from listener", 3)
-                break # jump out of loop causing thread to exit
-            if len(self.qIn.queue) > 0: # this unassuming bit of code is very important, if there's anything in the input queue ...
-                sock.send(self.qIn.get()) # send it over the wire
-            
-    def listen(self, sock):
-        if self.stopped(): # if the stop signal has been set
-            msg("Listener is exiting, stop call detected in listener.listen() stage 1", 3)
-            return 'stop' # return stop to close the socket and exit the threads cleanly
-        data = self.com(sock)
-        if self.stopped(): # if the stop signal has been set
-            msg("Listener is exiting, stop call detected in listener.listen() stage 2", 3)
-            return 'stop' # return stop to close the socket and exit the threads cleanly  
-        if data == "{":
-            message = data
-            while 1:
-                if self.stopped(): # if the stop signal has been set
-                    msg("Listener is exiting, stop call detected in listener.listen() stage 3", 3)
-                    return 'stop' # return stop to close the socket and exit the threads cleanly 
-                while 1 :
-                    if self.stopped(): # if the stop signal has been set
-                        msg("Listener is exiting, stop call detected in listener.listen() stage 4", 3)
-                        return 'stop' # return stop to close the socket and exit the threads cleanly 
-                    data = self.com(sock)
-                    if data:
-                        break
-                message += data
-                if data == "}":
-                    dataDict = json.loads(message)
-                    self.qOut.put(dataDict) # add message to queue for reading in the main thread
-                    self.p.p.onDataUpdate() # trigger update of UI
-                    break
-
-    def com(self, sock):
-        try:
-            data = sock.recv(1)
-        except bluetooth.btcommon.BluetoothError as e:
-            if str(e).find("temporarily") >= 0: # this is no data on the pipe, situation normal, just return
-                return
-            if str(e).find("busy") >= 0: # this is just no data on the pipe, situation normal, just return
-                return
-            else: # this is a loss of connection
-                self.p.p.connLost()
-                msg(f"The connection was lost: {e}")
-                msg("Stop will now be called in listener.com()", 2)
-                self.stop()
-                return
-        if data:
-            return data.decode("utf-8")
-            
-    def stop(self):
-        self._stop_event.set()
-
-    def clear(self):
-        self._stop_event.clear()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-
 ##########################################################################################################
 #######   Begin App class   ##############################################################################
 ##########################################################################################################
@@ -300,11 +254,13 @@ class btwindrx(App):
         # otherwise the app window will close, but the Python process will
         # keep running until all secondary threads exit.
         msg("User initiated shutdown, sending non-daemon threads a stop signal", 3)
-        if hasattr(self.mv, 'watcher'):
-            self.mv.watcher.stop()
-        if hasattr(self.mv.watcher, 'connection'):
-            self.mv.watcher.connection.stop()
+        msg("Display refresh: %s", 3, self.mv.stats()) # update latency and skipped sample counts
+        self.mv.rx.stop() # stops the connections, then flushes and closes the stores
         self.root.stop.set()
+
+    def on_start(self):
+        if self.mv.rx.engine == 'asyncio':
+            self.mv.rx.start() # the asyncio station hub runs as a task alongside kivy on the same loop
     
     def build(self):
         #self.settings_cls = SettingsWithSidebar # Optional alternative settings layout
@@ -313,7 +269,12 @@ class btwindrx(App):
         return self.mv
 
     def build_config(self, config):
-        config.setdefaults("General", {"address": "00:18:E4:0C:68:00", "update": "1", "connection":"1", "lights":"1"})
+        config.setdefaults("General", settingDefaults["General"])
+        config.setdefaults("Storage", settingDefaults["Storage"])
+        config.setdefaults("Metrics", settingDefaults["Metrics"])
+        config.setdefaults("Logging", settingDefaults["Logging"])
+        config.setdefaults("Pulses", settingDefaults["Pulses"])
+        config.setdefaults("Analytics", settingDefaults["Analytics"])
 
     def build_settings(self, settings):
         settings.add_json_panel("General", self.config, data=json_settings)
@@ -322,27 +283,46 @@ class btwindrx(App):
         if key == "address":
             storage.set('General', 'address', value)
         elif key == "update":
-            storage.set('General', 'interval', value)
+            storage.set('General', 'update', value)
+            self.mv.latest.interval = float(value)
         elif key == "connection":
             storage.set('General', 'connection', value)
+            self.mv.rx.setEnabled(value == '1') # connect or disconnect right away
+        elif key == "retrymax":
+            storage.set('General', 'retrymax', value)
+            self.mv.rx.configure(limit=float(value))
+        elif key == "retries":
+            storage.set('General', 'retries', value)
+            self.mv.rx.configure(retries=int(value))
+        elif key == "station":
+            storage.set('General', 'station', value)
+        elif key == "record":
+            storage.set('General', 'record', value)
+        elif key == "cadence":
+            storage.set('General', 'cadence', value)
+        elif key == "protocol":
+            storage.set('General', 'protocol', value)
+            self.mv.rx.setProtocol(value)
+        elif key == "level":
+            storage.set('Logging', 'level', value)
+            logs.setLevel(value)
+        elif key == "file":
+            storage.set('Logging', 'file', value)
         elif key == "lights":
             storage.set('General', 'lights', value)
-            self.mv.qIn.put("@L@") # add a command to the listener thread input queue
+            self.mv.sendCommand("@L@")
 
 ##########################################################################################################
 #######   Begin Main Line Code   #########################################################################
 ##########################################################################################################
 
-# error/msg/log handling 
-def msg(msg, lvl=1):
-    debugLvl = 3
-    if debugLvl > 0 and lvl <= debugLvl:
-        if lvl == 1: print(f'ERROR - {msg}\n')
-        if lvl == 2: print(f'WARN - {msg}\n')
-        if lvl == 3: print(f'INFO - {msg}\n')
-
 # this starts our kivy app and is the only main line code other than imports.
 if __name__ == '__main__':
     storage = ConfigParser()
     storage.read("btwindrx.ini")
-    btwindrx().run()
+    logs.fromConfig(storage) # msg() and the btwind modules log through a background writer
+    if storage.get('General', 'engine', fallback='thread') == 'asyncio':
+        import asyncio
+        asyncio.run(btwindrx().async_run(async_lib='asyncio'))
+    else:
+        btwindrx().run()
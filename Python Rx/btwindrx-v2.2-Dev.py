@@ -19,22 +19,12 @@ TODO: Settings Page
 TODO: Backlight slider
 TODO: Backlight status
 TODO: Daily High / Low temp?
-TODO: Wind Chill
 TODO: Finish detailed commenting
 TODO: Early warning about connection problems via message timing
 
 '''
-import bluetooth
-import select
-from queue import Queue
-import json
-import os
-import telnetlib
-import socket
 import threading
-import time
 
-import paho.mqtt.client as mqtt
 from kivy.lang import Builder
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.stacklayout import StackLayout
@@ -51,13 +41,15 @@ from kivy.config import Config
 from kivy.clock import Clock, mainthread
 from kivy.storage.dictstore import DictStore
 from kivy.uix.settings import SettingsWithSidebar
-from json_settings import json_settings
+from json_settings import json_settings, mqtt_settings
+from btwind import logs
+from btwind.logs import msg
+from btwind.config import defaults as settingDefaults
+from btwind.receiver import receiver
 from kivy.uix.progressbar import ProgressBar
 from kivy.core.window import Window
 Window.size = (400, 275)
 
-DEBUGLVL = 3
-
 Builder.load_string('''
 <Interface>:
     orientation: 'vertical'
@@ -82,11 +74,9 @@ class MainView(BoxLayout):
 
 ## Builds the main control view
     def windMain(self):
-        self.client = mqtt.Client('myclientID')
-        self.client.connect('10.5.5.3')
-        self.qIn = Queue()
-        self.qOut = Queue()
-        self.listener = listenerThread(self.qIn, self.qOut, self) # build listener thread
+        # the receiver core (btwind) owns the connection, storage and the mqtt publisher for the
+        # openhab home control server (through the disk outbox), this view only displays
+        self.rx = receiver(App.get_running_app().config, "btwindrx.ini", onSample=self.onDataUpdate, onState=self.onState)
         self.containerStack = StackLayout(padding=10, spacing=5, size_hint=(1, 1))
 
         # create a stack layout for info display
@@ -116,32 +106,27 @@ class MainView(BoxLayout):
         self.add_widget(self.containerStack)
         self.comErr = False
 
-        # start listener thread
-        self.connection = threading.Thread(target=connectBT, args=(self,)) # build connector thread
-        self.connection.daemon = False
-        self.connection.start()
-
-        self.watcher = threading.Thread(target=self.watcher, args=()) # build connector thread
-        self.watcher.daemon = True
-        self.watcher.start()
+        # start the watcher thread, it starts the connection and restarts it whenever it's lost
+        self.rx.start()
 
 ######### Begin in-class functions #########################################################################
 
     # This queues up an outgoing command to toggle the display lights in the box
     def toggleDispLights(self, touch):
-        self.qIn.put("@L@") # add a command to the listener thread input queue
+        self.rx.send("@L@") # add a command to the connection thread input queue
 
     # This queues up an outgoing command to reset the high gust in the box
     def resetGust(self, touch):
-        self.qIn.put("@R@") # add a command to the listener thread input queue 
+        self.rx.send("@R@") # add a command to the connection thread input queue
 
-    # This is always running in a daemon thread, it restarts the connection when
-    # connection is lost or fails. This function calls startConnectionThread in the
-    # main thread every second which starts a new connection thread only if none exists
-    def watcher(self):
-        while 1:
-            time.sleep(1)
-            self.startConnectionThread(None)
+    # The receiver calls this on its connection thread when the link goes up or down
+    @mainthread
+    def onState(self, station, up):
+        if up:
+            self.connStatusLbl.text = "BT: Connected"
+            self.connStatusLbl.color = [86,70,10,1]
+        else:
+            self.connLost()
 
     # Do this UI stuff whenever the connection is lost
     @mainthread
@@ -152,127 +137,19 @@ class MainView(BoxLayout):
         self.connStatusLbl.text = "BT: Disconnected"
         self.connStatusLbl.color = [6,100,81,8]
         
-    # This is run every 1 second by the watcher thread, if there's no connection thread, it fires off a new one 
-    @mainthread
-    def startConnectionThread(self, touch):
-        if not self.connection.is_alive(): # if there's no running connection thread
-            msg("Starting new connection thread", 3)
-            self.connection = threading.Thread(target=connectBT, args=(self,)) # build connection thread
-            self.connection.start() # start the new connection thread    
-
     # This is run whenever a complete datagram arrives, it updates UI components
     @mainthread 
     def onDataUpdate(self, m):
-        self.windStatusLbl.text = f'{m["mph"]} mph' # update wind speed display
-        self.gustStatusLbl.text = f'Highest Gust: {m["gust"]} mph' # update high gust display
-        self.tempStatusLbl.text = f'Temperature: {m["temp"]}' # update temperature display
-        # update the openhab home control server
-        self.client = mqtt.Client('myclientID')
-        self.client.connect('10.5.5.3')
-        self.client.publish("JHome/Backyard/Temperature", m["temp"])
-        self.client.publish("JHome/Backyard/Wind", m["mph"])
-        self.client.disconnect()
+        self.windStatusLbl.text = f'{m.mph} mph' # update wind speed display
+        self.gustStatusLbl.text = f'Highest Gust: {m.gust} mph' # update high gust display
+        if m.windchill is not None: # worked out by the receiver, see btwind/derived.py
+            self.tempStatusLbl.text = f'Temperature: {m.temp:.1f}  Wind Chill: {m.windchill:.0f}'
+        else:
+            self.tempStatusLbl.text = f'Temperature: {m.temp:.1f}' # update temperature display
 
 
 ######### END in-class functions #########################################################################
 
-# error/msg/log handling 
-def msg(msg, lvl=1):
-    if DEBUGLVL > 0 and lvl <= DEBUGLVL:
-        if lvl == 1: print(f'ERROR - {msg}\n')
-        if lvl == 2: print(f'WARN - {msg}\n')
-        if lvl == 3: print(f'INFO - {msg}\n')
-
-# This is always run in a separate non-daemon thread, it connects and stays alive
-# as long as the connection within it stays alive. When an established connection dies,
-# or a connect fails the thread dies The watcher will re-start it indefinitely to establish
-# a new connection.
-def connectBT(p):
-    devAddr = "00:18:E4:0C:68:00" # address of the bluetooth rfcomm device
-    port = 1 # communication channel
-    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM) # init the socket
-    msg(f"Attempting BT RFCOMM connection with {devAddr}", 3)
-    try:
-        sock.connect((devAddr, port)) # try to connect
-        sock.settimeout(1) # not sure if this is needed, sts the socket timeout to blocking
-    except bluetooth.btcommon.BluetoothError as e:
-        msg(f"Failed to establish connection with {devAddr}: {e}")
-        return # no connection, jump on outta this thread and watcher will start a new one soon to try again
-    msg(f"Successfully connected with {devAddr}", 3)
-    p.connStatusLbl.text = "BT: Connected" # update UI
-    p.connStatusLbl.color = [86,70,10,1]
-    sock.settimeout(0) # this is necessary, it allows non-blocking access to the coms
-    while 1:
-        p.listener.clear() # this is absolutely necessary, the stop flag remains set even though the thread was restarted without this listener stage 1 immediately calls stop
-        if p.listener.listen(sock) == 'stop': # check for some data, if stop is returned, close out this connection
-            msg("Connection thread is exiting, stop was returned from listener", 3)
-            break # jump out of loop causing thread to exit
-        if len(p.qIn.queue) > 0: # this unassuming bit of code is very important, if there's anything in the input queue ...
-            sock.send(p.qIn.get()) # send it over the wire
-        
-class listenerThread(threading.Thread):
-    def __init__(self, qIn, qOut, p, args=()):
-        super(listenerThread, self).__init__()
-        self._stop_event = threading.Event()
-        self.qIn = qIn
-        self.qOut = qOut
-        self.daemon = False
-        self.p = p
-        
-    def listen(self, sock):
-        if self.stopped(): # if the stop signal has been set
-            msg("Listener thread is exiting, stop call detected in listener.listen() stage 1", 3)
-            return 'stop' # return stop to close the socket and exit the threads cleanly
-        data = self.com(sock)
-        if self.stopped(): # if the stop signal has been set
-            msg("Listener thread is exiting, stop call detected in listener.listen() stage 2", 3)
-            return 'stop' # return stop to close the socket and exit the threads cleanly  
-        if data == "{":
-            message = data
-            while 1:
-                if self.stopped(): # if the stop signal has been set
-                    msg("Listener thread is exiting, stop call detected in listener.listen() stage 3", 3)
-                    return 'stop' # return stop to close the socket and exit the threads cleanly 
-                while 1 :
-                    if self.stopped(): # if the stop signal has been set
-                        msg("Listener thread is exiting, stop call detected in listener.listen() stage 4", 3)
-                        return 'stop' # return stop to close the socket and exit the threads cleanly 
-                    data = self.com(sock)
-                    if data:
-                        break
-                message += data
-                if data == "}":
-                    dataDict = json.loads(message)
-                    self.qOut.put(dataDict)
-                    self.p.onDataUpdate(dataDict)
-                    break
-
-    def com(self, sock):
-        try:
-            data = sock.recv(1)
-        except bluetooth.btcommon.BluetoothError as e:
-            if str(e).find("temporarily") >= 0: # this is no data on the pipe, situation normal, just return
-                return
-            if str(e).find("busy") >= 0: # this is just no data on the pipe, situation normal, just return
-                return
-            else: # this is a loss of connection
-                self.p.connLost()
-                msg(f"The connection was lost: {e}")
-                msg("Stop will now be called in listener.com()", 2)
-                self.stop()
-                return
-        if data:
-            return data.decode("utf-8")
-            
-    def stop(self):
-        self._stop_event.set()
-
-    def clear(self):
-        self._stop_event.clear()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-    
 # This class builds and starts our app       
 class btwindrx(App):
     
@@ -281,27 +158,38 @@ class btwindrx(App):
         # otherwise the app window will close, but the Python process will
         # keep running until all secondary threads exit.
         msg("User initiated shutdown, sending non-daemon threads a stop signal", 3)
-        if hasattr(self.mv, 'listener'):
-            self.mv.listener.stop()
+        self.mv.rx.stop() # stops the connection, lets the outbox fsync and save its state, stops the mqtt sink
         self.root.stop.set()
     
     def build(self):
         #self.settings_cls = SettingsWithSidebar # Optional alternative settings layout
         #self.use_kivy_settings = False
+        logs.fromConfig(self.config) # the [Logging] level, file and post-mortems from the settings
         self.mv = MainView()
-        try:
-            DEBUGLVL = self.mv.storage.get('debuglvl')['debuglvl']
-        except KeyError:
-            msg('KeyError "debugLvl" - Debug level setting not found in storage', 2)
         return self.mv
 
     def build_config(self, config):
         config.setdefaults("General", {"ip": "127.0.0.1", "port": "6969", "update": ".5", "connection":"1"})
+        for section in ("Storage", "MQTT", "Outbox", "Metrics", "Logging", "Pulses", "Analytics"):
+            config.setdefaults(section, settingDefaults[section])
 
     def build_settings(self, settings):
         settings.add_json_panel("Connection", self.config, data=json_settings)
+        settings.add_json_panel("MQTT", self.config, data=mqtt_settings)
 
     def on_config_change(self, config, section, key, value):
+        if section in ("Outbox", "Metrics", "Pulses", "Analytics"):
+            return # takes effect on restart
+        if section == "Logging":
+            if key == "level":
+                logs.setLevel(value)
+            return # the log file takes effect on restart
+        if section == "MQTT":
+            if hasattr(self.mv.rx, 'mqtt') and key == "interval":
+                self.mv.rx.mqtt.interval = float(value)
+            elif hasattr(self.mv.rx, 'mqtt') and key.startswith("topic_"):
+                self.mv.rx.mqtt.topics[key[6:]] = value
+            return # broker, client and qos changes take effect on restart
         if key == "ip":
             self.mv.storage.put('hostip', ip=value)
         elif key == "port":
@@ -316,4 +204,5 @@ class btwindrx(App):
 
 # this starts our kivy app and is the only main line code other than imports.
 if __name__ == '__main__':
+    logs.setup() # until build() applies the [Logging] settings
     app = btwindrx().run()
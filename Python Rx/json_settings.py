@@ -12,9 +12,179 @@ json_settings = json.dumps([
     {
         "type": "string",
         "title": "Device Address",
-        "desc": "Device MAC Address",
+        "desc": "Device MAC Address, or host:port, serial:///dev/ttyACM0, replay:///path/file.rec",
         "section": "General",
         "key": "address"
+    },
+    {
+        "type": "string",
+        "title": "Record File",
+        "desc": "Write the raw link to this replay file, blank = off, takes effect on restart",
+        "section": "General",
+        "key": "record"
+    },
+    {
+        "type": "numeric",
+        "title": "Display Update",
+        "desc": "Minimum seconds between display refreshes, 0 to refresh every frame",
+        "section": "General",
+        "key": "update"
+    },
+    {
+        "type": "numeric",
+        "title": "Station Interval",
+        "desc": "Seconds between station updates, links that drift from it are flagged as degraded, takes effect on restart",
+        "section": "General",
+        "key": "cadence"
+    },
+    {
+        "type": "bool",
+        "title": "Auto Connect",
+        "desc": "Connect to the device and reconnect whenever the connection is lost",
+        "section": "General",
+        "key": "connection"
+    },
+    {
+        "type": "numeric",
+        "title": "Max Retry Delay",
+        "desc": "Longest wait in seconds between reconnect attempts",
+        "section": "General",
+        "key": "retrymax"
+    },
+    {
+        "type": "numeric",
+        "title": "Retry Limit",
+        "desc": "Stop trying after this many failed attempts in a row, 0 to keep trying",
+        "section": "General",
+        "key": "retries"
+    },
+    {
+        "type": "options",
+        "title": "Receive Engine",
+        "desc": "Threads or asyncio for the connection, takes effect on restart",
+        "section": "General",
+        "key": "engine",
+        "options": ["thread", "asyncio"]
+    },
+    {
+        "type": "options",
+        "title": "Wire Protocol",
+        "desc": "Ask the station for compact binary frames or JSON, takes effect on the next connection",
+        "section": "General",
+        "key": "protocol",
+        "options": ["binary", "json"]
+    },
+    {
+        "type": "string",
+        "title": "Displayed Station",
+        "desc": "Name of the station to show from the Stations section, blank for the first",
+        "section": "General",
+        "key": "station"
+    },
+    {
+        "type": "numeric",
+        "title": "Sample History",
+        "desc": "Days of samples kept per station, takes effect for new storage files",
+        "section": "Storage",
+        "key": "days"
+    },
+    {
+        "type": "bool",
+        "title": "Pulse Mode",
+        "desc": "Ask the station for its raw anemometer pulses and work out the speed here (needs numpy), takes effect on restart",
+        "section": "Pulses",
+        "key": "enabled"
+    },
+    {
+        "type": "string",
+        "title": "Calibration",
+        "desc": "Pulse mode rev/s:mph points, e.g. 0:0, 1:10 (the station's own rpm / 6), takes effect on restart",
+        "section": "Pulses",
+        "key": "calibration"
+    },
+    {
+        "type": "options",
+        "title": "Log Level",
+        "desc": "Least important messages shown and written to the log file",
+        "section": "Logging",
+        "key": "level",
+        "options": ["DEBUG", "INFO", "WARNING", "ERROR"]
+    },
+    {
+        "type": "string",
+        "title": "Log File",
+        "desc": "Also log to this file, rotated at Logging/maxkb, blank = console only, takes effect on restart",
+        "section": "Logging",
+        "key": "file"
     }
     
 ])
+
+mqtt_settings = json.dumps([
+
+    {
+        "type": "bool",
+        "title": "Publish to MQTT",
+        "desc": "Publish samples to an MQTT broker, takes effect on restart",
+        "section": "MQTT",
+        "key": "enabled"
+    },
+    {
+        "type": "string",
+        "title": "Broker",
+        "desc": "MQTT broker host name or address, takes effect on restart",
+        "section": "MQTT",
+        "key": "broker"
+    },
+    {
+        "type": "numeric",
+        "title": "Broker Port",
+        "desc": "MQTT broker port, takes effect on restart",
+        "section": "MQTT",
+        "key": "port"
+    },
+    {
+        "type": "options",
+        "title": "QoS",
+        "desc": "MQTT quality of service level, takes effect on restart",
+        "section": "MQTT",
+        "key": "qos",
+        "options": ["0", "1", "2"]
+    },
+    {
+        "type": "numeric",
+        "title": "Publish Interval",
+        "desc": "Minimum seconds between publishes, newer values replace unpublished ones. Only without the outbox, through it every sample is published",
+        "section": "MQTT",
+        "key": "interval"
+    },
+    {
+        "type": "string",
+        "title": "Temperature Topic",
+        "desc": "Topic for temperature, {station} is replaced with the station name",
+        "section": "MQTT",
+        "key": "topic_temp"
+    },
+    {
+        "type": "string",
+        "title": "Wind Topic",
+        "desc": "Topic for wind speed, {station} is replaced with the station name",
+        "section": "MQTT",
+        "key": "topic_mph"
+    },
+    {
+        "type": "bool",
+        "title": "Store and Forward",
+        "desc": "Log samples to disk and replay them when the broker comes back, takes effect on restart",
+        "section": "Outbox",
+        "key": "enabled"
+    },
+    {
+        "type": "numeric",
+        "title": "Outbox Size",
+        "desc": "Most disk space in MB for samples waiting on the broker, oldest are dropped first",
+        "section": "Outbox",
+        "key": "maxmb"
+    }
+
+])
@@ -5,6 +5,11 @@
 // Arduino tracks each revolution and calculates RPM and wind speed
 // ModernDevice LCD117 tty serial LCD displays wind speed and BT status
 // Seeed Bluetooth Shield v1 transmits JSON data via BT serial connection 
+// or compact binary frames once the receiver sends @B@ (@J@ goes back to JSON)
+// A receiver on the USB serial port gets the same data once it sends @B@ or @J@ there
+// @P@ adds pulse frames, the micros() time of every magnet pass, so the receiver can work out the speed itself
+// The last 300 samples are kept with their millis() whether or not anyone is connected, @F<seq>@ sends back the ones
+// after seq in backfill frames, so a receiver that lost the link can fill the hole
 
 // TODO: Send display light status to remote host
 // TODO: Set PIN IO0 to High on reset to ensure BT disconnect? 
@@ -55,6 +60,44 @@ int mphLast = 1;
 int gustLast = 1;
 String tempLast = "";
 
+// binary frames: 0xA5, payload length, type, payload, crc16 (CCITT over length, type and payload), little endian
+int binMode = 0;               // 1 = send binary frames instead of JSON, reset to JSON whenever BT disconnects
+const byte frameSync = 0xA5;
+const byte frameSample = 1;    // payload: mph, gust (uint16), temp x10 (int16), seq (uint16), millis() (uint32)
+unsigned int seq = 0;          // counts datagrams sent so the receiver can spot lost and repeated ones
+unsigned long sampleMs = 0;    // millis() when the current sample was taken, sent with it so the receiver can time it
+char lastSrc = 'B';            // where the last received char came from, B = bluetooth, U = USB serial
+int usbLink = 0;               // 1 once a receiver on USB serial has asked for data
+int usbBin = 0;                // 1 = binary frames on USB serial
+
+// pulse frames: payload is the index of the first pulse (uint16), micros() when sent (uint32), then if there are
+// any pulses micros() of the first (uint32) and a 3 byte delta to each of the others
+const byte framePulses = 2;
+const int pulseMax = 32;       // pulses buffered between frames, 32 x 4 bytes of RAM
+unsigned long pulseTimes[pulseMax];
+int pulseCount = 0;            // pulses in the buffer
+unsigned int pulseIndex = 0;   // counts every pulse so the receiver can spot a lost frame
+int pulseMode = 0;             // 1 = pulse frames over bluetooth, reset whenever BT disconnects
+int usbPulses = 0;             // 1 = pulse frames on USB serial
+
+// backfill frames: payload is the seq of the first sample (uint16), millis() when sent (uint32), then for each sample
+// millis() when it was taken (uint32), mph, gust (uint8, capped at 255) and temp x10 (int16)
+const byte frameBackfill = 3;
+const int backlogMax = 300;    // samples kept, 5 minutes at 1 Hz, 8 bytes each of RAM
+const int backfillMax = 31;    // samples per frame, as many as fit in a 255 byte payload
+unsigned long backlogMs[backlogMax];
+byte backlogMph[backlogMax];
+byte backlogGust[backlogMax];
+int backlogTemp[backlogMax];
+int backlogHead = 0;           // slot the next sample goes in
+int backlogCount = 0;          // samples held, the newest is seq - 1
+unsigned int backfillNext = 0; // seq of the next sample to backfill
+unsigned int backfillEnd = 0;  // seq the backfill stops before
+HardwareSerial *backfillPort = &Serial3;
+byte backfillFrame[5 + 6 + 8 * backfillMax];
+int backfillLen = 0;           // bytes in backfillFrame
+int backfillSent = 0;          // bytes of it already written
+
 // Timed Events
 const int dataUpdateInterval = 1000; // ms
 TimerEvent dataUpdateTimer; 
@@ -90,7 +133,9 @@ void loop()
 }
 
 void updateData() {
-  String t = getTemp();
+  sampleMs = millis();
+  int tenths = getTempTenths();
+  String t = getTemp(tenths);
   if (mphLast != mph) {
     lcd.print("?a?lWind Speed: " + String(mph));
   }
@@ -100,9 +145,16 @@ void updateData() {
   if (tempLast != t) {
     lcd.print("?a?j?j?lTemp: " + t);
   }
+  finishBackfill(); // a sample can't go out in the middle of a backfill frame
+  sendPulses(); // the pulses up to now go ahead of the sample
   if (btState == '4') {
-    Serial3.print("{\"mph\":\"" + String(mph) + "\", \"gust\":\"" + String(gust) + "\", \"temp\":\"" + t + "\"}"); // json formatted output for BT com
+    sendSample(Serial3, binMode, tenths, t);
+  }
+  if (usbLink) {
+    sendSample(Serial, usbBin, tenths, t); // same sample and seq as bluetooth
   }
+  addBacklog(tenths);
+  seq++; // counts every sample, sent or not, so the backlog can be asked for by seq
   mphLast = mph;
   gustLast = gust;
   tempLast = t;
@@ -142,14 +194,21 @@ char com()
       //lcd.print("?a?j?lHighest Gust: " + String(gust));
       //btDataUpdate();
     }
+    if (pulseCount == pulseMax) { // the pulse buffer filled up in wind(), send it here
+      finishBackfill();
+      sendPulses();
+    }
+    pumpBackfill(); // a little of any backfill at a time, in what fits in the serial buffer
     char recvChar;
     if(Serial3.available()){// check if there's any data sent from the remote bluetooth shield
       recvChar = Serial3.read();
+      lastSrc = 'B';
       //Serial.print(recvChar);
       return recvChar;
     }
     if(Serial.available()){// check if there's any data sent from the local serial terminal, you can add the other applications here
       recvChar  = Serial.read();
+      lastSrc = 'U';
       //Serial3.print(recvChar);
       return recvChar;
     }
@@ -168,6 +227,27 @@ void rcvProgMsg()
         gust = 0;
         //lcd.print("?a?j?lHighest Gust: " + String(gust));
         //btDataUpdate();
+      } else if (pMessage == "B" && lastSrc == 'U') { // a receiver on USB serial
+        usbLink = 1;
+        usbBin = 1;
+      } else if (pMessage == "J" && lastSrc == 'U') {
+        usbLink = 1;
+        usbBin = 0;
+        usbPulses = 0;
+      } else if (pMessage == "P" && lastSrc == 'U') {
+        usbLink = 1;
+        usbBin = 1;
+        usbPulses = 1;
+      } else if (pMessage == "B") { // receiver understands binary frames
+        binMode = 1;
+      } else if (pMessage == "J") { // back to JSON
+        binMode = 0;
+        pulseMode = 0;
+      } else if (pMessage == "P") { // receiver wants the raw pulse times, binary frames only
+        binMode = 1;
+        pulseMode = 1;
+      } else if (pMessage.charAt(0) == 'F') { // backfill the samples after the seq given, all of them for @F@
+        startBackfill(pMessage.substring(1));
       } else if (pMessage == "L") {
         if (dispLights == 1) {
           dispLights = 0;
@@ -198,6 +278,14 @@ void rcvSeedMsg()
     else if ((c == ':') && (sMessage.indexOf('+') >= 0)) { // Status message, status of seed is next rcvd char
         sMessage += c;
         btState = com(); // collect next char (status)
+        if (btState != '4') {
+          binMode = 0; // the next receiver may not know binary frames, it has to ask again
+          pulseMode = 0;
+          if (backfillPort == &Serial3) { // nobody left to backfill
+            backfillNext = backfillEnd;
+            backfillLen = backfillSent = 0;
+          }
+        }
         sMessage += btState; // add status to sMessage
         if (btInit == 0) {
           processSeedState(); // process the status update
@@ -235,6 +323,7 @@ void wind() {
   }
   else if (digitalRead(pin) == 0 && det == 0) {
     det = 1;    
+    addPulse(micros());
     if (moving == 0) { // first rotation, no print
       moving = 1;
       last = millis();
@@ -261,11 +350,151 @@ void wind() {
   }  
 }
 
-String getTemp() {
-  // gets a truncated String from a float
-  // TODO: Round to 4 digit int, then String 
+// Buffers a magnet pass for the pulse frames, com() sends them once the buffer is full so wind() never waits
+// on a serial write
+void addPulse(unsigned long us) {
+  pulseIndex++;
+  if (!((pulseMode && btState == '4') || usbPulses)) {
+    return;
+  }
+  if (pulseCount == pulseMax) { // com() hasn't sent the full buffer yet, the index shows the receiver the gap
+    return;
+  }
+  pulseTimes[pulseCount++] = us;
+}
+
+// Sends the buffered pulses to the receivers in pulse mode, an empty frame still gives them the time
+void sendPulses() {
+  int toBt = pulseMode && btState == '4';
+  if (!toBt && !usbPulses) {
+    pulseCount = 0;
+    return;
+  }
+  byte f[5 + 6 + 4 + 3 * (pulseMax - 1)];
+  unsigned long now = micros(); // every buffered pulse came before this
+  unsigned int first = pulseIndex - pulseCount;
+  int n = 3;
+  f[n++] = first & 0xFF;
+  f[n++] = (first >> 8) & 0xFF;
+  for (int b = 0; b < 4; b++) {
+    f[n++] = (now >> (8 * b)) & 0xFF;
+  }
+  for (int i = 0; i < pulseCount; i++) {
+    unsigned long v = i == 0 ? pulseTimes[0] : pulseTimes[i] - pulseTimes[i - 1];
+    for (int b = 0; b < (i == 0 ? 4 : 3); b++) {
+      f[n++] = (v >> (8 * b)) & 0xFF;
+    }
+  }
+  pulseCount = 0;
+  f[0] = frameSync;
+  f[1] = n - 3; // payload length
+  f[2] = framePulses;
+  unsigned int crc = crc16(f + 1, n - 1);
+  f[n++] = crc & 0xFF;
+  f[n++] = (crc >> 8) & 0xFF;
+  if (toBt) {
+    Serial3.write(f, n);
+  }
+  if (usbPulses) {
+    Serial.write(f, n);
+  }
+}
+
+// Keeps the sample about to go out as seq in the backlog, the oldest is overwritten once it's full
+void addBacklog(int tenths) {
+  backlogMs[backlogHead] = sampleMs;
+  backlogMph[backlogHead] = min(mph, 255);
+  backlogGust[backlogHead] = min(gust, 255);
+  backlogTemp[backlogHead] = tenths;
+  backlogHead = (backlogHead + 1) % backlogMax;
+  if (backlogCount < backlogMax) {
+    backlogCount++;
+  }
+}
+
+// @F<seq>@: backfill the samples after seq up to now to whoever asked, all of them if seq isn't in the backlog
+void startBackfill(String after) {
+  finishBackfill();
+  backfillNext = seq - backlogCount;
+  if (after.length() > 0) {
+    unsigned int start = (unsigned int)after.toInt() + 1;
+    if ((unsigned int)(seq - start) < (unsigned int)backlogCount) {
+      backfillNext = start;
+    }
+  }
+  backfillEnd = seq;
+  backfillPort = lastSrc == 'U' ? &Serial : &Serial3;
+}
+
+// Puts the next backfill frame in backfillFrame, 0 once there's nothing left to send
+int buildBackfillFrame() {
+  if ((unsigned int)(seq - backfillEnd) >= (unsigned int)backlogCount) { // even the end has been overwritten since
+    backfillNext = backfillEnd;
+    return 0;
+  }
+  if ((unsigned int)(seq - backfillNext) > (unsigned int)backlogCount) { // overwritten while waiting
+    backfillNext = seq - backlogCount;
+  }
+  byte *f = backfillFrame;
+  unsigned long now = millis();
+  int n = 3;
+  f[n++] = backfillNext & 0xFF;
+  f[n++] = (backfillNext >> 8) & 0xFF;
+  for (int b = 0; b < 4; b++) {
+    f[n++] = (now >> (8 * b)) & 0xFF;
+  }
+  for (int k = 0; k < backfillMax && backfillNext != backfillEnd; k++) {
+    int i = (backlogHead - (int)(unsigned int)(seq - backfillNext) + backlogMax) % backlogMax;
+    for (int b = 0; b < 4; b++) {
+      f[n++] = (backlogMs[i] >> (8 * b)) & 0xFF;
+    }
+    f[n++] = backlogMph[i];
+    f[n++] = backlogGust[i];
+    f[n++] = backlogTemp[i] & 0xFF;
+    f[n++] = (backlogTemp[i] >> 8) & 0xFF;
+    backfillNext++;
+  }
+  f[0] = frameSync;
+  f[1] = n - 3; // payload length
+  f[2] = frameBackfill;
+  unsigned int crc = crc16(f + 1, n - 1);
+  f[n++] = crc & 0xFF;
+  f[n++] = (crc >> 8) & 0xFF;
+  return n;
+}
+
+// Writes only what the serial buffer has room for, so wind() never waits on a backfill
+void pumpBackfill() {
+  if (backfillSent == backfillLen) {
+    if (backfillNext == backfillEnd) {
+      return;
+    }
+    backfillLen = buildBackfillFrame();
+    backfillSent = 0;
+  }
+  int n = min(backfillPort->availableForWrite(), backfillLen - backfillSent);
+  if (n > 0) {
+    backfillPort->write(backfillFrame + backfillSent, n);
+    backfillSent += n;
+  }
+}
+
+// Writes the rest of a backfill frame that's partly out, before anything else goes on the same port
+void finishBackfill() {
+  if (backfillSent < backfillLen) {
+    backfillPort->write(backfillFrame + backfillSent, backfillLen - backfillSent);
+    backfillSent = backfillLen;
+  }
+}
+
+// temperature in 1/10 degree F
+int getTempTenths() {
   float F = temp.GetTemperature()*9/5+32;
-  int rounded = round(F*10);
+  return round(F*10);
+}
+
+String getTemp(int rounded) {
+  // gets a truncated String from the temperature in 1/10 degree
   String strT = String(rounded);
   int i = strT.length()-1;
   String postDec = strT.substring(i);
@@ -274,6 +503,50 @@ String getTemp() {
   return strTemp;
 }
 
+// CRC-CCITT (poly 0x1021, init 0xFFFF), the receiver checks it with binascii.crc_hqx
+unsigned int crc16(const byte *data, int len) {
+  unsigned int crc = 0xFFFF;
+  for (int i = 0; i < len; i++) {
+    crc ^= (unsigned int)data[i] << 8;
+    for (int b = 0; b < 8; b++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// Sends the current sample to one receiver, as a binary frame or JSON
+void sendSample(Print &port, int bin, int tenths, String t) {
+  if (bin) {
+    sendSampleFrame(port, mph, gust, tenths, seq, sampleMs); // 17 bytes, no string building
+  } else {
+    port.print("{\"mph\":\"" + String(mph) + "\", \"gust\":\"" + String(gust) + "\", \"temp\":\"" + t + "\", \"seq\":\"" + String(seq) + "\", \"ms\":\"" + String(sampleMs) + "\"}"); // json formatted output
+  }
+}
+
+// Sends one sample as a binary frame
+void sendSampleFrame(Print &port, int mph, int gust, int tenths, unsigned int n, unsigned long ms) {
+  byte f[17];
+  f[0] = frameSync;
+  f[1] = 12; // payload length
+  f[2] = frameSample;
+  f[3] = mph & 0xFF;
+  f[4] = (mph >> 8) & 0xFF;
+  f[5] = gust & 0xFF;
+  f[6] = (gust >> 8) & 0xFF;
+  f[7] = tenths & 0xFF;
+  f[8] = (tenths >> 8) & 0xFF;
+  f[9] = n & 0xFF;
+  f[10] = (n >> 8) & 0xFF;
+  for (int i = 0; i < 4; i++) {
+    f[11 + i] = (ms >> (8 * i)) & 0xFF;
+  }
+  unsigned int crc = crc16(f + 1, 14);
+  f[15] = crc & 0xFF;
+  f[16] = (crc >> 8) & 0xFF;
+  port.write(f, 17);
+}
+
 // Start bluetooth shield
 void setupBlueToothConnection()
 {